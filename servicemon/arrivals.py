@@ -0,0 +1,37 @@
+"""
+Arrival processes for open-loop load generation, in which queries are started
+on a schedule rather than when the previous query finishes.
+"""
+import random
+
+__all__ = ['arrival_offsets']
+
+
+def arrival_offsets(kind, rate, seed=None):
+    """
+    Yield the offsets, in seconds from the start of the run, at which
+    successive queries are scheduled to start.
+
+    Parameters
+    ----------
+    kind : str
+        'fixed' for evenly spaced arrivals, or 'poisson' for exponentially
+        distributed gaps between arrivals.
+    rate : float
+        Mean arrivals per second.
+    seed : int or None
+        Seed for the random gaps of 'poisson' arrivals, for a repeatable schedule.
+    """
+    if rate <= 0:
+        raise ValueError(f'Arrival rate must be positive: {rate}')
+    if kind not in ('fixed', 'poisson'):
+        raise ValueError(f'Unknown arrival process: {kind}')
+
+    rng = random.Random(seed)
+    offset = 0.0
+    while True:
+        yield offset
+        if kind == 'fixed':
+            offset += 1.0 / rate
+        else:
+            offset += rng.expovariate(rate)
@@ -0,0 +1,436 @@
+"""
+An asyncio engine for running queries, selected with ``sm_query --engine asyncio``.
+
+A single event loop drives up to ``--workers`` queries at once, so hundreds of
+queries can be in flight without a thread for each.  The cone, xcone and TAP
+(sync, and async via UWS) flows are the same as those of `~servicemon.query.Query`,
+and produce the same `~servicemon.query_stats.QueryStats` rows.
+
+This engine requires the optional aiohttp package.
+
+Connection phases are recorded from aiohttp's request tracing.  aiohttp does not
+separate the TLS handshake from the TCP connect, so for https the connect duration
+includes the handshake and no tls_handshake duration is recorded.
+"""
+import io
+import os
+import logging
+import time
+import asyncio
+from distutils.version import LooseVersion
+from urllib.parse import urljoin, urlparse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from pyvo.dal.exceptions import DALQueryError, DALServiceError
+from pyvo.io import uws
+
+from .query import Query
+from .deadline import QueryTimeout, is_timeout
+from .pyvo_wrappers import _sleep_time
+from .query_timing import timed, record_duration, record_uws_times
+from .votable_meta import VOTableMetaExtractor
+from .timing_labels import (QUERY_TOTAL, DO_QUERY, STREAM_TO_FILE,
+                            TAP_SUBMIT, TAP_RUN, TAP_WAIT, TAP_RAISE_IF_ERROR,
+                            TAP_FETCH_RESPONSE, TAP_DELETE,
+                            DNS, CONNECT, TTFB, TRANSFER)
+
+__all__ = ['AsyncQuery', 'AsyncEngine']
+
+_CHUNK_SIZE = 65536
+
+
+class AsyncQuery(Query):
+    """
+    A Query that runs with aiohttp in an event loop.
+
+    Parameters
+    ----------
+    client_session : aiohttp.ClientSession
+        The session used for all requests.  It should be created by `AsyncEngine`
+        so that connection phases are traced.
+
+    All other arguments are those of `~servicemon.query.Query`.
+    """
+
+    def __init__(self, *args, client_session=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._client = client_session
+
+    async def run_async(self):
+        self._stats.mark_start_time(self._intended_start_time)
+        response = None
+        try:
+            with self._timings.activate(), self._deadline.activate(), timed(QUERY_TOTAL):
+                with timed(DO_QUERY):
+                    if self._service_type == 'cone':
+                        response = await self._request('GET', self._access_url,
+                                                       params=self._query_params)
+                    elif self._service_type == 'xcone':
+                        response = await self._request('GET', self._access_url)
+                    elif self._service_type == 'tap':
+                        if self._tap_mode == 'async':
+                            response = await self.do_tap_query_async()
+                        else:
+                            response = await self.do_tap_query_sync()
+                await self.stream_response_async(response)
+        except Exception as e:
+            self._timed_out = is_timeout(e) or self._deadline.expired
+            msg = f'Query error for service {self._service}: {repr(e)}'
+            self._handle_exc(msg)
+        finally:
+            self._stats.mark_end_time()
+
+        with self._timings.activate():
+            await self.dispose_job_async()
+        self.gather_response_metadata(response)
+        if response is not None:
+            response.release()
+        self._release_sessions()
+
+    async def dispose_job_async(self):
+        """
+        As `~servicemon.query.Query.dispose_job`, but an inline deletion does
+        not block the event loop.
+        """
+        if self._delete_jobs != 'inline':
+            self.dispose_job()
+            return
+        job_url, self._job_url = self._job_url, None
+        if job_url is None:
+            return
+        try:
+            with timed(TAP_DELETE):
+                response = await self._client.request(
+                    'DELETE', job_url, allow_redirects=False,
+                    timeout=aiohttp.ClientTimeout(total=self._deadline.read))
+                try:
+                    response.raise_for_status()
+                finally:
+                    response.release()
+        except Exception as e:
+            logging.warning(f'Error deleting UWS job {job_url}: {repr(e)}')
+
+    async def do_tap_query_sync(self):
+        response = await self._request('POST', f'{self._tap_baseurl()}/sync',
+                                       data=self._tap_params())
+        self._raise_for_status(response)
+        return response
+
+    async def do_tap_query_async(self):
+        with timed(TAP_SUBMIT):
+            response = await self._request('POST', f'{self._tap_baseurl()}/async',
+                                           data=self._tap_params())
+            self._raise_for_status(response)
+            job_url = str(response.url)
+            self._job_url = job_url
+            job = await self._parse_job(response)
+
+        with timed(TAP_RUN):
+            response = await self._request('POST', f'{job_url}/phase', data={'PHASE': 'RUN'})
+            self._raise_for_status(response)
+            await self._read_body(response)
+
+        with timed(TAP_WAIT):
+            job = await self._wait(job_url, job)
+        record_uws_times(job)
+
+        with timed(TAP_RAISE_IF_ERROR):
+            if job.phase in {"ERROR", "ABORTED"}:
+                raise DALQueryError("Query Error", job.phase, job_url)
+
+        with timed(TAP_FETCH_RESPONSE):
+            response = await self._request('GET', _result_uri(job_url, job))
+            self._raise_for_status(response)
+
+        return response
+
+    async def stream_response_async(self, response):
+        """
+        Read the response body without blocking the event loop, saving it
+        to a file only if the results are to be saved.
+        """
+        with timed(STREAM_TO_FILE):
+            meta = VOTableMetaExtractor()
+            digest = self._new_digest()
+            fd = None
+            if self._save_results:
+                os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+                fd = open(self._filename, 'wb+')
+            try:
+                while True:
+                    with timed(TRANSFER):
+                        chunk = await response.content.read(_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self._deadline.check()
+                    if fd is not None:
+                        fd.write(chunk)
+                    meta.feed(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+            finally:
+                if fd is not None:
+                    fd.close()
+            meta.close()
+            self._finish_stream(meta, digest)
+
+    async def _wait(self, job_url, job, async_request_timeout=30, async_total_timeout=120):
+        """
+        The same polling as `~servicemon.pyvo_wrappers.AsyncTAPSM.wait`, but
+        sleeping without blocking the event loop.
+        """
+        phases = {"COMPLETED", "ABORTED", "ERROR"}
+        active_phases = {
+            "QUEUED", "EXECUTING", "RUN", "COMPLETED", "ERROR", "UNKNOWN"}
+        interval = 1.0
+        increment = 1.2
+
+        supports_wait_for_statechange = (LooseVersion(job.version) >= LooseVersion("1.1"))
+        if supports_wait_for_statechange:
+            timeout = async_total_timeout
+        else:
+            timeout = async_request_timeout
+        start_time = time.time()
+        while True:
+            if supports_wait_for_statechange:
+                response = await self._request('GET', job_url, params={'WAIT': str(timeout)},
+                                               timeout=aiohttp.ClientTimeout(total=timeout + 5))
+            else:
+                response = await self._request('GET', job_url,
+                                               timeout=aiohttp.ClientTimeout(total=timeout))
+            self._raise_for_status(response, job_url)
+            job = await self._parse_job(response)
+
+            elapsed = time.time() - start_time
+
+            if job.phase not in active_phases:
+                raise DALServiceError(
+                    "Cannot wait for job completion. Job is not active!")
+
+            if job.phase in phases:
+                break
+
+            if elapsed > async_total_timeout:
+                raise QueryTimeout(
+                    f'Async TAP job timed out, exceeding {async_total_timeout}s.')
+
+            # fallback for uws 1.0
+            if not supports_wait_for_statechange:
+                await asyncio.sleep(_sleep_time(interval))
+                interval = min(120, interval * increment)
+
+        return job
+
+    async def _request(self, method, url, **kwargs):
+        params = kwargs.get('params')
+        if params is not None:
+            kwargs['params'] = {k: str(v) for k, v in params.items()}
+        timeout = self._client_timeout(kwargs.get('timeout'))
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        return await self._client.request(method, url, **kwargs)
+
+    def _client_timeout(self, timeout):
+        """
+        The ClientTimeout for a request made with the given one, if any, limited
+        by the query's deadline.  The total also covers reading the response.
+        """
+        deadline = self._deadline
+        remaining = deadline.check()
+        if timeout is not None:
+            total = timeout.total
+            if remaining is not None:
+                total = remaining if total is None else min(total, remaining)
+            return aiohttp.ClientTimeout(total=total, sock_connect=timeout.sock_connect,
+                                         sock_read=timeout.sock_read)
+        if deadline.connect is None and deadline.read is None and remaining is None:
+            return None
+        return aiohttp.ClientTimeout(total=remaining, sock_connect=deadline.connect,
+                                     sock_read=deadline.read)
+
+    async def _read_body(self, response):
+        with timed(TRANSFER):
+            return await response.read()
+
+    async def _parse_job(self, response):
+        body = await self._read_body(response)
+        return uws.parse_job(io.BytesIO(body).read)
+
+    def _raise_for_status(self, response, url=None):
+        try:
+            response.raise_for_status()
+        except aiohttp.ClientResponseError as ex:
+            response.release()
+            raise DALServiceError(str(ex), ex.status, url=url or str(response.url))
+
+    def _tap_baseurl(self):
+        return self._access_url.rstrip('?')
+
+    def _tap_params(self):
+        return {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'QUERY': self._adql}
+
+    def _status_of(self, response):
+        return response.status
+
+
+def _result_uri(job_url, job):
+    """
+    The result URI of a completed job, chosen as pyvo's AsyncTAPJob.result_uri does.
+    """
+    result = None
+    for r in job.results:
+        if r.href and r.href.endswith("results/result"):
+            result = r
+            break
+    else:
+        for r in job.results:
+            if r.href and r.href.strip() and r.id_ == 'result':
+                result = r
+                break
+    if result is None:
+        raise DALServiceError('No result found for job', url=job_url)
+    uri = result.href
+    if not urlparse(uri).netloc:
+        uri = urljoin(job_url, uri)
+    return uri
+
+
+def _trace_config():
+    """
+    Record the connection phases of each request into the current QueryTimings.
+    """
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, ctx, params):
+        ctx.request_start = time.perf_counter()
+        ctx.connected = None
+
+    async def on_dns_resolvehost_start(session, ctx, params):
+        ctx.dns_start = time.perf_counter()
+
+    async def on_dns_resolvehost_end(session, ctx, params):
+        ctx.dns_dur = time.perf_counter() - ctx.dns_start
+        record_duration(DNS, ctx.dns_dur)
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.connect_start = time.perf_counter()
+        ctx.dns_dur = 0.0
+
+    async def on_connection_create_end(session, ctx, params):
+        ctx.connected = time.perf_counter()
+        record_duration(CONNECT, ctx.connected - ctx.connect_start - ctx.dns_dur)
+
+    async def on_request_end(session, ctx, params):
+        # From when the request could be sent until the headers were read.
+        sent = ctx.connected if ctx.connected is not None else ctx.request_start
+        record_duration(TTFB, time.perf_counter() - sent)
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+class AsyncEngine():
+    """
+    Runs a QueryRunner's tasks as AsyncQuery coroutines in one event loop,
+    with the runner's --workers as the number of queries in flight and its
+    --per_host_limit and rate limits applied.
+    """
+
+    def __init__(self, runner):
+        if aiohttp is None:
+            raise ImportError('The asyncio engine requires the aiohttp package.  '
+                              'Install it with "pip install servicemon[async]".')
+        self._runner = runner
+
+    def run(self, tasks):
+        asyncio.run(self._run(tasks))
+
+    async def _run(self, tasks):
+        runner = self._runner
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=runner._session_pool.pool_size,
+                                         force_close=runner._session_pool.cold)
+        async with aiohttp.ClientSession(
+                connector=connector,
+                headers={'User-Agent': runner._agent},
+                timeout=aiohttp.ClientTimeout(total=None),
+                trace_configs=[_trace_config()]) as session:
+            if runner._arrival != 'closed':
+                await self._run_open_loop(session, tasks)
+                return
+
+            scheduler = runner._new_scheduler(tasks)
+            in_flight = {}
+
+            def start(task):
+                in_flight[asyncio.create_task(self._run_query(session, *task))] = task
+
+            for delay in scheduler.schedule(start, in_flight, runner._workers):
+                if not in_flight:
+                    await asyncio.sleep(delay)
+                    continue
+
+                done, _ = await asyncio.wait(in_flight, timeout=delay,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    task = in_flight.pop(future)
+                    scheduler.task_done(task)
+                    runner._finish_task(task, future.result())
+
+    async def _run_open_loop(self, session, tasks):
+        """
+        Start each task at its scheduled time, with no more than --workers in flight.
+        """
+        runner = self._runner
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(runner._workers)
+
+        async def run_when_free(task, intended_start_time):
+            async with slots:
+                return await self._run_query(session, *task,
+                                             intended_start_time=intended_start_time)
+
+        in_flight = {}
+        for task, intended_start_time, due in runner._arrival_schedule(tasks):
+            # Write the stats of finished tasks while waiting.
+            while True:
+                delay = due - time.monotonic()
+                if delay <= 0:
+                    break
+                if in_flight:
+                    done, _ = await asyncio.wait(in_flight, timeout=delay,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        runner._finish_task(in_flight.pop(future), future.result())
+                else:
+                    await asyncio.sleep(delay)
+
+            in_flight[loop.create_task(run_when_free(task, intended_start_time))] = task
+
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                runner._finish_task(in_flight.pop(future), future.result())
+
+    async def _run_query(self, session, index, cone, service, **kwargs):
+        runner = self._runner
+        if not runner._circuit_allows(service):
+            return runner._skipped_query(cone, service, **kwargs)
+
+        query = None
+        try:
+            query = runner._create_query(cone, service, query_class=AsyncQuery,
+                                         client_session=session, **kwargs)
+            await query.run_async()
+        except Exception as e:
+            runner._handle_query_exc(query, cone, service, e)
+        runner._circuit_record(service, query)
+        return query
@@ -1,8 +1,14 @@
 import os
 import json
+import queue
+import time
+import uuid
 import socket
+import logging
 import requests
 import datetime
+import threading
+from pathlib import Path
 
 from ec2_metadata import ec2_metadata
 
@@ -11,18 +17,68 @@ from servicemon.plugin_support import AbstractResultWriter
 
 class AWSResultWriter(AbstractResultWriter, plugin_name='aws_writer',
                       description='Sends results to a central SQLite database.'):
+    """
+    Sends the results to the central database from a background thread, so
+    that the queries never wait for it.
+
+    Writer kwargs:
+
+    admin_url, results_url
+        The URLs of the admin and results CGIs.
+    batch_size
+        Most rows sent in one POST (default 1).  A single row is sent as a
+        JSON object, as it always was; more are sent as a JSON list of them,
+        so only raise it for a server that accepts lists.
+    batch_seconds
+        Seconds to wait for more rows to fill a batch (default 2).
+    retries, backoff, max_backoff
+        A failed POST is tried up to retries more times (default 5), waiting
+        backoff seconds (default 1) before the first retry and doubling the
+        wait, up to max_backoff seconds (default 60), for each one after.
+        A POST fails on an HTTP error status, or a response body with a line
+        that starts with error_marker.
+    error_marker, success_marker
+        How the CGI reports the outcome in a response body: a line starting
+        with error_marker, ignoring case, is a failure (default 'error').  If
+        success_marker is given, a body that does not contain it is a failure
+        too (default None).
+    spool
+        File to which the rows that could not be sent are appended, one JSON
+        object per line (default aws_writer.spool in the result directory).
+        They are sent again first at the next begin.  The count of those sent
+        is kept next to the spool, and advanced before they are posted, so a
+        run that does not reach its end does not post them twice.
+    timeout
+        Timeout in seconds for each POST (default 30).
+    """
+
+    _default_admin_url = 'http://vmnavo01.ipac.caltech.edu/cgi-bin/NAVOMonitor/nph-admin'
+    _default_results_url = 'http://vmnavo01.ipac.caltech.edu/cgi-bin/NAVOMonitor/nph-submit'
 
     # BEGIN gathers info and sends a 'begin' state message
-    # to the admin database
+    # to the admin database, then starts the sender with any
+    # rows spooled by an earlier run
 
-    def begin(self, args, outfile=None):
+    def begin(self, args, outfile=None, admin_url=None, results_url=None, batch_size=1,
+              batch_seconds=2.0, retries=5, backoff=1.0, max_backoff=60.0, spool=None, timeout=30.0,
+              error_marker='error', success_marker=None):
 
         self._pid = os.getpid()
 
         self._starttime = str(datetime.datetime.now())
 
-        self._adminURL = 'http://vmnavo01.ipac.caltech.edu/cgi-bin/NAVOMonitor/nph-admin'
-        self._resultsURL = 'http://vmnavo01.ipac.caltech.edu/cgi-bin/NAVOMonitor/nph-submit'
+        self._adminURL = admin_url or self._default_admin_url
+        self._resultsURL = results_url or self._default_results_url
+
+        self._batch_size = max(1, int(batch_size))
+        self._batch_seconds = float(batch_seconds)
+        self._retries = int(retries)
+        self._backoff = float(backoff)
+        self._max_backoff = float(max_backoff)
+        self._timeout = float(timeout)
+        self._error_marker = error_marker.lower()
+        self._success_marker = success_marker
+        self._spool_path = Path(spool) if spool is not None else Path(args.result_dir) / 'aws_writer.spool'
 
         try:
             self._region = ec2_metadata.region
@@ -43,20 +99,34 @@ class AWSResultWriter(AbstractResultWriter, plugin_name='aws_writer',
                 'region': self._region, 'instance_id': self._instance_id,
                 'starttime': self._starttime, 'endtime': ''}
 
-        jsonStr = json.dumps(data)
+        self._post_admin('START> ', data)
 
-        print("START> ", jsonStr)
+        self._session = requests.Session()
+        self._queue = queue.Queue()
+        self._closing = threading.Event()
+        self._spool_lock = threading.Lock()
+        self._replaying = self._spool_path.with_name(self._spool_path.name + '.replay')
+        self._replay_sent_path = self._replaying.with_name(self._replaying.name + '.sent')
+        for line in self._take_spool():
+            self._queue.put(line)
 
-        post_data = {'json': jsonStr}
+        self._sender = threading.Thread(target=self._send_loop, name='sm_aws_sender', daemon=True)
+        self._sender.start()
 
-        r = requests.post(url=self._adminURL, files=post_data)
+    # END sends the rows still queued, then sends an 'end' state
+    # message to the admin database, potentially triggering
+    # shutdown/clean-up
 
-        print(r.text)
+    def end(self):
 
-    # END sends an 'end' state message to the admin database,
-    # potentially triggering shutdown/clean-up
+        self._closing.set()
+        self._queue.put(None)
+        self._sender.join()
+        self._session.close()
 
-    def end(self):
+        # The replayed rows have all been sent or spooled again.
+        self._replaying.unlink(missing_ok=True)
+        self._replay_sent_path.unlink(missing_ok=True)
 
         endtime = str(datetime.datetime.now())
 
@@ -64,18 +134,10 @@ class AWSResultWriter(AbstractResultWriter, plugin_name='aws_writer',
                 'region': self._region, 'instance_id': self._instance_id,
                 'starttime': self._starttime, 'endtime': endtime}
 
-        jsonStr = json.dumps(data)
-
-        print("END>   ", jsonStr)
-
-        post_data = {'json': jsonStr}
+        self._post_admin('END>   ', data)
 
-        r = requests.post(url=self._adminURL, files=post_data)
-
-        print(r.text)
-
-    # ONE_RESULT sends a data record (the results on a single query)
-    # to the results database
+    # ONE_RESULT queues a data record (the results on a single query)
+    # for the results database
 
     def one_result(self, stats):
 
@@ -83,16 +145,160 @@ class AWSResultWriter(AbstractResultWriter, plugin_name='aws_writer',
 
         self.ncols = len(fields)
 
-        row = stats.row_values()
+        row = dict(stats.row_values())
 
         row['location'] = self._location
 
         print('DATA> ' + str(row))
 
-        jsonStr = json.dumps(row)
+        self._queue.put(json.dumps(row))
+
+    def _post_admin(self, label, data):
+        jsonStr = json.dumps(data)
+
+        print(label, jsonStr)
 
         post_data = {'json': jsonStr}
 
-        r = requests.post(url=self._resultsURL, files=post_data)
+        try:
+            r = requests.post(url=self._adminURL, files=post_data, timeout=self._timeout)
+            print(r.text)
+        except requests.RequestException as e:
+            logging.warning(f'Unable to send {label.strip()} message to {self._adminURL}: {repr(e)}')
+
+    def _send_loop(self):
+        done = False
+        while not done:
+            batch = []
+            row = self._queue.get()
+            if row is None:
+                break
+            batch.append(row)
+
+            # Gather more rows for the batch, without waiting once closing.
+            deadline = None
+            while len(batch) < self._batch_size:
+                try:
+                    if self._closing.is_set():
+                        row = self._queue.get_nowait()
+                    else:
+                        if deadline is None:
+                            deadline = time.monotonic() + self._batch_seconds
+                        row = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if row is None:
+                    done = True
+                    break
+                batch.append(row)
+
+            self._send(batch)
+
+    def _send(self, batch):
+        """
+        POST the batch of JSON rows, retrying with backoff, or spool it if it
+        cannot be sent.
+        """
+        jsonStr = batch[0] if len(batch) == 1 else '[' + ','.join(batch) + ']'
+        post_data = {'json': jsonStr}
 
-        print(r.text)
+        # The replayed rows come first in the queue.  Count them as sent before
+        # posting, as if the post fails they are spooled again.
+        replayed = min(len(batch), self._replay_unsent)
+        if replayed:
+            self._replay_unsent -= replayed
+            self._mark_replay_sent(replayed)
+
+        delay = self._backoff
+        for attempt in range(self._retries + 1):
+            try:
+                r = self._session.post(url=self._resultsURL, files=post_data, timeout=self._timeout)
+                r.raise_for_status()
+                print(r.text)
+                error = self._reported_error(r.text)
+                if error is None:
+                    return
+            except requests.RequestException as e:
+                error = e
+            # Once closing, spool rather than hold up the end of the run.
+            if attempt == self._retries or self._closing.wait(delay):
+                break
+            delay = min(self._max_backoff, delay * 2)
+
+        logging.warning(f'Unable to send {len(batch)} results to {self._resultsURL}, '
+                        f'spooling them to {self._spool_path}: {repr(error)}')
+        self._spool(batch)
+
+    def _reported_error(self, text):
+        """
+        The error reported in the body of a response, or None if it reports success.
+        """
+        for line in text.splitlines():
+            if line.strip().lower().startswith(self._error_marker):
+                return RuntimeError(f'Server reported: {line.strip()[:200]}')
+        if self._success_marker is not None and self._success_marker not in text:
+            return RuntimeError(f'Server did not report success: {text.strip()[:200]}')
+        return None
+
+    def _spool(self, batch):
+        with self._spool_lock:
+            self._spool_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self._spool_path, 'a') as f:
+                for row in batch:
+                    f.write(row + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _take_spool(self):
+        """
+        Move the spooled rows aside to be sent again, returning them.  Rows left
+        aside by a run that did not reach its end are taken too, unless it had
+        already sent them.
+
+        The rows set aside follow a line naming them with a new token, which the
+        count of them sent is kept with, so that a count is never applied to
+        other rows.
+        """
+        lines = self._unsent_replay()
+        if self._spool_path.exists():
+            lines.extend(self._spool_path.read_text().splitlines())
+        lines = [line for line in lines if line.strip()]
+
+        self._replay_token = uuid.uuid4().hex
+        self._replay_sent = 0
+        self._replay_unsent = len(lines)
+        if lines:
+            self._replaying.parent.mkdir(parents=True, exist_ok=True)
+            self._replace(self._replaying, ''.join([f'#{self._replay_token}\n'] + [line + '\n' for line in lines]))
+        else:
+            self._replaying.unlink(missing_ok=True)
+        self._replay_sent_path.unlink(missing_ok=True)
+        self._spool_path.unlink(missing_ok=True)
+        return lines
+
+    def _unsent_replay(self):
+        if not self._replaying.exists():
+            return []
+        lines = self._replaying.read_text().splitlines()
+        if not lines or not lines[0].startswith('#'):
+            return lines
+        token, lines = lines[0][1:], lines[1:]
+        if self._replay_sent_path.exists():
+            sent_token, _, count = self._replay_sent_path.read_text().partition(' ')
+            if sent_token == token:
+                lines = lines[int(count):]
+        return lines
+
+    def _mark_replay_sent(self, count):
+        self._replay_sent += count
+        self._replace(self._replay_sent_path, f'{self._replay_token} {self._replay_sent}')
+
+    @staticmethod
+    def _replace(path, text):
+        # Replace the file whole, so that a crash leaves either the old or the new text.
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
@@ -1,60 +1,152 @@
 import csv
 import os
 import sys
-from pathlib import Path
-from datetime import datetime
+import time
+import signal
+import logging
+import threading
 
 from servicemon.plugin_support import AbstractResultWriter
 
 
 class CsvResultWriter(AbstractResultWriter, plugin_name='csv_writer',
                       description='Writes results to a csv file.'):
+    """
+    Keeps the output file and its csv writer open from begin to end.
 
-    def begin(self, args, outfile=None):
+    Writer kwargs, besides outfile:
+
+    buffering
+        Size in bytes of the file's write buffer (default 65536).
+    flush_interval
+        Seconds between flushes of the buffer to the file, checked as each row is
+        written.  0 flushes after every row (default 1).
+    fsync_interval
+        Seconds between fsyncs of the file to disk, checked at the flushes.  By
+        default the file is only fsynced at the end.
+
+    The buffer is also flushed and fsynced on SIGTERM, before the signal goes on
+    to the handler that was there before.  The rows may be written from another
+    thread than the one handling the signal, so the writes and flushes hold a
+    lock.
+
+    The columns are those of the first row.  A later row with columns that the
+    first did not have raises ValueError, rather than losing them.
+    """
+
+    # How long the SIGTERM handler waits for a row being written by another thread.
+    _sigterm_lock_timeout = 5.0
+
+    def begin(self, args, outfile=None, buffering=65536, flush_interval=1.0, fsync_interval=None):
         self._first_stat = True
         self._outfile_path = self._compute_outfile_path(args, outfile=outfile)
+        self._buffering = int(buffering)
+        self._flush_interval = float(flush_interval)
+        self._fsync_interval = None if fsync_interval in (None, 'None') else float(fsync_interval)
+        self._file = None
+        self._writer = None
+        self._next_flush = None
+        self._next_fsync = None
+        self._prev_sigterm = None
+        self._sigterm_installed = False
+        self._lock = threading.RLock()
 
         # Create the output dir if needed.
         if self._outfile_path is not None:
             os.makedirs(self._outfile_path.parent, exist_ok=True)
 
+        self._install_sigterm_handler()
+
     def end(self):
-        pass
+        self._restore_sigterm_handler()
+        with self._lock:
+            if self._file is not None:
+                self._flush(fsync=True)
+                if self._file is not sys.stdout:
+                    self._file.close()
+                self._file = None
+                self._writer = None
 
     def one_result(self, stats):
+        with self._lock:
+            if self._writer is None:
+                self._open(stats)
+            self._writer.writerow(stats.row_values())
+
+            now = time.monotonic()
+            if now >= self._next_flush:
+                self._flush(fsync=self._next_fsync is not None and now >= self._next_fsync)
 
+    def _open(self, stats):
         if self._outfile_path is not None:
-            with open(self._outfile_path, 'a+') as file:
-                self._output_stats_row_to_file(stats, file)
+            self._file = open(self._outfile_path, 'a+', newline='', buffering=self._buffering)
         else:
-            self._output_stats_row_to_file(stats, sys.stdout)
-
-    def _output_stats_row_to_file(self, stats, file):
-        writer = csv.DictWriter(file, dialect='excel',
-                                fieldnames=stats.columns())
+            self._file = sys.stdout
+        # The columns are those of the first row; later rows with others raise ValueError.
+        self._writer = csv.DictWriter(self._file, dialect='excel', fieldnames=stats.columns(),
+                                      extrasaction='raise')
         if self._first_stat:
             self._first_stat = False
-            writer.writeheader()
-        row_values = stats.row_values()
-        writer.writerow(row_values)
+            self._writer.writeheader()
+        now = time.monotonic()
+        self._next_flush = now + self._flush_interval
+        if self._fsync_interval is not None and self._file is not sys.stdout:
+            self._next_fsync = now + self._fsync_interval
 
-    def _compute_outfile_path(self, args, outfile=None):
-        """
-        If outfile is not None, use it.  Otherwise compute the output file
-        name from name of the services file supplied in the args provided.
-        """
-        result_path = None
-        if outfile is not None:
-            # Leaving result_path None will cause output to go to stdout.
-            if outfile != 'stdout':
-                result_path = Path(outfile)
-        else:
-            now = datetime.now()
-            dtstr = now.strftime('%Y-%m-%d %H:%M:%S.%f')
+    def _flush(self, fsync=False):
+        self._file.flush()
+        now = time.monotonic()
+        self._next_flush = now + self._flush_interval
+        if fsync and self._file is not sys.stdout:
+            os.fsync(self._file.fileno())
+            if self._next_fsync is not None:
+                self._next_fsync = now + self._fsync_interval
 
-            base_services_name = Path(args.services).stem
-            result_name = f'{base_services_name}_{dtstr}.csv'
+    def _install_sigterm_handler(self):
+        try:
+            self._prev_sigterm = signal.signal(signal.SIGTERM, self._on_sigterm)
+            self._sigterm_installed = True
+        except ValueError:
+            # Signal handlers can only be set from the main thread.
+            pass
 
-            result_path = Path(args.result_dir) / Path(result_name)
+    def _restore_sigterm_handler(self):
+        if not self._sigterm_installed:
+            return
+        self._sigterm_installed = False
+        try:
+            # Leave alone any handler set since, which may chain to this one.
+            if signal.getsignal(signal.SIGTERM) == self._on_sigterm and self._prev_sigterm is not None:
+                signal.signal(signal.SIGTERM, self._prev_sigterm)
+        except ValueError:
+            pass
+
+    def _on_sigterm(self, signum, frame):
+        # The lock is reentrant, as the signal may have interrupted a write in this thread.
+        if self._lock.acquire(timeout=self._sigterm_lock_timeout):
+            try:
+                if self._file is not None:
+                    self._flush(fsync=True)
+            except Exception as e:
+                # The signal may have arrived in the middle of a write.
+                logging.warning(f'Unable to flush {self._outfile_path} on SIGTERM: {repr(e)}')
+            finally:
+                self._lock.release()
+        else:
+            logging.warning(f'Unable to flush {self._outfile_path} on SIGTERM: a row is still being written')
 
-        return result_path
+        prev = self._prev_sigterm
+        if callable(prev):
+            prev(signum, frame)
+        elif prev == signal.SIG_DFL:
+            self._restore_sigterm_handler()
+            signal.raise_signal(signum)
+
+    def _compute_outfile_path(self, args, outfile=None):
+        """
+        As for other writers, except that an outfile of stdout gives None.
+        """
+        # Leaving the path None will cause output to go to stdout.
+        if outfile == 'stdout':
+            return None
+        return super()._compute_outfile_path(args, outfile=outfile, suffix='.csv')
@@ -0,0 +1,84 @@
+from servicemon.plugin_support import AbstractResultWriter
+from servicemon.query_stats import column_kind, column_converter
+
+
+class ParquetResultWriter(AbstractResultWriter, plugin_name='parquet_writer',
+                          description='Writes results to a Parquet file.'):
+    """
+    Writes the results to a Parquet file with typed columns, as described by
+    `~servicemon.query_stats.column_kind`: float durations, timestamps,
+    categorical base_name, service_type and duration names, and int counts.
+    Rows are buffered and written row_group rows at a time.
+
+    This writer requires the optional pyarrow package.
+    """
+
+    def begin(self, args, outfile=None, row_group=5000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('The parquet_writer plugin requires the pyarrow package.')
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+
+        self._outfile_path = self._compute_outfile_path(args, outfile=outfile, suffix='.parquet')
+        self._row_group = max(1, int(row_group))
+        self._columns = None
+        self._converters = None
+        self._buffer = None
+        self._num_buffered = 0
+        self._schema = None
+        self._writer = None
+
+        self._outfile_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def end(self):
+        if self._num_buffered:
+            self._write_row_group()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def one_result(self, stats):
+        if self._columns is None:
+            self._start(stats.columns())
+
+        row = stats.row_values()
+        for col, convert, values in zip(self._columns, self._converters, self._buffer):
+            values.append(convert(row.get(col)))
+        self._num_buffered += 1
+        if self._num_buffered >= self._row_group:
+            self._write_row_group()
+
+    def _start(self, columns):
+        pa = self._pa
+        types = {
+            'timestamp': pa.timestamp('us'),
+            'float': pa.float64(),
+            'int': pa.int64(),
+            'category': pa.dictionary(pa.int32(), pa.string()),
+            'string': pa.string(),
+        }
+        kinds = [column_kind(col) for col in columns]
+        self._columns = list(columns)
+        self._converters = [column_converter(kind) for kind in kinds]
+        self._schema = pa.schema([pa.field(col, types[kind]) for col, kind in zip(columns, kinds)])
+        self._buffer = [[] for _ in columns]
+
+    def _write_row_group(self):
+        pa = self._pa
+        arrays = []
+        for field, values in zip(self._schema, self._buffer):
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, type=field.type))
+        table = pa.Table.from_arrays(arrays, schema=self._schema)
+
+        if self._writer is None:
+            self._writer = self._pq.ParquetWriter(str(self._outfile_path), self._schema)
+        self._writer.write_table(table, row_group_size=self._num_buffered)
+
+        self._buffer = [[] for _ in self._columns]
+        self._num_buffered = 0
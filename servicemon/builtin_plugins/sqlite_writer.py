@@ -0,0 +1,126 @@
+import time
+import sqlite3
+import threading
+
+from servicemon.plugin_support import AbstractResultWriter
+from servicemon.query_stats import column_kind, column_converter
+
+
+class SqliteResultWriter(AbstractResultWriter, plugin_name='sqlite_writer',
+                         description='Writes results to a local SQLite database.'):
+    """
+    Writes the results to a table of an SQLite database, which is created with
+    the columns of the first row if it does not exist yet.  Columns missing from
+    an existing table are added, so one database can collect many runs.
+
+    The database runs in WAL mode, so it can be queried while results are being
+    written.  Rows are committed in batches, when batch_rows rows are waiting or
+    batch_seconds seconds have passed since the last commit, whichever is first.
+    A background thread commits rows that have waited batch_seconds, so they
+    are not held back when no more rows arrive.
+    The table is indexed on (base_name, service_type, start_time).
+    """
+
+    _sql_types = {
+        'timestamp': 'TEXT',
+        'float': 'REAL',
+        'int': 'INTEGER',
+        'category': 'TEXT',
+        'string': 'TEXT',
+    }
+
+    def begin(self, args, outfile=None, table='results', batch_rows=1000, batch_seconds=5.0):
+        self._outfile_path = self._compute_outfile_path(args, outfile=outfile, suffix='.sqlite')
+        self._table = table
+        self._batch_rows = max(1, int(batch_rows))
+        self._batch_seconds = float(batch_seconds)
+        self._columns = None
+        self._converters = None
+        self._insert = None
+        self._pending = []
+        self._last_commit = time.monotonic()
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._committer = None
+
+        self._outfile_path.parent.mkdir(parents=True, exist_ok=True)
+        # The rows may be written from a thread other than the one calling begin.
+        self._conn = sqlite3.connect(str(self._outfile_path), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+
+        if self._batch_seconds > 0:
+            self._committer = threading.Thread(target=self._commit_loop, name='sm_sqlite_commit',
+                                               daemon=True)
+            self._committer.start()
+
+    def end(self):
+        if self._conn is None:
+            return
+        self._closing.set()
+        if self._committer is not None:
+            self._committer.join()
+        with self._lock:
+            self._commit()
+            self._conn.close()
+            self._conn = None
+
+    def one_result(self, stats):
+        with self._lock:
+            if self._columns is None:
+                self._create_table(stats.columns())
+
+            row = stats.row_values()
+            self._pending.append([convert(row.get(col))
+                                  for col, convert in zip(self._columns, self._converters)])
+            if (len(self._pending) >= self._batch_rows or
+                    time.monotonic() - self._last_commit >= self._batch_seconds):
+                self._commit()
+
+    def _commit_loop(self):
+        """
+        Commit the waiting rows once batch_seconds have passed since the last
+        commit, until the writer ends.
+        """
+        delay = self._batch_seconds
+        while not self._closing.wait(delay):
+            with self._lock:
+                delay = self._last_commit + self._batch_seconds - time.monotonic()
+                if delay <= 0:
+                    self._commit()
+                    delay = self._batch_seconds
+
+    def _create_table(self, columns):
+        kinds = [column_kind(col) for col in columns]
+        self._columns = list(columns)
+        # Times are stored as the sortable text of the stats.
+        self._converters = [column_converter('string' if kind == 'timestamp' else kind)
+                            for kind in kinds]
+
+        table = _quote(self._table)
+        with self._conn:
+            self._conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} (' +
+                ', '.join(f'{_quote(col)} {self._sql_types[kind]}' for col, kind in zip(columns, kinds)) +
+                ')')
+            existing = {info[1] for info in self._conn.execute(f'PRAGMA table_info({table})')}
+            for col, kind in zip(columns, kinds):
+                if col not in existing:
+                    self._conn.execute(f'ALTER TABLE {table} ADD COLUMN {_quote(col)} {self._sql_types[kind]}')
+            self._conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {_quote(self._table + "_service_time")} '
+                f'ON {table} (base_name, service_type, start_time)')
+
+        self._insert = (f'INSERT INTO {table} (' + ', '.join(_quote(col) for col in columns) +
+                        ') VALUES (' + ', '.join('?' * len(columns)) + ')')
+
+    def _commit(self):
+        if self._pending:
+            with self._conn:
+                self._conn.executemany(self._insert, self._pending)
+            self._pending = []
+        self._last_commit = time.monotonic()
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
@@ -0,0 +1,90 @@
+"""
+Per-service circuit breakers, so that a service that is down is not queried
+for every cone while it stays down.
+"""
+import threading
+import time
+
+__all__ = ['CircuitBreaker']
+
+
+class CircuitBreaker():
+    """
+    Tracks the consecutive failures of each service.  After threshold of them
+    in a row, the service's circuit opens and its queries are skipped.  Once
+    the backoff has passed, one probe query is let through: if it succeeds,
+    the circuit closes again; if it fails, the circuit reopens with the
+    backoff doubled, up to max_backoff.
+
+    Parameters
+    ----------
+    threshold : int
+        Consecutive failures that open a circuit.
+    backoff : float
+        Seconds a circuit stays open after it first opens.
+    max_backoff : float
+        Upper limit on the seconds a circuit stays open.
+    clock : callable
+        Returns the current time in seconds.
+    """
+
+    def __init__(self, threshold, backoff=30.0, max_backoff=1800.0, clock=time.monotonic):
+        if threshold < 1:
+            raise ValueError(f'Threshold must be at least 1: {threshold}')
+        self._threshold = threshold
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._circuits = {}
+
+    def allow(self, key):
+        """
+        Returns True if a query of the service identified by key may run now.
+        """
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None or circuit.open_until is None:
+                return True
+            if circuit.probing or self._clock() < circuit.open_until:
+                return False
+            circuit.probing = True
+            return True
+
+    def record(self, key, ok):
+        """
+        Record whether a query of the service identified by key succeeded.
+        """
+        with self._lock:
+            circuit = self._circuits.setdefault(key, _Circuit())
+            if ok:
+                circuit.reset()
+            elif circuit.probing:
+                circuit.probing = False
+                self._open(circuit)
+            elif circuit.open_until is None:
+                circuit.failures += 1
+                if circuit.failures >= self._threshold:
+                    self._open(circuit)
+            # Otherwise it is a query that started before the circuit opened.
+
+    def is_open(self, key):
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit is not None and circuit.open_until is not None
+
+    def _open(self, circuit):
+        delay = min(self._max_backoff, self._backoff * 2 ** circuit.trips)
+        circuit.trips += 1
+        circuit.open_until = self._clock() + delay
+
+
+class _Circuit():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.failures = 0
+        self.trips = 0
+        self.open_until = None
+        self.probing = False
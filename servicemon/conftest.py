@@ -5,8 +5,12 @@
 
 import os
 
+import pytest
 from astropy.version import version as astropy_version
 
+from servicemon.query_runner import QueryRunner, _parse_query
+from servicemon.uws_poller import UwsPoller
+
 # For Astropy 3.0 and later, we can use the standalone pytest plugin
 if astropy_version < '3.0':
     from astropy.tests.pytest_plugins import *  # noqa
@@ -35,6 +39,59 @@ def pytest_configure(config):
         packagename = os.path.basename(os.path.dirname(__file__))
         TESTED_VERSIONS[packagename] = __version__
 
+
+class FakeClock():
+    """
+    A clock for the time-based classes, which only moves when now is set.
+    """
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def fast_polls(monkeypatch):
+    monkeypatch.setattr(UwsPoller, '_first_interval', 0.01)
+
+
+def durations(row):
+    """
+    Return a dict of the named durations in the extra_dur columns of a result row.
+    """
+    result = {}
+    for i in range(16):
+        name = row.get(f'extra_dur{i}_name')
+        if name is not None:
+            result[name] = row[f'extra_dur{i}_value']
+    return result
+
+
+def run_rows(server, kinds, num_cones, *extra_args):
+    """
+    Run queries with the given sm_query arguments over num_cones cones to the
+    LocalCone and LocalTap services of a LocalServer, in the order given by
+    kinds ('cone' or 'tap'), and return the result rows.
+    """
+    services = {
+        'cone': {'base_name': 'LocalCone', 'service_type': 'cone',
+                 'access_url': server.url('/cone'), 'adql': ''},
+        'tap': {'base_name': 'LocalTap', 'service_type': 'tap', 'access_url': server.url('/tap'),
+                'adql': 'select * from t where contains(point(ra, dec), circle({}, {}, {})) = 1'},
+    }
+    args = _parse_query(['fake_services_file', '--cone_file', 'my_cones.py', *extra_args])
+    args.services = [services[kind] for kind in kinds]
+    args.cone_file = [{'ra': 10.0 + i, 'dec': 20.0, 'radius': 0.1} for i in range(num_cones)]
+    args.writers = []
+    qr = QueryRunner(args)
+
+    rows = []
+    qr._collect_stats = lambda stats: rows.append(stats.row_values())
+    qr.run()
+    return rows
+
+
 # Uncomment the last two lines in this block to treat all DeprecationWarnings as
 # exceptions. For Astropy v2.0 or later, there are 2 additional keywords,
 # as follow (although default should work for most cases).
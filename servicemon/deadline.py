@@ -0,0 +1,192 @@
+"""
+Per-query deadlines: limits on connecting, on each read and on the whole query.
+
+A Deadline is made current with `Deadline.activate` for the duration of a
+query, like a `~servicemon.query_timing.QueryTimings`.  The HTTP requests
+made while it is current, including those made by pyvo, get timeouts no
+longer than the time remaining, and fail with `QueryTimeout` once it has
+passed.  When the total limit is reached, the sockets of the query's
+responses are shut down, so a read that is blocked, or that is being fed a
+byte at a time, is cut short.
+"""
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import requests
+import urllib3
+
+__all__ = ['Deadline', 'QueryTimeout', 'current_deadline', 'is_timeout']
+
+_current_deadline = ContextVar('servicemon_query_deadline', default=None)
+
+
+class QueryTimeout(TimeoutError):
+    """
+    A query ran out of time.
+    """
+
+
+class Deadline():
+    """
+    Time limits for one query, in seconds.  A limit of None is no limit.
+
+    Parameters
+    ----------
+    connect : float or None
+        Limit on making each connection.
+    read : float or None
+        Limit on each wait for data from the server, for requests that do not
+        set their own timeout.
+    total : float or None
+        Limit on the whole query, from when it is activated.
+    clock : callable
+        Returns the current time in seconds.
+    """
+
+    def __init__(self, connect=None, read=None, total=None, clock=time.monotonic):
+        self._connect = connect
+        self._read = read
+        self._total = total
+        self._clock = clock
+        self._expires = None
+        self._expired = False
+        self._lock = threading.Lock()
+        self._sockets = []
+
+    @property
+    def connect(self):
+        return self._connect
+
+    @property
+    def read(self):
+        return self._read
+
+    @property
+    def total(self):
+        return self._total
+
+    @property
+    def expired(self):
+        """
+        True if the total limit has been reached.
+        """
+        remaining = self.remaining()
+        return self._expired or (remaining is not None and remaining <= 0)
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this the current Deadline for the duration of the with block.  The
+        clock on the total limit starts the first time it is activated, so a
+        query run in several steps may activate it for each one.
+        """
+        timer = None
+        if self._total is not None:
+            if self._expires is None:
+                self._expires = self._clock() + self._total
+            timer = threading.Timer(max(0.0, self.remaining()), self._expire)
+            timer.daemon = True
+            timer.start()
+        token = _current_deadline.set(self)
+        try:
+            yield self
+        finally:
+            _current_deadline.reset(token)
+            if timer is not None:
+                timer.cancel()
+            with self._lock:
+                self._sockets.clear()
+
+    def watch(self, sock):
+        """
+        Shut down sock when the total limit is reached.
+        """
+        with self._lock:
+            if not self._expired:
+                self._sockets.append(sock)
+                return
+        _shutdown(sock)
+
+    def _expire(self):
+        with self._lock:
+            self._expired = True
+            sockets, self._sockets = self._sockets, []
+        for sock in sockets:
+            _shutdown(sock)
+
+    def remaining(self):
+        """
+        Seconds until the total limit is reached, or None if there is none.
+        """
+        if self._expires is None:
+            return None
+        return self._expires - self._clock()
+
+    def check(self):
+        """
+        Raise QueryTimeout if the total limit has been reached.
+        """
+        remaining = self.remaining()
+        if self._expired or (remaining is not None and remaining <= 0):
+            raise QueryTimeout(f'Query exceeded its total timeout of {self._total}s')
+        return remaining
+
+    def request_timeout(self, timeout=None):
+        """
+        The (connect, read) timeout for a request, given the timeout the request
+        was made with, if any, as for `requests`.  Each is limited to the time
+        remaining.
+
+        Raises
+        ------
+        QueryTimeout
+            If no time remains.
+        """
+        remaining = self.check()
+        if timeout is None:
+            connect, read = self._connect, self._read
+        elif isinstance(timeout, tuple):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        return (_min(connect, remaining), _min(read, remaining))
+
+
+def current_deadline():
+    """
+    Return the Deadline that is current in this context, or None.
+    """
+    return _current_deadline.get()
+
+
+def is_timeout(exc):
+    """
+    True if exc, or any exception it was raised from, is a timeout.
+    """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, (TimeoutError, socket.timeout, requests.Timeout,
+                            urllib3.exceptions.TimeoutError)):
+            return True
+        # pyvo keeps the underlying exception as the cause.
+        exc = getattr(exc, 'cause', None) or exc.__cause__ or exc.__context__
+    return False
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _min(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
@@ -0,0 +1,192 @@
+"""
+Deletion of finished async TAP jobs, selected with ``sm_query --delete_jobs``.
+
+Every async TAP query leaves a UWS job on the service, and deleting it as part
+of the query would add a DELETE round trip to the time of every query.  The
+`JobCleaner` instead deletes the jobs from a few background threads once their
+queries are done.  Each thread takes a batch of queued jobs at a time and
+deletes them one after another, grouped by host, so that the deletions reuse
+the connections of the session pool and never have more requests in flight
+than there are threads.
+
+The deletions are timed, as tap_delete, separately from the queries: they do
+not appear in the stats rows, but are written one per row to the cleaner's
+log file, if it has one, and summarized per service by `summary`.
+"""
+import collections
+import csv
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+
+import numpy as np
+from astropy.table import Table
+
+from .query_stats import TIME_FORMAT
+
+__all__ = ['JobCleaner', 'delete_job']
+
+
+def delete_job(session, job_url, timeout=None):
+    """
+    Delete the UWS job at job_url with session.
+
+    Raises
+    ------
+    requests.RequestException
+        If the request fails or the service returns an error status.
+    """
+    response = session.delete(job_url, allow_redirects=False, timeout=timeout)
+    try:
+        response.raise_for_status()
+    finally:
+        response.close()
+
+
+class JobCleaner():
+    """
+    Deletes UWS jobs in the background.
+
+    Parameters
+    ----------
+    session_pool : SessionPool
+        Gives the session for each job's host.
+    workers : int
+        Number of deleting threads, and so the most deletions in flight at once.
+    batch_size : int
+        Most jobs a thread takes from the queue at a time.
+    request_timeout : float
+        Timeout for each DELETE request.
+    log_path : str, `~pathlib.Path` or None
+        If not None, a csv file to which each deletion is written, with the
+        columns base_name, job_url, start_time, tap_delete and errmsg.  The
+        file is created at the first deletion.
+    """
+
+    _log_columns = ('base_name', 'job_url', 'start_time', 'tap_delete', 'errmsg')
+
+    def __init__(self, session_pool, workers=2, batch_size=20, request_timeout=30.0, log_path=None):
+        if workers < 1:
+            raise ValueError(f'Number of workers must be at least 1: {workers}')
+        self._session_pool = session_pool
+        self._nworkers = workers
+        self._batch_size = batch_size
+        self._request_timeout = request_timeout
+        self._cond = threading.Condition()
+        self._pending = collections.deque()
+        self._threads = []
+        self._closed = False
+        self._durations = collections.defaultdict(list)
+        self._failures = collections.Counter()
+        self._log_path = log_path
+        self._log_file = None
+        self._log_writer = None
+
+    def add(self, job_url, name=None):
+        """
+        Queue the job at job_url for deletion.  name identifies the job's
+        service in the `summary`.
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('The job cleaner is closed')
+            if not self._threads:
+                self._start_threads()
+            self._pending.append((job_url, name))
+            self._cond.notify()
+
+    def close(self):
+        """
+        Delete the jobs still queued, then stop the threads.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    def summary(self):
+        """
+        Summarize the deletions as a Table with one row per service name.
+
+        Returns
+        -------
+        `~astropy.table.Table`
+            With columns base_name, deleted, failed, and the mean, p50, p95 and
+            max of the tap_delete durations, in seconds.
+        """
+        with self._cond:
+            names = sorted(set(self._durations) | set(self._failures), key=str)
+            rows = []
+            for name in names:
+                durs = np.array(self._durations[name], dtype=float)
+                if len(durs):
+                    mean, (p50, p95), top = durs.mean(), np.percentile(durs, [50, 95]), durs.max()
+                else:
+                    mean = p50 = p95 = top = np.nan
+                rows.append((str(name), len(durs), self._failures[name], mean, p50, p95, top))
+
+        table = Table(rows=rows if rows else None,
+                      names=('base_name', 'deleted', 'failed', 'mean', 'p50', 'p95', 'max'),
+                      dtype=(str, int, int, float, float, float, float))
+        for col in ('mean', 'p50', 'p95', 'max'):
+            table[col].format = '.3f'
+        return table
+
+    def _start_threads(self):
+        for i in range(self._nworkers):
+            thread = threading.Thread(target=self._delete_loop, name=f'sm_job_delete{i}', daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _delete_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch = [self._pending.popleft()
+                         for _ in range(min(self._batch_size, len(self._pending)))]
+            batch.sort(key=lambda job: urlparse(job[0]).netloc)
+            for job_url, name in batch:
+                self._delete(job_url, name)
+
+    def _delete(self, job_url, name):
+        start_time = datetime.now().strftime(TIME_FORMAT)
+        start = time.perf_counter()
+        session = self._session_pool.get(job_url)
+        try:
+            delete_job(session, job_url, timeout=self._request_timeout)
+        except Exception as e:
+            logging.warning(f'Error deleting UWS job {job_url}: {repr(e)}')
+            with self._cond:
+                self._failures[name] += 1
+                self._log(name, job_url, start_time, None, repr(e))
+            return
+        finally:
+            self._session_pool.release(session)
+        duration = time.perf_counter() - start
+        with self._cond:
+            self._durations[name].append(duration)
+            self._log(name, job_url, start_time, duration, '')
+
+    def _log(self, name, job_url, start_time, duration, errmsg):
+        # Called with the lock held.
+        if self._log_path is None:
+            return
+        try:
+            if self._log_file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self._log_path)), exist_ok=True)
+                self._log_file = open(self._log_path, 'a', newline='')
+                self._log_writer = csv.writer(self._log_file)
+                self._log_writer.writerow(self._log_columns)
+            self._log_writer.writerow((name, job_url, start_time, duration, errmsg))
+        except OSError as e:
+            logging.warning(f'Unable to log the deletion of {job_url} to {self._log_path}: {repr(e)}')
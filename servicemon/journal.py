@@ -0,0 +1,93 @@
+"""
+A durable record of the queries completed by a run, so an interrupted run
+can be resumed with ``sm_query --journal journal_file --resume``.
+"""
+import os
+import threading
+
+__all__ = ['ProgressJournal', 'read_completed']
+
+
+class ProgressJournal():
+    """
+    An append-only journal of the (cone_index, service_key) pairs whose results
+    have been written.
+
+    Each pair is one line, ``cone_index<TAB>service_key``, which is flushed and
+    fsynced before `record` returns, so the journal survives the process (or its
+    host) being killed.  A partial last line left by such a kill is ignored, and
+    removed when the journal is next opened.  Records may be made from several
+    threads.
+
+    Parameters
+    ----------
+    path : str
+        The journal file.  It is created if needed, otherwise appended to.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._completed = read_completed(path)
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        _truncate_partial_line(path)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def completed(self):
+        return self._completed
+
+    def is_completed(self, cone_index, service_key):
+        return (cone_index, service_key) in self._completed
+
+    def record(self, cone_index, service_key):
+        """
+        Durably record that the query of service_key for cone_index is done.
+        """
+        with self._lock:
+            self._write(f'{cone_index}\t{service_key}\n')
+            self._completed.add((cone_index, service_key))
+
+    def close(self):
+        self._file.close()
+
+    def _write(self, text):
+        self._file.write(text)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+def read_completed(path):
+    """
+    Return the set of (cone_index, service_key) pairs recorded in the journal at
+    path, which is empty if there is no such file.
+    """
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break  # Partially written.
+            index, sep, service_key = line[:-1].partition('\t')
+            if sep and index.isdigit():
+                completed.add((int(index), service_key))
+    return completed
+
+
+def _truncate_partial_line(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
@@ -3,6 +3,7 @@ from importlib import import_module
 from abc import ABC, abstractmethod
 
 from pathlib import Path
+from datetime import datetime
 
 from servicemon import builtin_plugins
 
@@ -157,6 +158,19 @@ class AbstractResultWriter(SmPluginSupport):
     def end(self):
         pass
 
+    def _compute_outfile_path(self, args, outfile=None, suffix=''):
+        """
+        If outfile is not None, use it.  Otherwise compute the output file
+        name, ending in suffix, from name of the services file supplied in the
+        args provided.
+        """
+        if outfile is not None:
+            return Path(outfile)
+
+        dtstr = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+        base_services_name = Path(args.services).stem
+        return Path(args.result_dir) / f'{base_services_name}_{dtstr}{suffix}'
+
 
 class AbstractTimedQuery(SmPluginSupport):
 
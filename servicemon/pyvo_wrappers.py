@@ -4,7 +4,6 @@ from time import sleep
 from distutils.version import LooseVersion
 from functools import partial
 
-from codetiming import Timer
 from astropy.io.votable import parse as votableparse
 
 from pyvo.dal.tap import AsyncTAPJob, TAPService, TAPQuery, TAPResults
@@ -12,6 +11,8 @@ from pyvo.dal.exceptions import DALQueryError, DALServiceError
 from pyvo.utils.http import use_session
 from pyvo.io import uws
 
+from .deadline import QueryTimeout, current_deadline
+from .query_timing import timed, record_uws_times
 from .timing_labels import (TAP_SUBMIT, TAP_RUN, TAP_WAIT, TAP_RAISE_IF_ERROR,
                             TAP_FETCH_RESPONSE, TAP_DELETE)
 
@@ -75,7 +76,7 @@ class TAPServiceSM(TAPService):
 
     def run_async_timed(
             self, query, language="ADQL", maxrec=None, uploads=None,
-            streamable_response=False, delete=False, **keywords):
+            streamable_response=False, delete=False, poller=None, **keywords):
         """
         runs async query and returns its result
          Parameters
@@ -92,6 +93,8 @@ class TAPServiceSM(TAPService):
         streamable_response: bool
             If False (default) return TapResult, otherwise return
             a streamable response.
+        poller : UwsPoller
+            If not None, the shared poller that waits for the job.
          Returns
         -------
         TAPResult or requests.packages.urllib3.response.HTTPResponse
@@ -109,28 +112,52 @@ class TAPServiceSM(TAPService):
         --------
         AsyncTAPJob
         """
-        with Timer(TAP_SUBMIT, logger=None):
+        job = self.submit_async_timed(query, language=language, maxrec=maxrec,
+                                      uploads=uploads, **keywords)
+
+        with timed(TAP_WAIT):
+            job = job.wait(poller=poller)
+
+        return self.fetch_async_timed(job, streamable_response=streamable_response,
+                                      delete=delete)
+
+    def submit_async_timed(self, query, language="ADQL", maxrec=None, uploads=None,
+                           **keywords):
+        """
+        Create an async job and start it running, without waiting for it.
+
+        Returns
+        -------
+        AsyncTAPSM
+            the running job
+        """
+        with timed(TAP_SUBMIT):
             job = AsyncTAPSM.create(
                 self.baseurl, query, language, maxrec, uploads, self._session, **keywords)
 
-        with Timer(TAP_RUN, logger=None):
+        with timed(TAP_RUN):
             job = job.run()
 
-        with Timer(TAP_WAIT, logger=None):
-            job = job.wait()
+        return job
+
+    def fetch_async_timed(self, job, streamable_response=False, delete=False):
+        """
+        Fetch the result of a finished async job, as for `run_async_timed`.
+        """
+        record_uws_times(job._job)
 
-        with Timer(TAP_RAISE_IF_ERROR, logger=None):
+        with timed(TAP_RAISE_IF_ERROR):
             if job._job.phase in {"ERROR", "ABORTED"}:
                 raise DALQueryError("Query Error", job._job.phase, job.url)
 
-        with Timer(TAP_FETCH_RESPONSE, logger=None):
+        with timed(TAP_FETCH_RESPONSE):
             if streamable_response:
                 result = job.get_result_response()
             else:
                 result = job.fetch_result()
 
         if delete:
-            with Timer(TAP_DELETE, logger=None):
+            with timed(TAP_DELETE):
                 job.delete()
 
         return result
@@ -209,13 +236,15 @@ class AsyncTAPSM(AsyncTAPJob):
         self._job = uws.parse_job(response.raw.read)
 
     def wait(self, phases=None, async_request_timeout=30,
-             async_total_timeout=120):
+             async_total_timeout=120, poller=None):
         """
         waits for the job to reach the given phases.
         Parameters
         ----------
         phases : list
             phases to wait for
+        poller : UwsPoller
+            if not None, the shared poller that polls the job while this waits
         Raises
         ------
         DALServiceError
@@ -224,12 +253,12 @@ class AsyncTAPSM(AsyncTAPJob):
         if not phases:
             phases = {"COMPLETED", "ABORTED", "ERROR"}
 
+        if poller is not None:
+            return poller.wait(self, phases, total_timeout=async_total_timeout)
+
         interval = 1.0
         increment = 1.2
 
-        active_phases = {
-            "QUEUED", "EXECUTING", "RUN", "COMPLETED", "ERROR", "UNKNOWN"}
-
         supports_wait_for_statechange = (LooseVersion(self._job.version) >=
                                          LooseVersion("1.1"))
         if supports_wait_for_statechange:
@@ -238,33 +267,67 @@ class AsyncTAPSM(AsyncTAPJob):
             timeout = async_request_timeout
         start_time = time.time()
         while True:
-            self._update(wait_for_statechange=supports_wait_for_statechange,
-                         timeout=timeout)
+            finished = self.poll(phases, wait_for_statechange=supports_wait_for_statechange,
+                                 timeout=timeout)
 
             elapsed = time.time() - start_time
 
-            # use the cached value
-            cur_phase = self._job.phase
-
-            if cur_phase not in active_phases:
-                raise DALServiceError(
-                    "Cannot wait for job completion. Job is not active!")
-
-            if cur_phase in phases:
+            if finished:
                 break
 
             # Check if we've exceeded total_timeout
             if elapsed > async_total_timeout:
-                raise DALServiceError(
+                raise QueryTimeout(
                     f'Async TAP job timed out, exceeding {async_total_timeout}s.')
 
             # fallback for uws 1.0
             if not supports_wait_for_statechange:
-                sleep(interval)
+                sleep(_sleep_time(interval))
                 interval = min(120, interval * increment)
 
         return self
 
+    def poll(self, phases=None, wait_for_statechange=False, timeout=30):
+        """
+        Update the job once.
+
+        Parameters
+        ----------
+        phases : list
+            phases that finish the job
+        wait_for_statechange : bool
+            if True, ask a UWS 1.1 service to hold the request until the phase
+            changes or timeout seconds pass
+        timeout : float
+            request timeout in seconds
+
+        Returns
+        -------
+        bool
+            True if the job has reached one of phases
+
+        Raises
+        ------
+        DALServiceError
+            if the job is in a state that won't lead to an result
+        """
+        if not phases:
+            phases = {"COMPLETED", "ABORTED", "ERROR"}
+
+        active_phases = {
+            "QUEUED", "EXECUTING", "RUN", "COMPLETED", "ERROR", "UNKNOWN"}
+
+        self._update(wait_for_statechange=wait_for_statechange, timeout=timeout)
+
+        # use the cached value
+        cur_phase = self._job.phase
+
+        if cur_phase not in active_phases:
+            raise DALServiceError(
+                "Cannot wait for job completion. Job is not active!")
+
+        return cur_phase in phases
+
     def fetch_result(self):
         """
         returns the result votable if query is finished
@@ -289,3 +352,17 @@ class AsyncTAPSM(AsyncTAPJob):
             raise DALServiceError.from_except(ex, self.url)
 
         return response
+
+
+def _sleep_time(interval):
+    """
+    interval, shortened to end at the current deadline, if any.
+
+    Raises
+    ------
+    QueryTimeout
+        If the deadline has already passed.
+    """
+    deadline = current_deadline()
+    remaining = deadline.check() if deadline is not None else None
+    return interval if remaining is None else min(interval, remaining)
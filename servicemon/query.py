@@ -1,23 +1,34 @@
 import os
+import hashlib
 import pathlib
-import warnings
+import threading
 import traceback
 import logging
 import html
 import requests
 import sys
 
-from codetiming import Timer
 import servicemon
 from astropy.coordinates import SkyCoord
-from astropy.table import Table
 from servicemon.utils import parse_coordinates
 
 from .query_stats import QueryStats
+from .deadline import Deadline, is_timeout
+from .query_timing import QueryTimings, timed
+from .votable_meta import VOTableMetaExtractor
+from .session_pool import SessionPool
+from .job_cleaner import delete_job
 from .pyvo_wrappers import TAPServiceSM
 from .timing_labels import (QUERY_TOTAL, DO_QUERY, STREAM_TO_FILE,
                             TAP_SUBMIT, TAP_RUN, TAP_WAIT, TAP_RAISE_IF_ERROR,
-                            TAP_FETCH_RESPONSE, TAP_DELETE)
+                            TAP_FETCH_RESPONSE, TAP_DELETE,
+                            TAP_SERVER_QUEUED, TAP_SERVER_EXEC,
+                            DNS, CONNECT, TLS_HANDSHAKE, TTFB, TRANSFER)
+
+
+# Reusable per-thread buffers for reading responses that are not saved.
+_sink_buffers = threading.local()
+_SINK_BUFFER_SIZE = 65536
 
 
 def compute_user_agent(specified_agent):
@@ -35,15 +46,47 @@ class Query():
     """
     """
 
+    # The named durations that go into the stats, in order, when they were measured.
+    _extra_duration_labels = (TAP_SUBMIT, TAP_RUN, TAP_WAIT, TAP_RAISE_IF_ERROR,
+                              TAP_FETCH_RESPONSE, TAP_DELETE,
+                              TAP_SERVER_QUEUED, TAP_SERVER_EXEC,
+                              TTFB, TRANSFER, DNS, CONNECT, TLS_HANDSHAKE)
+
+    # Which durations are kept when there are more than the stats have room for:
+    # the connection phases first, then tap_delete, which is only measured when
+    # asked for with --delete_jobs inline, then the TAP durations that say the
+    # most about the service.
+    _extra_duration_priority = (TTFB, TRANSFER, DNS, CONNECT, TLS_HANDSHAKE, TAP_DELETE,
+                                TAP_WAIT, TAP_SERVER_QUEUED, TAP_SERVER_EXEC,
+                                TAP_SUBMIT, TAP_FETCH_RESPONSE, TAP_RUN, TAP_RAISE_IF_ERROR)
+
     def __init__(self, service, coords, radius, out_dir, use_subdir=True,
                  agent=None, tap_mode='async', save_results=True,
-                 verbose=False):
+                 verbose=False, session_pool=None, digest=None, intended_start_time=None,
+                 tags=None, deadline=None, uws_poller=None, delete_jobs='never', job_cleaner=None,
+                 max_extra_durations=8):
         self._save_results = save_results
-
-        self._timer = Timer(QUERY_TOTAL, logger=None)
-        self._timer.timers.clear()
+        self._digest = digest
+        self._intended_start_time = intended_start_time
+        self._deadline = deadline if deadline is not None else Deadline()
+        self._timed_out = False
+        self._uws_poller = uws_poller
+        self._delete_jobs = delete_jobs
+        self._job_cleaner = job_cleaner
+        self._job_url = None
+        # The number of extra_dur columns in the stats.  Durations beyond these are
+        # left out, in the reverse order of _extra_duration_priority.
+        self._max_extra_durations = max_extra_durations
+
+        self._timings = QueryTimings()
 
         self.__agent = compute_user_agent(agent)
+        # A pool made for this query alone is closed when the query ends.
+        self._owns_pool = session_pool is None
+        if session_pool is None:
+            session_pool = SessionPool(agent=self.__agent)
+        self._session_pool = session_pool
+        self._sessions = []
         self._tap_mode = tap_mode
         self._service = service
         self._base_name = self._compute_base_name()
@@ -70,66 +113,187 @@ class Query():
         self._query_params = self._compute_query_params()
         self._query_name = self._compute_query_name()
         self._filename = self._out_path / (self._query_name + '.xml')
+        self._response_meta = None
+        self._response_digest = None
+        self._skipped = False
 
         self._stats = QueryStats(
             self._query_name, self._base_name, self._service_type,
-            self._access_url, self._query_params, self._result_meta_attrs())
+            self._access_url, self._query_params, self._result_meta_attrs(),
+            max_extra_durations=self._max_extra_durations, tags=tags,
+            scheduled=intended_start_time is not None)
 
     @property
     def stats(self):
         return self._stats
 
+    @property
+    def timings(self):
+        return self._timings
+
+    @property
+    def skipped(self):
+        return self._skipped
+
+    @property
+    def timed_out(self):
+        return self._timed_out
+
+    def skip(self, reason):
+        """
+        Record the query as skipped for the given reason instead of running it.
+        """
+        self._skipped = True
+        self._stats.mark_start_time(self._intended_start_time)
+        self._stats.mark_end_time()
+        self._stats.errmsg = self._stats.errmsg + reason
+        result_meta = dict.fromkeys(self._result_meta_attrs())
+        result_meta['status'] = 'skipped'
+        self._stats.result_meta = result_meta
+
     def run(self):
-        self._stats.mark_start_time()
+        self._stats.mark_start_time(self._intended_start_time)
+        response = None
         try:
-            with self._timer:
+            with self._timings.activate(), self._deadline.activate(), timed(QUERY_TOTAL):
                 if self._service_type == 'cone':
                     response = self.do_cone_query()
-                    self.stream_to_file(response)
+                    self.stream_response(response)
                 if self._service_type == 'xcone':
                     response = self.do_xcone_query()
-                    self.stream_to_file(response)
+                    self.stream_response(response)
                 elif self._service_type == 'tap':
-                    tap_service = TAPServiceSM(self._access_url)
+                    tap_service = TAPServiceSM(
+                        self._access_url, session=self._get_session(self._access_url))
                     if self._tap_mode == 'async':
                         response = self.do_tap_query_async_pyvo(tap_service)
                     else:
                         response = self.do_tap_query_pyvo(tap_service)
-                    self.stream_to_file(response)
+                    self.stream_response(response)
         except Exception as e:
+            self._timed_out = is_timeout(e) or self._deadline.expired
             msg = f'Query error for service {self._service}: {repr(e)}'
             self._handle_exc(msg)
         finally:
             self._stats.mark_end_time()
 
+        with self._timings.activate():
+            self.dispose_job()
         self.gather_response_metadata(response)
 
-    @Timer(name=DO_QUERY, logger=None)
+        # Returns the connection to the pool if the response was fully read,
+        # or closes it if the read was cut short.
+        if response is not None:
+            response.close()
+        self._release_sessions()
+
+    @timed(DO_QUERY)
     def do_tap_query_async_pyvo(self, tap_service):
-        response = tap_service.run_async_timed(self._adql, streamable_response=True)
+        job = tap_service.submit_async_timed(self._adql)
+        self._job_url = job.url
+
+        with timed(TAP_WAIT):
+            job = job.wait(poller=self._uws_poller)
+
+        response = tap_service.fetch_async_timed(job, streamable_response=True)
         return response
 
-    @Timer(name=DO_QUERY, logger=None)
+    def dispose_job(self):
+        """
+        Delete the query's async TAP job, if it created one, as set by
+        delete_jobs: 'inline' deletes it now, recording the tap_delete duration
+        with the query's, 'background' hands it to the job cleaner, if there is
+        one, and 'never' leaves it on the service.  A failed deletion is logged
+        but does not count against the query.
+        """
+        job_url, self._job_url = self._job_url, None
+        if job_url is None or self._delete_jobs == 'never':
+            return
+        if self._delete_jobs == 'background' and self._job_cleaner is not None:
+            self._job_cleaner.add(job_url, self._base_name)
+            return
+        try:
+            with timed(TAP_DELETE):
+                delete_job(self._get_session(job_url), job_url, timeout=self._deadline.read)
+        except Exception as e:
+            logging.warning(f'Error deleting UWS job {job_url}: {repr(e)}')
+
+    @timed(DO_QUERY)
     def do_tap_query_pyvo(self, tap_service):
         response = tap_service.run_sync_timed(self._adql, streamable_response=True)
         return response
 
-    @Timer(name=DO_QUERY, logger=None)
+    @timed(DO_QUERY)
     def do_cone_query(self):
         response = self.do_request(self._access_url, self._query_params)
         return response
 
-    @Timer(name=DO_QUERY, logger=None)
+    @timed(DO_QUERY)
     def do_xcone_query(self):
         response = self.do_request(self._access_url)
         return response
 
-    @Timer(name=STREAM_TO_FILE, logger=None)
+    def stream_response(self, response):
+        """
+        Read the response body, saving it to a file only if the results are to be saved.
+        """
+        if self._save_results:
+            self.stream_to_file(response)
+        else:
+            self.stream_to_sink(response)
+
+    @timed(STREAM_TO_FILE)
     def stream_to_file(self, response):
+        meta = VOTableMetaExtractor()
+        digest = self._new_digest()
         os.makedirs(os.path.dirname(self._filename), exist_ok=True)
         with open(self._filename, 'wb+') as fd:
             for chunk in response.iter_content(chunk_size=8096):
+                self._deadline.check()
                 fd.write(chunk)
+                meta.feed(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+        # A shut down socket looks like the end of the response.
+        self._deadline.check()
+        meta.close()
+        self._finish_stream(meta, digest)
+
+    @timed(STREAM_TO_FILE)
+    def stream_to_sink(self, response):
+        """
+        Read the response body into a reusable buffer without writing it anywhere,
+        so the timing reflects the network rather than the local disk.
+        """
+        meta = VOTableMetaExtractor()
+        digest = self._new_digest()
+
+        buf = getattr(_sink_buffers, 'buf', None)
+        if buf is None:
+            buf = _sink_buffers.buf = bytearray(_SINK_BUFFER_SIZE)
+        view = memoryview(buf)
+
+        raw = response.raw
+        raw.decode_content = True
+        while (n := raw.readinto(buf)) > 0:
+            self._deadline.check()
+            chunk = view[:n]
+            meta.feed(chunk)
+            if digest is not None:
+                digest.update(chunk)
+        self._deadline.check()
+        meta.close()
+        self._finish_stream(meta, digest)
+
+    def _new_digest(self):
+        if self._digest is None:
+            return None
+        return hashlib.new(self._digest)
+
+    def _finish_stream(self, meta, digest):
+        self._response_meta = meta
+        if digest is not None:
+            self._response_digest = digest.hexdigest()
 
     def compute_headers(self):
         headers = requests.utils.default_headers()
@@ -142,11 +306,35 @@ class Query():
     def do_request(self, url, params=None, agent=None):
         headers = self.compute_headers()
 
-        response = requests.get(url, params, headers=headers, stream=True)
+        session = self._get_session(url)
+        response = session.get(url, params=params, headers=headers, stream=True)
         return response
 
+    def _get_session(self, url):
+        session = self._session_pool.get(url)
+        self._sessions.append(session)
+        return session
+
+    def _release_sessions(self):
+        """
+        Give back the sessions the query used, once its response is closed.
+        """
+        sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            self._session_pool.release(session)
+        if self._owns_pool:
+            self._session_pool.close()
+
+    def _status_of(self, response):
+        return response.status_code
+
     def _result_meta_attrs(self):
-        return ['status', 'size', 'num_rows', 'num_columns']
+        # query_status is in every row, even when the VOTable has no QUERY_STATUS,
+        # so that the columns do not change from row to row (see the output docs).
+        attrs = ['status', 'size', 'num_rows', 'num_columns', 'query_status']
+        if self._digest is not None:
+            attrs.append('digest')
+        return attrs
 
     def _handle_exc(self, msg, trace=False):
         self._stats.errmsg = self._stats.errmsg + msg
@@ -160,39 +348,36 @@ class Query():
         response:  Either an http.client.HTTPResponse or a ???
         """
         # Add timings to stats intervals.
-        timers = self._timer.timers
+        timers = self._timings
         stats = self._stats
         stats.do_query_dur = timers.get(DO_QUERY)
         stats.stream_to_file_dur = timers.get(STREAM_TO_FILE)
         stats.query_total_dur = timers.get(QUERY_TOTAL)
 
-        if (val := timers.get(TAP_SUBMIT)) is not None:
-            stats.add_named_duration(TAP_SUBMIT, val)
-        if (val := timers.get(TAP_RUN)) is not None:
-            stats.add_named_duration(TAP_RUN, timers.get(TAP_RUN))
-        if (val := timers.get(TAP_WAIT)) is not None:
-            stats.add_named_duration(TAP_WAIT, timers.get(TAP_WAIT))
-        if (val := timers.get(TAP_RAISE_IF_ERROR)) is not None:
-            stats.add_named_duration(TAP_RAISE_IF_ERROR, timers.get(TAP_RAISE_IF_ERROR))
-        if (val := timers.get(TAP_FETCH_RESPONSE)) is not None:
-            stats.add_named_duration(TAP_FETCH_RESPONSE, timers.get(TAP_FETCH_RESPONSE))
-        if (val := timers.get(TAP_DELETE)) is not None:
-            stats.add_named_duration(TAP_DELETE, timers.get(TAP_DELETE))
+        recorded = [label for label in self._extra_duration_priority if timers.get(label) is not None]
+        kept = set(recorded[:self._max_extra_durations])
+        for label in self._extra_duration_labels:
+            if label in kept:
+                stats.add_named_duration(label, timers.get(label))
 
         result_meta = dict.fromkeys(self._result_meta_attrs())
-        result_meta['status'] = response.status_code
+        if self._timed_out:
+            result_meta['status'] = 'timeout'
+        elif response is not None:
+            result_meta['status'] = self._status_of(response)
 
         try:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                t = Table.read(self._filename, format='votable')
-
-            result_meta['size'] = os.path.getsize(self._filename)
-            result_meta['num_rows'] = len(t)
-            result_meta['num_columns'] = len(t.columns)
-
-            if not self._save_results:
-                os.remove(self._filename)
+            # The metadata was extracted as the response was streamed.
+            meta = self._response_meta
+            if meta is None:
+                raise ValueError('No response body was read')
+            result_meta['size'] = meta.size
+            result_meta['query_status'] = meta.query_status
+            if self._digest is not None:
+                result_meta['digest'] = self._response_digest
+            meta.raise_if_error()
+            result_meta['num_rows'] = meta.num_rows
+            result_meta['num_columns'] = meta.num_columns
         except Exception as e:
             msg = f'In {self._query_name}, error reading result table: {repr(e)}'
             self._handle_exc(msg)
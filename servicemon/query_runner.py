@@ -1,18 +1,41 @@
 import sys
 import ast
+import time
 import csv
 import signal
 import faulthandler
 import platform
 import logging
 import warnings
-
-from argparse import ArgumentParser
+import hashlib
+import random
+import uuid
+import functools
+
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlparse
 
+import numpy as np
 from astropy.table import Table
-from .query import Query
+from .query import Query, compute_user_agent
 from .cone import Cone
+from .session_pool import SessionPool
+from .async_engine import AsyncEngine
+from .shard_pool import ShardPool
+from .journal import ProgressJournal
+from .rate_limit import RateLimiter
+from .arrivals import arrival_offsets
+from .ramp import RampRunner
+from .circuit_breaker import CircuitBreaker
+from .deadline import Deadline
+from .tap_pipeline import TapPipeline
+from .uws_poller import UwsPoller
+from .job_cleaner import JobCleaner
+from .writer_dispatch import WriterDispatch, OVERFLOW_POLICIES
 from .plugin_support import SmPluginSupport, AbstractResultWriter
 
 
@@ -22,7 +45,7 @@ class QueryRunner():
 
     _first_instance = True
 
-    def __init__(self, args):
+    def __init__(self, args, writers=None, shard=None, journal=None):
         """
         args is assumed to be a Namespace object args with each attribute having a valid
         value (no defaults will be applied here).  Using vars(args) to show the object as
@@ -41,8 +64,48 @@ class QueryRunner():
          'start_index': 14,
          'tap_mode': 'async',
          'verbose': False,
+         'workers': 1,
+         'per_host_limit': None,
+         'pool_size': 10,
+         'max_extra_durations': 8,
+         'cold_connections': False,
+         'digest': None,
+         'engine': 'threads',
+         'processes': 1,
+         'shard_by': 'range',
+         'journal': 'output/ps-tap.journal',
+         'resume': False,
+         'host_max_qps': None,
+         'arrival': 'closed',
+         'arrival_rate': None,
+         'arrival_seed': None,
+         'ramp': None,
+         'step_duration': 300.0,
+         'breaker_threshold': 0,
+         'breaker_backoff': 30.0,
+         'breaker_max_backoff': 1800.0,
+         'connect_timeout': 30.0,
+         'read_timeout': 60.0,
+         'total_timeout': None,
+         'tap_pipeline': 1,
+         'uws_pollers': 4,
+         'delete_jobs': 'background',
+         'delete_workers': 2,
+         'pair_order': 'fixed',
+         'pair_seed': None,
+         'writer_queue': 1000,
+         'writer_overflow': 'block',
          'writers': ['csv_writer:outfile=output/ps-tap-2020-08-02-16:19:37.484191.csv',
          'some_writer']}
+
+        writers, if not None, is a list of result writer objects to use instead of
+        the plug-ins given by args.writers.
+
+        shard, if not None, is a (shard_index, num_shards) tuple selecting the part of
+        the work this runner does, as split by args.shard_by.
+
+        journal, if not None, is used instead of a ProgressJournal opened from
+        args.journal to record and look up the completed queries.
         """
 
         # reset this flag for each instance
@@ -68,10 +131,60 @@ class QueryRunner():
         self._save_results = args.save_results
         self._verbose = args.verbose
         self._writer_specs = args.writers
+        self._workers = max(1, int(getattr(args, 'workers', 1)))
+        self._per_host_limit = getattr(args, 'per_host_limit', None)
+        self._digest = getattr(args, 'digest', None)
+        self._engine = getattr(args, 'engine', 'threads')
+        self._processes = max(1, int(getattr(args, 'processes', 1)))
+        self._shard_by = getattr(args, 'shard_by', 'range')
+        self._shard = shard
+        self._journal_path = getattr(args, 'journal', None)
+        self._resume = getattr(args, 'resume', False)
+        self._journal = journal
+        self._host_max_qps = getattr(args, 'host_max_qps', None)
+        self._arrival = getattr(args, 'arrival', 'closed')
+        self._arrival_rate = getattr(args, 'arrival_rate', None)
+        self._arrival_seed = getattr(args, 'arrival_seed', None)
+        self._ramp = getattr(args, 'ramp', None)
+        self._step_duration = float(getattr(args, 'step_duration', 300.0))
+        self._connect_timeout = getattr(args, 'connect_timeout', 30.0)
+        self._read_timeout = getattr(args, 'read_timeout', 60.0)
+        self._total_timeout = getattr(args, 'total_timeout', None)
+        self._tap_pipeline = max(1, int(getattr(args, 'tap_pipeline', 1)))
+        uws_pollers = int(getattr(args, 'uws_pollers', 4))
+        self._uws_poller = UwsPoller(threads=uws_pollers) if uws_pollers > 0 else None
+        # A ramp keeps every service busy for the whole step, skipped or not.
+        self._breaker = None
+        breaker_threshold = getattr(args, 'breaker_threshold', 0)
+        if breaker_threshold > 0 and not self._ramp:
+            self._breaker = CircuitBreaker(breaker_threshold,
+                                           backoff=float(getattr(args, 'breaker_backoff', 30.0)),
+                                           max_backoff=float(getattr(args, 'breaker_max_backoff', 1800.0)))
+        self._agent = compute_user_agent(self._user_agent)
+        self._max_extra_durations = int(getattr(args, 'max_extra_durations', 8))
+        self._session_pool = SessionPool(pool_size=int(getattr(args, 'pool_size', 10)),
+                                         cold=getattr(args, 'cold_connections', False),
+                                         agent=self._agent)
+        self._pair_order = getattr(args, 'pair_order', 'fixed')
+        self._pair_rng = random.Random(getattr(args, 'pair_seed', None))
+        # Keeps the pair_ids of this run apart from those of other runs.
+        self._run_id = uuid.uuid4().hex[:12]
+        self._delete_jobs = getattr(args, 'delete_jobs', 'background')
+        self._job_cleaner = None
+        if self._delete_jobs == 'background':
+            self._job_cleaner = JobCleaner(self._session_pool,
+                                           workers=max(1, int(getattr(args, 'delete_workers', 2))),
+                                           log_path=self._delete_log_path())
+
+        self._writer_queue = int(getattr(args, 'writer_queue', 1000))
+        self._writer_overflow = getattr(args, 'writer_overflow', 'block')
+        self._dispatch = None
 
         self._writers_descs = []
         self._writers = []
-        self._load_plugins(args)
+        self._injected_writers = writers
+        if writers is None:
+            self._load_plugins(args)
 
         # This flag will stay False for all future instances.
         self._first_instance = False
@@ -105,16 +218,47 @@ class QueryRunner():
 
         self._validate_services(self._services)
 
+        if self._injected_writers is not None:
+            for w in self._injected_writers:
+                w.begin(self._args)
+                self._writers.append(w)
         for wdesc in self._writers_descs:
             w = wdesc.cls()
             w.begin(self._args, **wdesc.kwargs)
             self._writers.append(w)
-
-        if self._cones is not None:
+        if self._writer_queue > 0:
+            self._dispatch = WriterDispatch(self._writers, queue_size=self._writer_queue,
+                                            overflow=self._writer_overflow, spill_dir=self._result_dir)
+
+        owns_journal = self._journal is None and self._journal_path is not None
+        if owns_journal:
+            self._journal = ProgressJournal(self._journal_path)
+
+        if self._ramp:
+            RampRunner(self, self._ramp, self._step_duration).run()
+        elif self._processes > 1:
+            ShardPool(self, self._processes).run()
+        elif self._cones is not None:
             self._run_with_cones()
         else:
             self._run_services_only()
 
+        if self._uws_poller is not None:
+            self._uws_poller.close()
+        if self._job_cleaner is not None:
+            self._job_cleaner.close()
+            summary = self._job_cleaner.summary()
+            if self._verbose and len(summary):
+                print('\n'.join(summary.pformat_all()), file=sys.stderr)
+        self._session_pool.close()
+
+        # The writers' threads journal the queries as their results are written.
+        if self._dispatch is not None:
+            self._dispatch.close()
+            if self._verbose:
+                print('\n'.join(self._dispatch.metrics().pformat_all()), file=sys.stderr)
+        if owns_journal:
+            self._journal.close()
         for w in self._writers:
             w.end()
 
@@ -131,61 +275,348 @@ class QueryRunner():
                     break
 
     def _run_with_cones(self):
-        cone_index = 0
-        cones_run = 0
-        for cone in self._cones:
-            if cone_index >= self._starting_cone:
-                cones_run += 1
-                if cones_run > self._cone_limit:
-                    break
-                for service in self._services:
-                    # Don't use the previous results upon new exception.
-                    query = None
-                    try:
-                        query = Query(service, (cone['ra'], cone['dec']),
-                                      cone['radius'], self._result_dir,
-                                      tap_mode=self._tap_mode,
-                                      agent=self._user_agent,
-                                      save_results=self._save_results,
-                                      verbose=self._verbose)
-                        query.run()
-                    except Exception as e:
-                        msg = f'Query error for cone {cone}, service {service}: {repr(e)}'
-                        query._handle_exc(msg, trace=True)
-                    try:
-                        self._collect_stats(query.stats)
-                    except Exception as e:
-                        msg = f'Unable to write stats for cone {cone}, service {service}: {repr(e)}'
-                        query._handle_exc(msg)
-
-            cone_index += 1
+        tasks = ((cone_index, cone, variant)
+                 for cone_index, cone in self._selected(self._cones)
+                 for service in self._services
+                 for variant in self._variants(cone_index, service)
+                 if not self._is_completed(cone_index, variant))
+        self._run_tasks(tasks)
 
     def _run_services_only(self):
-        cone_index = 0
+        tasks = ((index, None, variant)
+                 for index, service in self._selected(self._services)
+                 for variant in self._variants(index, service)
+                 if not self._is_completed(index, variant))
+        self._run_tasks(tasks)
+
+    def _variants(self, index, service):
+        """
+        The services to query for the cone or service at index.  With tap_mode
+        'both', a TAP service is queried twice, in turn, once with each mode:
+        sync first, or in random order with pair_order 'random'.  Each of the
+        two is a copy of service with its tap_mode, and the pair_id, unique to
+        this run, and pair_position that link the two stats rows.
+        """
+        if self._tap_mode != 'both' or self.getval(service, 'service_type') != 'tap':
+            return [service]
+        modes = ['sync', 'async']
+        if self._pair_order == 'random':
+            self._pair_rng.shuffle(modes)
+        pair_id = f"{self._run_id}_{self.getval(service, 'base_name', 'Unnamed')}_{index}"
+        return [dict(service, tap_mode=mode, pair_id=pair_id, pair_position=position)
+                for position, mode in enumerate(modes)]
+
+    def _tap_mode_for(self, service):
+        return self.getval(service, 'tap_mode', self._tap_mode)
+
+    def _selected(self, items):
+        """
+        Yield (index, item) for the items selected by the start index and limit.
+        If this runner has a shard, only the items of that shard are yielded.
+        """
+        if self._shard is not None:
+            shard_index, num_shards = self._shard
+            if self._shard_by == 'range':
+                num_selected = max(0, min(self._cone_limit, len(items) - self._starting_cone))
+                first = shard_index * num_selected // num_shards
+                last = (shard_index + 1) * num_selected // num_shards
+
         cones_run = 0
-        for service in self._services:
-            if cone_index >= self._starting_cone:
+        for index, item in enumerate(items):
+            if index >= self._starting_cone:
                 cones_run += 1
                 if cones_run > self._cone_limit:
                     break
-                query = Query(service, None, None, self._result_dir,
-                              tap_mode=self._tap_mode,
-                              agent=self._user_agent,
-                              save_results=self._save_results,
-                              verbose=self._verbose)
-                query.run()
-                try:
-                    self._collect_stats(query.stats)
-                except Exception as e:
-                    msg = f'Unable to write stats for service {service}: {repr(e)}'
-                    query._handle_exc(msg)
-
-            cone_index += 1
+                position = cones_run - 1
+                if self._shard is not None:
+                    if self._shard_by == 'range':
+                        if not first <= position < last:
+                            continue
+                    elif position % num_shards != shard_index:
+                        continue
+                yield index, item
+
+    def _is_completed(self, index, service):
+        """
+        True if resuming and the journal shows this task was already done.
+        """
+        return (self._resume and self._journal is not None and
+                self._journal.is_completed(index, self._service_key(service)))
+
+    def _service_key(self, service):
+        """
+        Identifies a service in the journal, in the style of the query names.
+        """
+        base_name = self.getval(service, 'base_name', 'Unnamed')
+        service_type = self.getval(service, 'service_type')
+        key = f'{base_name}_{service_type}'
+        if service_type == 'tap':
+            key += f'-{self._tap_mode_for(service)}'
+        return key
+
+    def _run_tasks(self, tasks):
+        """
+        Run each (index, cone, service) task, sending the stats to the writers.
+
+        With one worker the tasks are run in order in this thread.  Otherwise,
+        they are dispatched to a pool of worker threads, with no more than
+        per_host_limit of them in flight for any one host.  With the asyncio
+        engine, they are run as coroutines in an event loop with the same limits.
+        In all cases, a task is held back while its service's or host's rate
+        limit would be exceeded, letting other tasks go ahead of it.
+
+        With an open-loop arrival process, each task is instead handed to the
+        workers at its scheduled time, whether or not earlier tasks are done.
+
+        With a TAP pipeline, up to tap_pipeline async TAP jobs are kept
+        outstanding at once, all polled from this thread.
+
+        Stats are always sent to the writers from this thread.
+        """
+        if self._engine == 'asyncio':
+            AsyncEngine(self).run(tasks)
+        elif self._arrival != 'closed':
+            self._run_tasks_open_loop(tasks)
+        elif self._tap_pipeline > 1 and self._tap_mode == 'async':
+            TapPipeline(self, self._tap_pipeline, poller=self._uws_poller).run(tasks)
+        elif self._workers == 1:
+            self._run_tasks_serially(tasks)
+        else:
+            self._run_tasks_concurrently(tasks)
+
+    def _new_scheduler(self, tasks):
+        rate_limiter = None
+        if self._host_max_qps is not None or any(
+                self._service_max_qps(service) is not None for service in self._services):
+            scale = 1.0 / self._shard[1] if self._shard is not None else 1.0
+            rate_limiter = RateLimiter(self._service_host, self._service_key,
+                                       self._service_max_qps, host_max_qps=self._host_max_qps,
+                                       scale=scale)
+        per_host_limit = self._per_host_limit
+        if per_host_limit is not None and self._shard is not None:
+            # The processes share the limit, as they share the rates, so that
+            # together they never exceed it.
+            shard_index, num_shards = self._shard
+            per_host_limit = per_host_limit // num_shards + (shard_index < per_host_limit % num_shards)
+        return HostScheduler(tasks, self._service_host, per_host_limit,
+                             rate_limiter=rate_limiter)
+
+    def _service_max_qps(self, service):
+        return self.getval(service, 'max_qps')
+
+    def _run_tasks_serially(self, tasks):
+        scheduler = self._new_scheduler(tasks)
+
+        def run(task):
+            query = self._run_query(*task)
+            scheduler.task_done(task)
+            self._finish_task(task, query)
+
+        # Each task is finished by the time run returns, so there are only rate limits to wait for.
+        for delay in scheduler.schedule(run, (), 1):
+            time.sleep(delay)
+
+    def _run_tasks_concurrently(self, tasks):
+        scheduler = self._new_scheduler(tasks)
+        in_flight = {}
+
+        with ThreadPoolExecutor(max_workers=self._workers,
+                                thread_name_prefix='sm_query') as executor:
+            def submit(task):
+                in_flight[executor.submit(self._run_query, *task)] = task
+
+            for delay in scheduler.schedule(submit, in_flight, self._workers):
+                if not in_flight:
+                    time.sleep(delay)
+                    continue
+
+                done, _ = wait(in_flight, timeout=delay, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = in_flight.pop(future)
+                    scheduler.task_done(task)
+                    self._finish_task(task, future.result())
+
+    def _run_tasks_open_loop(self, tasks):
+        in_flight = {}
+
+        def finish(done):
+            for future in done:
+                self._finish_task(in_flight.pop(future), future.result())
+
+        with ThreadPoolExecutor(max_workers=self._workers,
+                                thread_name_prefix='sm_query') as executor:
+            for task, intended_start_time, due in self._arrival_schedule(tasks):
+                # Write the stats of finished tasks while waiting.
+                while True:
+                    delay = due - time.monotonic()
+                    if delay <= 0:
+                        break
+                    if in_flight:
+                        finish(wait(in_flight, timeout=delay, return_when=FIRST_COMPLETED)[0])
+                    else:
+                        time.sleep(delay)
+
+                # If all the workers are busy, the task starts late.
+                future = executor.submit(self._run_query, *task,
+                                         intended_start_time=intended_start_time)
+                in_flight[future] = task
+
+            while in_flight:
+                finish(wait(in_flight, return_when=FIRST_COMPLETED)[0])
+
+    def _arrival_schedule(self, tasks):
+        """
+        Yield (task, intended_start_time, due) for each task, where the
+        intended_start_time is a time.time() and due the same time as a
+        time.monotonic().
+        """
+        rate = self._arrival_rate
+        if self._shard is not None:
+            rate /= self._shard[1]
+        start = time.monotonic()
+        wall_offset = time.time() - start
+        for task, offset in zip(tasks, arrival_offsets(self._arrival, rate, self._arrival_seed)):
+            due = start + offset
+            yield task, due + wall_offset, due
+
+    def _run_query(self, index, cone, service, **kwargs):
+        """
+        Create and run the Query for one task.  Returns the Query, or None if
+        it could not be created.  kwargs are passed to the Query.
+        """
+        if not self._circuit_allows(service):
+            return self._skipped_query(cone, service, **kwargs)
+
+        # Don't use the previous results upon new exception.
+        query = None
+        try:
+            query = self._create_query(cone, service, **kwargs)
+            query.run()
+        except Exception as e:
+            self._handle_query_exc(query, cone, service, e)
+        self._circuit_record(service, query)
+        return query
+
+    def _circuit_allows(self, service):
+        return self._breaker is None or self._breaker.allow(self._service_key(service))
+
+    def _circuit_record(self, service, query):
+        """
+        Count a query that failed to run or recorded any error against its service.
+        """
+        if self._breaker is not None:
+            ok = query is not None and query.stats.errmsg == ':'
+            self._breaker.record(self._service_key(service), ok)
+
+    def _skipped_query(self, cone, service, **kwargs):
+        """
+        A Query whose stats record that it was skipped because its service's
+        circuit is open, or None if it could not be created.
+        """
+        query = None
+        try:
+            query = self._create_query(cone, service, **kwargs)
+            query.skip('skipped: circuit open')
+        except Exception as e:
+            self._handle_query_exc(query, cone, service, e)
+        return query
+
+    def _create_query(self, cone, service, query_class=Query, **kwargs):
+        if cone is not None:
+            coords, radius = (cone['ra'], cone['dec']), cone['radius']
+        else:
+            coords, radius = None, None
+        if self._tap_mode == 'both':
+            # Every row gets the pair columns, so that all the rows have the same columns.
+            kwargs['tags'] = dict(kwargs.get('tags') or {},
+                                  pair_id=self.getval(service, 'pair_id'),
+                                  pair_position=self.getval(service, 'pair_position'))
+        return query_class(service, coords, radius, self._result_dir,
+                           tap_mode=self._tap_mode_for(service),
+                           agent=self._user_agent,
+                           save_results=self._save_results,
+                           verbose=self._verbose,
+                           session_pool=self._session_pool,
+                           digest=self._digest,
+                           deadline=self._deadline_for(service),
+                           uws_poller=self._uws_poller,
+                           delete_jobs=self._delete_jobs,
+                           job_cleaner=self._job_cleaner,
+                           max_extra_durations=self._max_extra_durations,
+                           **kwargs)
+
+    def _delete_log_path(self):
+        """
+        The file in the result directory to which the background job
+        deletions of this run are written.
+        """
+        dtstr = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+        suffix = f'_shard{self._shard[0]}' if self._shard is not None else ''
+        return Path(self._result_dir) / f'tap_delete_{dtstr}{suffix}.csv'
+
+    def _deadline_for(self, service):
+        """
+        A new Deadline for a query of service, with the service's own
+        connect_timeout, read_timeout and total_timeout where it has them.
+        """
+        def timeout(key, default):
+            val = self.getval(service, key)
+            return default if val is None else float(val)
+
+        return Deadline(connect=timeout('connect_timeout', self._connect_timeout),
+                        read=timeout('read_timeout', self._read_timeout),
+                        total=timeout('total_timeout', self._total_timeout))
+
+    def _handle_query_exc(self, query, cone, service, e):
+        msg = f'Query error for cone {cone}, service {service}: {repr(e)}'
+        if query is None:
+            logging.error(msg)
+        else:
+            query._handle_exc(msg, trace=True)
+
+    def _finish_task(self, task, query):
+        if query is None:
+            return
+        index, cone, service = task
+        try:
+            written = self._collect_stats(query.stats)
+        except Exception as e:
+            msg = f'Unable to write stats for cone {cone}, service {service}: {repr(e)}'
+            query._handle_exc(msg)
+            return
+
+        # Only record the task once every writer has written its results, and
+        # not if it was skipped, so that a resumed run tries it again.
+        if self._journal is not None and not query.skipped:
+            self._when_written(written, functools.partial(self._journal.record, index,
+                                                          self._service_key(service)))
+
+    def _when_written(self, written, func):
+        """
+        Call func once stats are written.  written is what _collect_stats
+        returned for them: None if the writers have already been called, or the
+        Future from the dispatch, in which case func is not called if a writer
+        failed or the stats were dropped.
+        """
+        if written is None:
+            func()
+            return
+
+        def done(future):
+            if future.exception() is None:
+                func()
+        written.add_done_callback(done)
+
+    def _service_host(self, service):
+        access_url = self.getval(service, 'access_url', '')
+        return urlparse(str(access_url)).netloc
 
     def _collect_stats(self, stats):
-        self._output_stats_row(stats)
+        return self._output_stats_row(stats)
 
     def _output_stats_row(self, stats):
+        if self._dispatch is not None:
+            return self._dispatch.put(stats)
         for w in self._writers:
             w.one_result(stats)
 
@@ -197,7 +628,8 @@ class QueryRunner():
             writer.writeheader()
         writer.writerow(stats.row_values())
 
-    def _read_if_file(self, obj):
+    @staticmethod
+    def _read_if_file(obj):
         val = obj
         if isinstance(obj, str):
             # Read from file
@@ -221,9 +653,127 @@ class QueryRunner():
                 val = obj[key]
             except KeyError:
                 val = default
+
+        # Table rows have masked values for keys missing from some services.
+        if val is np.ma.masked:
+            val = default
         return val
 
 
+class HostScheduler():
+    """
+    Hands out (index, cone, service) tasks in order, except that a task whose
+    host already has per_host_limit tasks in flight is deferred until one of
+    them is done, and a task whose rate limit would be exceeded is deferred
+    until its rate allows, letting other tasks go ahead of it.
+
+    Parameters
+    ----------
+    tasks : iterable
+        The tasks, which are pulled from the iterable only as needed.
+    host_of : callable
+        Returns the host for a service.
+    per_host_limit : int or None
+        Maximum tasks in flight per host.  None means no limit.
+    rate_limiter : RateLimiter or None
+        Consulted before each task is started.  None means no rate limits.
+    """
+
+    def __init__(self, tasks, host_of, per_host_limit=None, rate_limiter=None):
+        self._tasks = iter(tasks)
+        self._host_of = host_of
+        self._per_host_limit = per_host_limit
+        self._rate_limiter = rate_limiter
+        self._pending = {}  # queue key -> deque of (seq, task) waiting to start
+        self._active = Counter()
+        self._seq = 0
+        self._tasks_left = True
+
+    def next_task(self):
+        """
+        Return the next task that may be started, or None if no task may start
+        until another is done, or until `next_ready_in` seconds have passed
+        (or there are no more tasks).
+        """
+        # Oldest deferred task that may now start.
+        ready = [(q[0][0], key) for key, q in self._pending.items()
+                 if q and self._can_start(q[0][1])]
+        if ready:
+            _, key = min(ready)
+            return self._start(self._pending[key].popleft()[1])
+
+        while self._tasks_left:
+            try:
+                task = next(self._tasks)
+            except StopIteration:
+                self._tasks_left = False
+                break
+            key = self._queue_key(task)
+            if not self._pending.get(key) and self._can_start(task):
+                return self._start(task)
+            self._pending.setdefault(key, deque()).append((self._seq, task))
+            self._seq += 1
+        return None
+
+    def next_ready_in(self):
+        """
+        Seconds until a task held back only by its rate limit may start, or None
+        if there is no such task.
+        """
+        if self._rate_limiter is None:
+            return None
+        delays = [self._rate_limiter.delay(q[0][1][2]) for q in self._pending.values()
+                  if q and self._host_available(self._host_of(q[0][1][2]))]
+        return min(delays) if delays else None
+
+    def task_done(self, task):
+        self._active[self._host_of(task[2])] -= 1
+
+    def schedule(self, start, in_flight, capacity):
+        """
+        Generator for the loop of a run with up to capacity tasks in flight.
+        Each task that may start is given to start(task), which adds it to
+        in_flight if it is still running.  When no more may start, the timeout
+        for the caller's wait is yielded: the caller waits up to that many seconds
+        (None for no limit) for a task in flight to finish, or if there is none,
+        sleeps that long, and calls task_done for each task that finished.
+        The generator ends when no task is in flight or left to start.
+        """
+        while True:
+            while len(in_flight) < capacity:
+                task = self.next_task()
+                if task is None:
+                    break
+                start(task)
+
+            # Wake up for a rate-limited task only if there is room for it.
+            timeout = self.next_ready_in() if len(in_flight) < capacity else None
+            if not in_flight and timeout is None:
+                return
+            yield timeout
+
+    def _queue_key(self, task):
+        if self._rate_limiter is None:
+            return self._host_of(task[2])
+        return self._rate_limiter.bucket_key(task[2])
+
+    def _can_start(self, task):
+        service = task[2]
+        if not self._host_available(self._host_of(service)):
+            return False
+        return self._rate_limiter is None or self._rate_limiter.delay(service) <= 0
+
+    def _host_available(self, host):
+        return self._per_host_limit is None or self._active[host] < self._per_host_limit
+
+    def _start(self, task):
+        service = task[2]
+        self._active[self._host_of(service)] += 1
+        if self._rate_limiter is not None:
+            self._rate_limiter.take(service)
+        return task
+
+
 ################################################################################
 
 # run time routines
@@ -255,11 +805,12 @@ def sm_query(input_args=None):
     qr.run()
 
 
-def _parse_query(input_args):
+def _parse_query(input_args, parser=None):
     """
     # Parse args and apply defaults.
     """
-    parser = _create_query_argparser()
+    if parser is None:
+        parser = _create_query_argparser()
 
     # Parse the arguments.  If args is None, then the args implicitly come from sys.argv.
     args = parser.parse_args(input_args)
@@ -274,6 +825,8 @@ def _parse_query(input_args):
         parser.error(message='argument --num-cones is required when '
                      '--min-radius or --max-radius are present.')
 
+    _validate_run_args(parser, args)
+
     if args.num_cones is None and args.cone_file is None:
         parser.error(message='Either --num-cones or --cone_file must be present\n'
                      '   to specify what values go into the service file templates.')
@@ -329,6 +882,8 @@ def _parse_replay(input_args):
     # Catch SIGHUP, SIGQUIT and SIGTERM to allow running in the background.
     catch_signals()
 
+    _validate_run_args(parser, args)
+
     # Apply defaults that couldn't be built in.
     apply_query_defaults(args, conelist_defaults)
     if args.writers is None:
@@ -337,12 +892,200 @@ def _parse_replay(input_args):
     return args
 
 
-def _create_query_argparser():
-    parser = ArgumentParser(description='Measure query performance.')
+def _validate_run_args(parser, args):
+    """
+    Check the combinations of the options added by _add_run_options().
+    """
+    if args.resume and args.journal is None:
+        parser.error(message='argument --journal is required with --resume.')
+
+    if args.arrival != 'closed' and (args.arrival_rate is None or args.arrival_rate <= 0):
+        parser.error(message=f'a positive --arrival_rate is required with --arrival {args.arrival}.')
+
+    # The results of the processes are merged in start time order, which needs
+    # each process to run one query at a time.
+    if args.processes > 1 and (args.workers > 1 or args.tap_pipeline > 1 or args.arrival != 'closed'):
+        parser.error(message='argument --processes cannot be used with --workers, --tap_pipeline '
+                     'or --arrival.')
+
+    if args.per_host_limit is not None and args.per_host_limit < args.processes:
+        parser.error(message='argument --per_host_limit must be at least --processes, which share it.')
+
+    if args.ramp is not None and (args.processes > 1 or args.arrival != 'closed' or
+                                  args.engine != 'threads'):
+        parser.error(message='argument --ramp cannot be used with --processes, --arrival '
+                     'or --engine asyncio.')
+
+    if args.tap_pipeline > 1 and (args.engine != 'threads' or args.arrival != 'closed' or
+                                  args.ramp is not None):
+        parser.error(message='argument --tap_pipeline cannot be used with --engine asyncio, '
+                     '--arrival or --ramp.')
+
+    # The two queries of a pair must not overlap with other queries of the service.
+    if args.tap_mode == 'both' and (args.ramp is not None or args.tap_pipeline > 1 or args.workers > 1 or
+                                    args.engine != 'threads' or args.processes > 1 or
+                                    args.arrival != 'closed'):
+        parser.error(message='argument --tap_mode both cannot be used with --ramp, --tap_pipeline, '
+                     '--workers, --engine asyncio, --processes or --arrival.')
+
+
+def _int_list(value):
+    try:
+        values = [int(v) for v in value.split(',')]
+    except ValueError:
+        raise ArgumentTypeError(f'invalid comma-separated integers: {value!r}')
+    if not values or min(values) < 1:
+        raise ArgumentTypeError(f'values must be positive integers: {value!r}')
+    return values
+
+
+def _add_run_options(parser):
+    """
+    Add the options for how queries are run, which sm_query and sm_replay share.
+    """
+    parser.add_argument('--engine', dest='engine', choices=['threads', 'asyncio'], default='threads',
+                        help='How to run queries.  "threads" runs each query in a thread; '
+                        '"asyncio" runs them all in one event loop, which allows many more '
+                        'queries in flight and requires aiohttp (default=threads)')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Number of queries to keep in flight at once (default=1)',
+                        metavar='workers')
+    parser.add_argument('--per_host_limit', dest='per_host_limit', type=int, default=None,
+                        help='Maximum number of queries in flight for any one host.'
+                        '  Only relevant when --workers is greater than 1 (default=no limit)',
+                        metavar='per_host_limit')
+    parser.add_argument('--pool_size', dest='pool_size', type=int, default=10,
+                        help='Maximum number of keep-alive connections to each host.  With '
+                        '--engine asyncio, also the most connections open to each host at once '
+                        '(default=10)',
+                        metavar='pool_size')
+    parser.add_argument('--cold_connections', dest='cold_connections', action='store_true',
+                        help='Open a new connection for every request instead of reusing '
+                        'keep-alive connections, so each timing includes connection setup.')
+    parser.add_argument('--max_extra_durations', dest='max_extra_durations', type=int, default=8,
+                        help='Number of extra_dur name and value column pairs in each result.  '
+                        'Named durations beyond these are left out, TAP durations before '
+                        'connection phases (default=8)',
+                        metavar='max_extra_durations')
+    parser.add_argument('--digest', dest='digest', choices=sorted(hashlib.algorithms_guaranteed),
+                        default=None,
+                        help='Record a digest of each query result computed with this hash algorithm '
+                        '(default=None)')
+    parser.add_argument('--processes', dest='processes', type=int, default=1,
+                        help='Number of worker processes to split the cones across.  Each process '
+                        'runs its own share of the queries, and the results are merged in start '
+                        'time order (default=1)',
+                        metavar='processes')
+    parser.add_argument('--shard_by', dest='shard_by', choices=['range', 'round_robin'],
+                        default='range',
+                        help='How to split the cones across --processes: contiguous index ranges '
+                        'or round-robin (default=range)')
+    parser.add_argument('--journal', dest='journal', default=None,
+                        help='Record each completed (cone index, service) pair in this file, '
+                        'so that an interrupted run can be continued with --resume (default=None)',
+                        metavar='journal_file')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Skip the queries that the --journal file shows were completed.')
+    parser.add_argument('--host_max_qps', dest='host_max_qps', type=float, default=None,
+                        help='Maximum rate of queries started to any one host, in queries per '
+                        'second.  Services may also have their own max_qps (default=no limit)',
+                        metavar='host_max_qps')
+    parser.add_argument('--arrival', dest='arrival', choices=['closed', 'fixed', 'poisson'],
+                        default='closed',
+                        help='When to start queries.  "closed" starts each query when a worker '
+                        'is free.  "fixed" and "poisson" start them on a schedule at --arrival_rate, '
+                        'evenly spaced or with random gaps, whether or not earlier queries are done.  '
+                        'Rate limits do not apply to the scheduled modes (default=closed)')
+    parser.add_argument('--arrival_rate', dest='arrival_rate', type=float, default=None,
+                        help='Queries started per second for --arrival fixed or poisson',
+                        metavar='arrival_rate')
+    parser.add_argument('--arrival_seed', dest='arrival_seed', type=int, default=None,
+                        help='Random seed for a repeatable --arrival poisson schedule',
+                        metavar='arrival_seed')
+    parser.add_argument('--ramp', dest='ramp', type=_int_list, default=None,
+                        help='Comma-separated numbers of queries to keep in flight to each '
+                        'service in successive steps, e.g., 1,2,4,8,16.  The cones are cycled '
+                        'through for --step_duration seconds per step, each row is tagged with '
+                        'its step, and a throughput and latency summary is printed at the end',
+                        metavar='ramp')
+    parser.add_argument('--step_duration', dest='step_duration', type=float, default=300.0,
+                        help='Seconds per --ramp step (default=300)',
+                        metavar='step_duration')
+    parser.add_argument('--breaker_threshold', dest='breaker_threshold', type=int, default=0,
+                        help='Consecutive failed queries after which a service is skipped, with a '
+                        '"skipped: circuit open" row for each of its queries, until a probe query '
+                        'succeeds.  0 never skips a service.  Not used with --ramp (default=0)',
+                        metavar='breaker_threshold')
+    parser.add_argument('--breaker_backoff', dest='breaker_backoff', type=float, default=30.0,
+                        help='Seconds before the first probe of a skipped service.  The wait doubles '
+                        'after each failed probe (default=30)',
+                        metavar='breaker_backoff')
+    parser.add_argument('--breaker_max_backoff', dest='breaker_max_backoff', type=float, default=1800.0,
+                        help='Maximum seconds between probes of a skipped service (default=1800)',
+                        metavar='breaker_max_backoff')
+    parser.add_argument('--connect_timeout', dest='connect_timeout', type=float, default=30.0,
+                        help='Seconds allowed to make each connection, for services without their '
+                        'own connect_timeout (default=30)',
+                        metavar='connect_timeout')
+    parser.add_argument('--read_timeout', dest='read_timeout', type=float, default=60.0,
+                        help='Seconds allowed for each wait for data from a server, for services '
+                        'without their own read_timeout (default=60)',
+                        metavar='read_timeout')
+    parser.add_argument('--total_timeout', dest='total_timeout', type=float, default=None,
+                        help='Seconds allowed for each whole query, including reading the results, '
+                        'for services without their own total_timeout (default=no limit)',
+                        metavar='total_timeout')
+    parser.add_argument('--tap_pipeline', dest='tap_pipeline', type=int, default=1,
+                        help='Number of async TAP jobs, for the upcoming cones, to keep submitted '
+                        'at once.  They are all polled from one thread and each result is fetched '
+                        'as soon as its job finishes.  Queries of other kinds of service are run '
+                        'one at a time in between (default=1, no pipelining)',
+                        metavar='tap_pipeline')
+    parser.add_argument('--uws_pollers', dest='uws_pollers', type=int, default=4,
+                        help='Number of threads that poll all the outstanding async TAP jobs, '
+                        'so that neither threads nor idle connections grow with the number of '
+                        'jobs in flight.  0 has each query poll its own job (default=4)',
+                        metavar='uws_pollers')
+    parser.add_argument('--delete_jobs', dest='delete_jobs',
+                        choices=['background', 'inline', 'never'], default='background',
+                        help='What to do with each async TAP job once its query is done: delete it '
+                        'from background threads, off the timed path, delete it as part of the '
+                        'query, recording tap_delete in its stats, or leave it on the service '
+                        '(default=background)',
+                        metavar='delete_jobs')
+    parser.add_argument('--delete_workers', dest='delete_workers', type=int, default=2,
+                        help='Number of threads deleting async TAP jobs in the background, and so '
+                        'the most deletions in flight at once (default=2)',
+                        metavar='delete_workers')
+    parser.add_argument('--writer_queue', dest='writer_queue', type=int, default=1000,
+                        help='Number of results that may wait for each writer, which is given them '
+                        'from a thread of its own so that slow writers do not delay the queries.  '
+                        '0 has the writers called in turn between queries (default=1000)',
+                        metavar='writer_queue')
+    parser.add_argument('--writer_overflow', dest='writer_overflow', choices=OVERFLOW_POLICIES,
+                        default='block',
+                        help="What to do with a result for a writer whose queue is full: wait for "
+                        "room, drop the oldest result queued, or spill it to a file in the result "
+                        "directory to be written later (default=block)",
+                        metavar='writer_overflow')
+    parser.add_argument('--pair_order', dest='pair_order', choices=['fixed', 'random'],
+                        default='fixed',
+                        help='With --tap_mode both, the order in which the two queries of each '
+                        'pair are run: sync then async, or a random order for each pair '
+                        '(default=fixed)',
+                        metavar='pair_order')
+    parser.add_argument('--pair_seed', dest='pair_seed', type=int, default=None,
+                        help='Seed for the random order of the pairs, for a repeatable run '
+                        '(default=None)',
+                        metavar='pair_seed')
+
+
+def _create_query_argparser(description='Measure query performance.',
+                            positional=('services', 'File containing list of services to query')):
+    parser = ArgumentParser(description=description)
 
     # Add positional args.
-    parser.add_argument(
-        'services', help='File containing list of services to query')
+    parser.add_argument(positional[0], help=positional[1])
 
     # Add general args.
     parser.add_argument('-r', '--result_dir', dest='result_dir', default='results',
@@ -367,8 +1110,10 @@ def _create_query_argparser():
                         'the query result file will be deleted after metadata is gathered '
                         'for the query.')
     parser.add_argument('-t', '--tap_mode', dest='tap_mode',
-                        choices={'sync', 'async'}, default='async',
-                        help='How to run TAP queries (default=async)')
+                        choices={'sync', 'async', 'both'}, default='async',
+                        help='How to run TAP queries.  both runs each TAP query twice, '
+                        'once sync and once async, with the pair linked by their pair_id '
+                        '(default=async)')
     parser.add_argument('-u', '--user_agent', dest='user_agent',
                         default=None,
                         help='Override the User-Agent used for queries (default=None)')
@@ -378,6 +1123,7 @@ def _create_query_argparser():
     parser.add_argument('-v', '--verbose', dest='verbose',
                         action='store_true',
                         help='Print additional information to stderr')
+    _add_run_options(parser)
 
     # Add cone arguments.
     cone_types = parser.add_mutually_exclusive_group()
@@ -435,8 +1181,10 @@ def _create_replay_argparser():
                         'the query result file will be deleted after metadata is gathered '
                         'for the query.')
     parser.add_argument('-t', '--tap_mode', dest='tap_mode',
-                        choices={'sync', 'async'}, default='async',
-                        help='How to run TAP queries (default=async)')
+                        choices={'sync', 'async', 'both'}, default='async',
+                        help='How to run TAP queries.  both runs each TAP query twice, '
+                        'once sync and once async, with the pair linked by their pair_id '
+                        '(default=async)')
     parser.add_argument('-u', '--user_agent', dest='user_agent',
                         default=None,
                         help='Override the User-Agent used for queries (default=None)')
@@ -446,6 +1194,7 @@ def _create_replay_argparser():
     parser.add_argument('-v', '--verbose', dest='verbose',
                         action='store_true',
                         help='Print additional information to stderr')
+    _add_run_options(parser)
 
     # Add cone arguments.
     parser.add_argument(
@@ -463,15 +1212,13 @@ def _create_replay_argparser():
 def receiveSignal(signalNumber, frame):
     now = datetime.now()
     dtstr = now.strftime('%Y-%m-%d %H:%M:%S.%f')
-    logging.warning(f'Received signal {signalNumber} at {dtstr}', file=sys.stderr,
-                    flush=True)
+    logging.warning(f'Received signal {signalNumber} at {dtstr}')
 
 
 def receiveSIGTERM(signalNumber, frame):
     now = datetime.now()
     dtstr = now.strftime('%Y-%m-%d %H:%M:%S.%f')
-    logging.warning(f'Received signal {signalNumber} at {dtstr}', file=sys.stderr,
-                    flush=True)
+    logging.warning(f'Received signal {signalNumber} at {dtstr}')
     faulthandler.dump_traceback()
 
 
@@ -1,12 +1,83 @@
 import time
 from datetime import datetime
 
+# The format of the start_time, end_time and intended_start_time values.
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+_TIMESTAMP_COLUMNS = {'start_time', 'end_time', 'intended_start_time'}
+_FLOAT_COLUMNS = {'do_query_dur', 'stream_to_file_dur', 'query_total_dur', 'RA', 'DEC', 'SR'}
+_INT_COLUMNS = {'size', 'num_rows', 'num_columns', 'ramp_step', 'ramp_concurrency', 'pair_position'}
+_CATEGORY_COLUMNS = {'base_name', 'service_type', 'status', 'query_status'}
+
+
+def column_kind(name):
+    """
+    The kind of value in the stats column called name, for writers that store
+    typed columns: 'timestamp' for the times formatted with TIME_FORMAT,
+    'float' for the durations and cone coordinates, 'int' for counts,
+    'category' for strings from a small set of values, such as the service
+    type or the names of the extra durations, and 'string' for anything else.
+    """
+    if name in _TIMESTAMP_COLUMNS:
+        return 'timestamp'
+    if name in _FLOAT_COLUMNS or (name.startswith('extra_dur') and name.endswith('_value')):
+        return 'float'
+    if name in _INT_COLUMNS:
+        return 'int'
+    if name in _CATEGORY_COLUMNS or (name.startswith('extra_dur') and name.endswith('_name')):
+        return 'category'
+    return 'string'
+
+
+def column_converter(kind):
+    """
+    A function that converts a stats value to the Python type for a column of
+    the given `column_kind`: datetime, float, int or str.  Missing values, and
+    values that cannot be converted, such as an empty RA, become None.
+    """
+    return _CONVERTERS[kind]
+
+
+def _to_timestamp(val):
+    if val is None or val == '':
+        return None
+    if isinstance(val, datetime):
+        return val
+    return datetime.strptime(val, TIME_FORMAT)
+
+
+def _to_float(val):
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(val):
+    try:
+        return int(val)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_string(val):
+    return None if val is None else str(val)
+
+
+_CONVERTERS = {
+    'timestamp': _to_timestamp,
+    'float': _to_float,
+    'int': _to_int,
+    'category': _to_string,
+    'string': _to_string,
+}
+
 
 class QueryStats():
     """
     """
     def __init__(self, name, base_name, service_type, access_url, query_params,
-                 result_meta_fields, max_extra_durations=8):
+                 result_meta_fields, max_extra_durations=8, tags=None, scheduled=False):
 
         # First save the params needed to define the result structure.
         self._query_params = self._organize_params(query_params)
@@ -14,6 +85,13 @@ class QueryStats():
         self._max_extra_durations = max_extra_durations
         self._result_meta = dict.fromkeys(result_meta_fields)
 
+        # Extra columns with fixed values, e.g., identifying the step of a ramp.
+        self._tags = dict(tags) if tags else {}
+
+        # Only queries started on an arrival schedule have an intended_start_time
+        # column, so that the other rows keep their usual columns.
+        self._scheduled = scheduled
+
         self._vals = dict.fromkeys(self.columns())
 
         self._vals['name'] = name
@@ -25,6 +103,7 @@ class QueryStats():
         self._query_params = self._organize_params(query_params)
         self._vals.update(self._query_params)  # Add the query_params values.
         self._vals.update(self._result_meta)  # Add the result metadata values.
+        self._vals.update(self._tags)
 
         self._num_extra_durations = 0
 
@@ -36,18 +115,33 @@ class QueryStats():
         self._vals[f'extra_dur{self._num_extra_durations}_value'] = duration
         self._num_extra_durations += 1
 
-    def mark_start_time(self):
-        now = datetime.fromtimestamp(time.time())
-        self._vals['start_time'] = now.strftime('%Y-%m-%d %H:%M:%S.%f')
+    def mark_start_time(self, intended=None):
+        """
+        Record the start time as now.  intended is the time.time() at which the
+        query was scheduled to start, if it was scheduled; otherwise the intended
+        start time is the start time.  It is only recorded if the stats were
+        made with scheduled=True.
+        """
+        now = time.time()
+        self._vals['start_time'] = self._format_time(now)
+        if self._scheduled:
+            self._vals['intended_start_time'] = self._format_time(now if intended is None else intended)
 
     def mark_end_time(self):
-        now = datetime.fromtimestamp(time.time())
-        self._vals['end_time'] = now.strftime('%Y-%m-%d %H:%M:%S.%f')
+        self._vals['end_time'] = self._format_time(time.time())
+
+    @staticmethod
+    def _format_time(t):
+        return datetime.fromtimestamp(t).strftime(TIME_FORMAT)
 
     @property
     def result_meta(self):
         return self._result_meta
 
+    @property
+    def tags(self):
+        return self._tags
+
     @property
     def do_query_dur(self):
         return self._vals['do_query_dur']
@@ -87,8 +181,10 @@ class QueryStats():
             self._vals[key] = value.get(key)
 
     def columns(self):
-        cols = ['name', 'start_time', 'end_time',
-                'do_query_dur', 'stream_to_file_dur', 'query_total_dur']
+        cols = ['name', 'start_time', 'end_time']
+        if self._scheduled:
+            cols.append('intended_start_time')
+        cols.extend(['do_query_dur', 'stream_to_file_dur', 'query_total_dur'])
         for i in range(0, self._max_extra_durations):
             cols.append(f'extra_dur{i}_name')
             cols.append(f'extra_dur{i}_value')
@@ -102,6 +198,7 @@ class QueryStats():
         cols.append('access_url')
         cols.append('errmsg')
         cols.extend(list(self.result_meta.keys()))
+        cols.extend(list(self._tags.keys()))
         return cols
 
     def row_values(self):
@@ -0,0 +1,112 @@
+import time
+from contextlib import ContextDecorator, contextmanager
+from contextvars import ContextVar
+
+from .timing_labels import TAP_SERVER_QUEUED, TAP_SERVER_EXEC
+
+__all__ = ['QueryTimings', 'timed', 'current_timings', 'record_duration', 'record_uws_times']
+
+_current_timings = ContextVar('servicemon_query_timings', default=None)
+
+
+class QueryTimings():
+    """
+    The named durations measured for a single query.
+
+    A QueryTimings object is made current with `activate`.  While it is current,
+    every `timed` block in the same thread (or asyncio task) adds its duration
+    to it, so queries running at the same time do not share timings.
+    """
+
+    def __init__(self):
+        self._durations = {}
+
+    def add(self, name, duration):
+        """
+        Add duration (seconds) to the named duration.  As with codetiming,
+        repeated timings with the same name accumulate.
+        """
+        self._durations[name] = self._durations.get(name, 0.0) + duration
+
+    def get(self, name, default=None):
+        return self._durations.get(name, default)
+
+    def __contains__(self, name):
+        return name in self._durations
+
+    def items(self):
+        return self._durations.items()
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this the current QueryTimings for the duration of the with block.
+        """
+        token = _current_timings.set(self)
+        try:
+            yield self
+        finally:
+            _current_timings.reset(token)
+
+
+def current_timings():
+    """
+    Return the QueryTimings that is current in this context, or None.
+    """
+    return _current_timings.get()
+
+
+def record_duration(name, duration):
+    """
+    Add an already measured duration to the current QueryTimings, if any.
+    """
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(name, duration)
+
+
+def record_uws_times(job):
+    """
+    Add the server-side phases of a finished UWS job to the current QueryTimings:
+    the time the job was queued, from its creationTime to its startTime, and the
+    time it was executing, from its startTime to its endTime.
+
+    job is a job document as parsed by `pyvo.io.uws.parse_job`.  Phases whose
+    times the service did not give are not recorded.  The job's
+    executionDuration is not used, since it is the limit on how long the job
+    may run rather than how long it ran.
+    """
+    creation = getattr(job, 'creationtime', None)
+    start = getattr(job, 'starttime', None)
+    end = getattr(job, 'endtime', None)
+    for name, begin, finish in ((TAP_SERVER_QUEUED, creation, start),
+                                (TAP_SERVER_EXEC, start, end)):
+        if begin is not None and finish is not None:
+            duration = (finish - begin).sec
+            if duration >= 0:
+                record_duration(name, duration)
+
+
+class timed(ContextDecorator):
+    """
+    Context manager and decorator that adds the elapsed time of its block
+    to the current QueryTimings under the given name.  Nothing is recorded
+    when no QueryTimings is current.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._start = None
+
+    def _recreate_cm(self):
+        # Decorated functions may run in several threads at once,
+        # so give each call its own start time.
+        return type(self)(self.name)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_duration(self.name, time.perf_counter() - self._start)
+        return False
@@ -0,0 +1,153 @@
+"""
+A concurrency ramp, selected with ``sm_query --ramp 1,2,4,8,16``, for finding
+the concurrency at which each service stops scaling.
+
+The ramp runs in steps of ``--step_duration`` seconds.  In each step, every
+service is queried with the step's number of queries kept in flight, cycling
+through the selected cones as needed.  When a step's time is up, no new queries
+are started, and the next step begins once the step's queries are done.  Each
+stats row is tagged with its step, and a summary of the throughput and latency
+percentiles of each service at each step is printed at the end.
+"""
+import sys
+import time
+import itertools
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from astropy.table import Table
+
+__all__ = ['RampRunner', 'ramp_summary']
+
+
+class RampRunner():
+    """
+    Runs the concurrency ramp for a QueryRunner.
+
+    Parameters
+    ----------
+    runner : QueryRunner
+        The runner whose services, cones and writers are used.
+    ramp : list of int
+        The number of queries in flight per service in each step.
+    step_duration : float
+        Seconds during which new queries are started in each step.
+    out : file or None
+        Where the summary table is printed, sys.stdout if None.
+    """
+
+    def __init__(self, runner, ramp, step_duration, out=None):
+        self._runner = runner
+        self._ramp = ramp
+        self._step_duration = step_duration
+        self._out = out if out is not None else sys.stdout
+        self._results = []  # (service base_name, step, concurrency, elapsed, stats row)
+
+        # Select the cones once, as random ones come from a generator, so that
+        # every service and step cycles through the same ones.
+        self._cones = None
+        if runner._cones is not None:
+            self._cones = list(runner._selected(runner._cones))
+
+    def run(self):
+        runner = self._runner
+        services = list(runner._services)
+        with ThreadPoolExecutor(max_workers=max(self._ramp) * max(1, len(services)),
+                                thread_name_prefix='sm_ramp') as executor:
+            for step, concurrency in enumerate(self._ramp):
+                self._run_step(executor, services, step, concurrency)
+
+        summary = ramp_summary(self._results)
+        print('\n'.join(summary.pformat_all()), file=self._out)
+        return summary
+
+    def _run_step(self, executor, services, step, concurrency):
+        runner = self._runner
+        tags = {'ramp_step': step, 'ramp_concurrency': concurrency}
+        task_iters = [self._tasks_for(service) for service in services]
+        in_flight = {}
+
+        def submit(service_index):
+            task = next(task_iters[service_index], None)
+            if task is None:
+                return
+            future = executor.submit(runner._run_query, *task, tags=tags)
+            in_flight[future] = (service_index, task)
+
+        start = time.monotonic()
+        end = start + self._step_duration
+        for service_index in range(len(services)):
+            for _ in range(concurrency):
+                submit(service_index)
+
+        step_rows = []
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                service_index, task = in_flight.pop(future)
+                query = future.result()
+                runner._finish_task(task, query)
+                if query is not None:
+                    step_rows.append((runner.getval(services[service_index], 'base_name', 'Unnamed'),
+                                      query.stats.row_values()))
+                if time.monotonic() < end:
+                    submit(service_index)
+
+        elapsed = time.monotonic() - start
+        self._results.extend((name, step, concurrency, elapsed, row) for name, row in step_rows)
+
+    def _tasks_for(self, service):
+        """
+        Endlessly cycle through the (index, cone, service) tasks for service.
+        """
+        if self._cones is not None:
+            return itertools.cycle([(index, cone, service) for index, cone in self._cones])  # Empty if no cones.
+        return itertools.repeat((0, None, service))
+
+
+def ramp_summary(results):
+    """
+    Summarize the ramp results as a Table with one row per service and step.
+
+    Parameters
+    ----------
+    results : list
+        (base_name, step, concurrency, step elapsed seconds, stats row values) tuples.
+
+    Returns
+    -------
+    `~astropy.table.Table`
+        With columns base_name, step, concurrency, queries, errors, throughput
+        (queries per second over the step) and the p50, p95 and p99 of
+        query_total_dur, in seconds.
+    """
+    groups = {}
+    for base_name, step, concurrency, elapsed, row in results:
+        group = groups.setdefault((base_name, step), {'concurrency': concurrency, 'elapsed': elapsed,
+                                                      'queries': 0, 'durs': [], 'errors': 0})
+        group['queries'] += 1
+        dur = row.get('query_total_dur')
+        if dur is not None:
+            group['durs'].append(dur)
+        if row.get('errmsg', ':') != ':':
+            group['errors'] += 1
+
+    rows = []
+    for (base_name, step), group in sorted(groups.items()):
+        durs = np.array(group['durs'], dtype=float)
+        if len(durs):
+            p50, p95, p99 = np.percentile(durs, [50, 95, 99])
+        else:
+            p50 = p95 = p99 = np.nan
+        rows.append((base_name, step, group['concurrency'], group['queries'], group['errors'],
+                     group['queries'] / group['elapsed'] if group['elapsed'] > 0 else np.nan,
+                     p50, p95, p99))
+
+    table = Table(rows=rows if rows else None,
+                  names=('base_name', 'step', 'concurrency', 'queries', 'errors',
+                         'throughput', 'p50', 'p95', 'p99'),
+                  dtype=(str, int, int, int, int, float, float, float, float))
+    for col in ('throughput', 'p50', 'p95', 'p99'):
+        table[col].format = '.3f'
+    return table
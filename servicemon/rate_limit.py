@@ -0,0 +1,120 @@
+"""
+Token-bucket rate limits on how often queries are started.
+"""
+import time
+
+__all__ = ['TokenBucket', 'RateLimiter']
+
+
+class TokenBucket():
+    """
+    A token bucket that refills at rate tokens per second, holding at most
+    burst tokens.  Each query start takes one token.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second, i.e., the sustained queries per second.
+    burst : int
+        Capacity of the bucket.  With the default of 1, starts are evenly
+        spaced 1/rate seconds apart.
+    clock : callable
+        Returns the current time in seconds.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError(f'Rate must be positive: {rate}')
+        self._interval = 1.0 / rate
+        self._tolerance = (burst - 1) * self._interval
+        self._clock = clock
+
+        # The time at which the bucket would be full again.
+        self._full_at = None
+
+    def delay(self):
+        """
+        Seconds until a token will be available, 0 if one is available now.
+        """
+        if self._full_at is None:
+            return 0.0
+        return max(0.0, self._full_at - self._tolerance - self._clock())
+
+    def take(self):
+        """
+        Take a token, whether or not one is available.
+        """
+        now = self._clock()
+        if self._full_at is None or self._full_at < now:
+            self._full_at = now
+        self._full_at += self._interval
+
+
+class RateLimiter():
+    """
+    The per-service and per-host token buckets consulted before each query
+    is started.
+
+    Parameters
+    ----------
+    host_of : callable
+        Returns the host for a service.
+    key_of : callable
+        Returns a key identifying a service.
+    max_qps_of : callable
+        Returns the maximum queries per second for a service, or None.
+    host_max_qps : float or None
+        Maximum queries per second to each host, or None for no limit.
+    scale : float
+        Multiplies all the rates, e.g., to share them between processes.
+    clock : callable
+        Returns the current time in seconds.
+    """
+
+    def __init__(self, host_of, key_of, max_qps_of, host_max_qps=None, scale=1.0,
+                 clock=time.monotonic):
+        self._host_of = host_of
+        self._key_of = key_of
+        self._max_qps_of = max_qps_of
+        self._host_max_qps = host_max_qps
+        self._scale = scale
+        self._clock = clock
+        self._service_buckets = {}
+        self._host_buckets = {}
+
+    def bucket_key(self, service):
+        """
+        A key that is the same for services sharing the same buckets.
+        """
+        return (self._host_of(service), self._key_of(service))
+
+    def delay(self, service):
+        """
+        Seconds until a query of service may start, 0 if it may start now.
+        """
+        return max([0.0] + [bucket.delay() for bucket in self._buckets(service)])
+
+    def take(self, service):
+        """
+        Record that a query of service is starting.
+        """
+        for bucket in self._buckets(service):
+            bucket.take()
+
+    def _buckets(self, service):
+        buckets = []
+        max_qps = self._max_qps_of(service)
+        if max_qps is not None:
+            key = self._key_of(service)
+            if key not in self._service_buckets:
+                self._service_buckets[key] = TokenBucket(float(max_qps) * self._scale,
+                                                         clock=self._clock)
+            buckets.append(self._service_buckets[key])
+
+        if self._host_max_qps is not None:
+            host = self._host_of(service)
+            if host not in self._host_buckets:
+                self._host_buckets[host] = TokenBucket(self._host_max_qps * self._scale,
+                                                       clock=self._clock)
+            buckets.append(self._host_buckets[host])
+        return buckets
@@ -0,0 +1,192 @@
+"""
+The sm_run_all command, which times all the services found in an input
+directory tree in a single process.
+
+Each subdirectory of the input directory (typically one per service provider)
+is a lane.  The lanes run in parallel with each other, while the service files
+within a lane are run one after another, so no provider sees more than one
+service file's queries at a time.  The cones and all the service files are
+loaded once at the start, and the results of every lane go to one shared set
+of writers.
+"""
+import copy
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from .cone import Cone
+from .journal import ProgressJournal
+from .plugin_support import SmPluginSupport, AbstractResultWriter
+from .query_runner import (QueryRunner, _create_query_argparser, _parse_query,
+                           _init_logging, _print_arg_info)
+
+__all__ = ['RunAll', 'sm_run_all']
+
+
+class RunAll():
+    """
+    Runs the service files found in the subdirectories of args.input_dir.
+
+    args is the Namespace returned by the sm_run_all argument parser, which
+    has the sm_query arguments with input_dir in place of services, plus
+    script_output_dir and max_lanes.
+    """
+
+    def __init__(self, args):
+        self._args = args
+        self._lanes = self._find_lanes(args.input_dir)
+        self._cones = QueryRunner._read_if_file(args.cone_file)
+
+        self._writers = []
+        self._writer_lock = threading.Lock()
+        self._journal = None
+
+    @property
+    def lanes(self):
+        """
+        Dict of lane name to a list of (service file path, services) tuples.
+        """
+        return self._lanes
+
+    def run(self):
+        self._begin_writers()
+        if self._args.journal is not None:
+            self._journal = ProgressJournal(self._args.journal)
+
+        max_lanes = self._args.max_lanes or max(1, len(self._lanes))
+        with ThreadPoolExecutor(max_workers=max_lanes, thread_name_prefix='sm_lane') as executor:
+            for future in [executor.submit(self._run_lane, name, files)
+                           for name, files in self._lanes.items()]:
+                future.result()
+
+        if self._journal is not None:
+            self._journal.close()
+        for w in self._writers:
+            w.end()
+
+    def _run_lane(self, name, files):
+        for path, services in files:
+            logging.info(f'Lane {name}: starting {path}')
+            args = copy.copy(self._args)
+            args.services = services
+            args.cone_file = self._cones
+            try:
+                runner = QueryRunner(args, writers=[_LaneWriter(self)], journal=self._journal)
+                runner.run()
+            except Exception as e:
+                logging.error(f'Lane {name}: error running {path}: {repr(e)}')
+            logging.info(f'Lane {name}: finished {path}')
+
+    def _one_result(self, stats):
+        with self._writer_lock:
+            for w in self._writers:
+                w.one_result(stats)
+
+    def _begin_writers(self):
+        args = self._args
+        SmPluginSupport.load_builtin_plugins()
+        if args.load_plugins is None:
+            SmPluginSupport.load_plugins()
+        else:
+            SmPluginSupport.load_plugins(plugins=args.load_plugins)
+
+        # Writers that name their output after the services file
+        # get the input directory instead.
+        writer_args = copy.copy(args)
+        writer_args.services = args.input_dir
+
+        now = datetime.now()
+        for spec in args.writers:
+            wdesc = AbstractResultWriter.get_plugin_from_spec(now.strftime(spec))
+            w = wdesc.cls()
+            w.begin(writer_args, **wdesc.kwargs)
+            self._writers.append(w)
+
+    @staticmethod
+    def _find_lanes(input_dir):
+        lanes = {}
+        for sub_dir in sorted(Path(input_dir).iterdir()):
+            if sub_dir.is_dir():
+                files = [(str(path), QueryRunner._read_if_file(str(path)))
+                         for path in sorted(sub_dir.glob('*.py'))]
+                if files:
+                    lanes[sub_dir.name] = files
+        return lanes
+
+
+class _LaneWriter():
+    """
+    The writer given to each lane's QueryRunner, passing results to the
+    shared writers, which are begun and ended by RunAll itself.
+    """
+
+    def __init__(self, run_all):
+        self._run_all = run_all
+
+    def begin(self, args, **kwargs):
+        pass
+
+    def one_result(self, stats):
+        self._run_all._one_result(stats)
+
+    def end(self):
+        pass
+
+
+def sm_run_all(input_args=None):
+
+    args = _parse_run_all(input_args)
+
+    _init_logging(args)
+    if args.script_output_dir is not None:
+        _log_to_dir(args.script_output_dir)
+    _print_arg_info(args)
+
+    # Generate the cones once so that every service gets the same ones.
+    if args.cone_file is None:
+        args.cone_file = list(Cone.generate_random(args.num_cones, args.min_radius, args.max_radius))
+
+    RunAll(args).run()
+
+
+def _log_to_dir(script_output_dir):
+    """
+    Also log the progress of the lanes, and anything logged by the queries,
+    to a file in script_output_dir.
+    """
+    Path(script_output_dir).mkdir(parents=True, exist_ok=True)
+    dtstr = datetime.now().strftime('%Y-%m-%d-%H-%M')
+    handler = logging.FileHandler(Path(script_output_dir) / f'sm_run_all-{dtstr}_runlog.txt')
+    handler.setFormatter(logging.Formatter('%(levelname)s: (%(asctime)s) [%(threadName)s]    %(message)s',
+                                           datefmt='%Y-%m-%d %H:%M:%S'))
+
+    # Keep the existing handlers at their level while the file gets INFO too.
+    root = logging.getLogger()
+    for h in root.handlers:
+        h.setLevel(root.level)
+    root.addHandler(handler)
+    root.setLevel(min(root.level, logging.INFO))
+
+
+def _parse_run_all(input_args):
+    parser = _create_query_argparser(
+        description='Measure performance on all the specified services in the input_dir directory tree.',
+        positional=('input_dir', 'Directory tree containing the input specifications.  Each '
+                    'subdirectory is run in parallel with the others, with its service files '
+                    'run one after another.'))
+    parser.add_argument('-o', '--script_output_dir', dest='script_output_dir', default=None,
+                        help='The directory in which to write a log of the run.  '
+                        'If not specified, the log only goes to stderr.',
+                        metavar='script_output_dir')
+    parser.add_argument('--max_lanes', dest='max_lanes', type=int, default=None,
+                        help='Maximum number of input subdirectories to run at once '
+                        '(default=all of them)',
+                        metavar='max_lanes')
+
+    args = _parse_query(input_args, parser=parser)
+    if not Path(args.input_dir).is_dir():
+        parser.error(message=f'input_dir {args.input_dir} is not a directory.')
+    return args
@@ -0,0 +1,100 @@
+import threading
+from urllib.parse import urlparse
+
+import requests
+
+from .timed_adapter import TimedHTTPAdapter
+
+__all__ = ['SessionPool']
+
+
+class SessionPool():
+    """
+    Hands out one keep-alive `requests.Session` per host so that all the
+    queries in a run can reuse connections instead of paying for a DNS lookup,
+    TCP connect and TLS handshake on every query.
+
+    Parameters
+    ----------
+    pool_size : int
+        Maximum number of connections kept open to each host.
+    cold : bool
+        If True, every call to `get` returns a new session that closes its
+        connections after each request, so every request pays the full
+        connection setup cost.  Each such session should be given back with
+        `release` once its responses have been read.
+    agent : str
+        If not None, the User-Agent header sent with every request.
+    """
+
+    def __init__(self, pool_size=10, cold=False, agent=None):
+        self._pool_size = pool_size
+        self._cold = cold
+        self._agent = agent
+        self._sessions = {}
+        self._cold_sessions = set()
+        self._lock = threading.Lock()
+
+    @property
+    def pool_size(self):
+        return self._pool_size
+
+    @property
+    def cold(self):
+        return self._cold
+
+    def get(self, url):
+        """
+        Return the session to use for requests to the host in url.
+        """
+        if self._cold:
+            session = self._new_session()
+            with self._lock:
+                self._cold_sessions.add(session)
+            return session
+
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._new_session()
+                self._sessions[key] = session
+        return session
+
+    def release(self, session):
+        """
+        Give back a session from `get` that is no longer needed.  A cold
+        session is closed; a pooled one stays open for the next query.
+        """
+        with self._lock:
+            if session not in self._cold_sessions:
+                return
+            self._cold_sessions.discard(session)
+        session.close()
+
+    def close(self):
+        """
+        Close all the pooled sessions and their connections, and any cold
+        sessions not yet released.
+        """
+        with self._lock:
+            sessions = list(self._sessions.values()) + list(self._cold_sessions)
+            self._sessions.clear()
+            self._cold_sessions.clear()
+        for session in sessions:
+            session.close()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = self._new_adapter()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self._agent is not None:
+            session.headers['User-Agent'] = self._agent
+        if self._cold:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def _new_adapter(self):
+        return TimedHTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
@@ -0,0 +1,190 @@
+"""
+Run a QueryRunner's queries in several worker processes, selected with
+``sm_query --processes N``.
+
+The cones (or, without cones, the services) selected by ``--start_index`` and
+``--cone_limit`` are split into one shard per process, either as contiguous
+index ranges or round-robin.  Each process runs its own QueryRunner over its
+shard and sends the stats of each query back to the parent process, where the
+streams are merged in start time order and given to the configured writers.
+With ``--journal``, the parent records each query once its stats are written.
+"""
+import copy
+import functools
+import heapq
+import logging
+import multiprocessing
+import queue
+from concurrent.futures import Future
+
+from .journal import read_completed
+
+__all__ = ['ShardPool']
+
+
+class ShardPool():
+    """
+    Runs the queries of a QueryRunner in worker processes, one shard each.
+
+    Parameters
+    ----------
+    runner : QueryRunner
+        The runner whose args select the work and whose writers receive the stats.
+    processes : int
+        Number of worker processes.
+    """
+
+    def __init__(self, runner, processes):
+        self._runner = runner
+        self._processes = processes
+
+    def run(self):
+        ctx = multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+
+        args = copy.copy(self._runner._args)
+        args.processes = 1
+        # Random cones come as a generator, which cannot be sent to the shards,
+        # and every shard must select from the same cones.
+        if self._runner._cones is not None:
+            args.cone_file = list(self._runner._cones)
+
+        procs = [ctx.Process(target=_run_shard, args=(args, (i, self._processes), results),
+                             name=f'sm_query-shard{i}')
+                 for i in range(self._processes)]
+        for p in procs:
+            p.start()
+
+        self._merge(results, procs)
+
+        for p in procs:
+            p.join()
+
+    def _merge(self, results, procs):
+        """
+        Pass the stats from the shards to the runner in start time order.  A row is
+        only passed on once every unfinished shard has sent a later one, so each
+        shard's rows must arrive in the order their queries started, as they do
+        when each shard runs one query at a time.
+        """
+        heap = []
+        buffered = [0] * len(procs)
+        latest = [None] * len(procs)
+        running = set(range(len(procs)))
+        seq = 0
+
+        while running:
+            try:
+                shard, kind, value = results.get(timeout=1)
+            except queue.Empty:
+                for i in list(running):
+                    if procs[i].exitcode not in (None, 0):
+                        logging.error(f'Shard {i} exited with code {procs[i].exitcode}.')
+                        running.discard(i)
+            else:
+                if kind == 'end':
+                    running.discard(shard)
+                elif kind == 'stats':
+                    start_time = value.row_values().get('start_time') or ''
+                    # [start_time, seq, shard, stats, journal entries, emitted, written]
+                    entry = [start_time, seq, shard, value, [], False, None]
+                    heapq.heappush(heap, entry)
+                    latest[shard] = entry
+                    buffered[shard] += 1
+                    seq += 1
+                elif kind == 'progress':
+                    # This follows the stats of the same task.
+                    entry = latest[shard]
+                    if entry is not None and not entry[5]:
+                        entry[4].append(value)
+                    elif entry is not None:
+                        self._record_when_written(entry[6], value)
+                    else:
+                        self._record(value)
+
+            while heap and all(buffered[i] for i in running):
+                self._emit(heap, buffered)
+
+        while heap:
+            self._emit(heap, buffered)
+
+    def _emit(self, heap, buffered):
+        entry = heapq.heappop(heap)
+        _, _, shard, stats, progress, _, _ = entry
+        entry[5] = True
+        buffered[shard] -= 1
+        try:
+            entry[6] = self._runner._collect_stats(stats)
+        except Exception as e:
+            logging.error(f'Unable to write stats from shard {shard}: {repr(e)}')
+            # Progress for these stats arriving later is not recorded either.
+            entry[6] = Future()
+            entry[6].set_exception(e)
+            return
+        for value in progress:
+            self._record_when_written(entry[6], value)
+
+    def _record_when_written(self, written, value):
+        self._runner._when_written(written, functools.partial(self._record, value))
+
+    def _record(self, value):
+        journal = self._runner._journal
+        if journal is not None:
+            journal.record(*value)
+
+
+class _QueueWriter():
+    """
+    A result writer for a shard's runner that sends each result to the parent.
+    """
+
+    def __init__(self, shard_index, results):
+        self._shard_index = shard_index
+        self._results = results
+
+    def begin(self, args, **kwargs):
+        pass
+
+    def one_result(self, stats):
+        self._results.put((self._shard_index, 'stats', stats))
+
+    def end(self):
+        pass
+
+
+class _ShardJournal():
+    """
+    A journal for a shard's runner.  Completed queries are looked up in the
+    journal as it was when the run started, and new ones are sent to the
+    parent to be recorded once their stats have been written.
+    """
+
+    def __init__(self, shard_index, results, completed):
+        self._shard_index = shard_index
+        self._results = results
+        self._completed = completed
+
+    def is_completed(self, cone_index, service_key):
+        return (cone_index, service_key) in self._completed
+
+    def record(self, cone_index, service_key):
+        self._results.put((self._shard_index, 'progress', (cone_index, service_key)))
+
+    def close(self):
+        pass
+
+
+def _run_shard(args, shard, results):
+    # Deferred import to avoid a circular import.
+    from .query_runner import QueryRunner
+
+    try:
+        journal = None
+        journal_path = getattr(args, 'journal', None)
+        if journal_path is not None:
+            journal = _ShardJournal(shard[0], results, read_completed(journal_path))
+        runner = QueryRunner(args, writers=[_QueueWriter(shard[0], results)], shard=shard,
+                             journal=journal)
+        runner.run()
+    finally:
+        results.put((shard[0], 'end', None))
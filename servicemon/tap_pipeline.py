@@ -0,0 +1,218 @@
+"""
+Pipelined async TAP queries, selected with ``sm_query --tap_pipeline K``.
+
+Normally each async TAP query submits its UWS job and then waits for it to
+finish before the next query starts, so most of the time is spent idle while
+the service queues and runs the job.  The pipeline instead keeps up to K jobs
+submitted at once, for the upcoming cones, and has them all polled by a shared
+`~servicemon.uws_poller.UwsPoller`.  Each job's result is fetched as soon as it
+finishes, and the next job is then submitted in its place.
+
+Every query still records its own tap_submit, tap_run, tap_wait and
+tap_fetch_response durations.  tap_wait runs from when the job was started
+until the poller saw that it had finished, and do_query and query_total also
+include the time the finished job waited for its result to be fetched.
+"""
+import queue
+import time
+from contextlib import contextmanager
+
+from .deadline import is_timeout
+from .pyvo_wrappers import TAPServiceSM
+from .query import Query
+from .timing_labels import QUERY_TOTAL, DO_QUERY, TAP_WAIT
+from .uws_poller import UwsPoller
+
+__all__ = ['PipelinedQuery', 'TapPipeline']
+
+
+class PipelinedQuery(Query):
+    """
+    An async TAP Query run in steps: `submit`, then `watch` until the job has
+    finished, then `finish`.  Errors are recorded in the stats, as by
+    `~servicemon.query.Query.run`, and end the query.
+
+    Parameters
+    ----------
+    async_total_timeout : float
+        Seconds the job may take, from when it is started, before the query
+        times out.
+
+    All other arguments are those of `~servicemon.query.Query`.
+    """
+
+    def __init__(self, *args, async_total_timeout=120, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_total_timeout = async_total_timeout
+        self._job = None
+        self._tap_service = None
+        self._started = None
+        self._running = None
+        self._finished = None
+        self._watch_error = None
+        self._done = False
+
+    @property
+    def done(self):
+        """
+        True once the query has finished, successfully or not.
+        """
+        return self._done
+
+    def submit(self):
+        """
+        Create the job and start it running.
+        """
+        self._stats.mark_start_time(self._intended_start_time)
+        self._started = time.perf_counter()
+        try:
+            with self._activate():
+                self._tap_service = TAPServiceSM(
+                    self._access_url, session=self._get_session(self._access_url))
+                self._job = self._tap_service.submit_async_timed(self._adql)
+            self._job_url = self._job.url
+            self._running = time.perf_counter()
+        except Exception as e:
+            self._fail(e)
+
+    def watch(self, poller, callback):
+        """
+        Have poller poll the job, calling callback(self) once it has finished
+        running, so the query is ready to `finish`.
+        """
+        def watched(error):
+            self._finished = time.perf_counter()
+            self._watch_error = error
+            callback(self)
+
+        # Poll in this query's context, so the polls are timed and limited.
+        with self._activate():
+            poller.watch(self._job, watched, total_timeout=self._async_total_timeout)
+
+    def finish(self):
+        """
+        Fetch and read the result of the finished job.
+        """
+        if self._done:
+            return
+        if self._watch_error is not None:
+            self._fail(self._watch_error)
+            return
+        self._timings.add(TAP_WAIT, self._finished - self._running)
+        response = None
+        try:
+            with self._activate():
+                response = self._tap_service.fetch_async_timed(self._job, streamable_response=True)
+                self._timings.add(DO_QUERY, time.perf_counter() - self._started)
+                self.stream_response(response)
+        except Exception as e:
+            self._handle(e)
+        self._complete(response)
+
+    @contextmanager
+    def _activate(self):
+        with self._timings.activate(), self._deadline.activate():
+            yield
+
+    def _fail(self, e):
+        self._handle(e)
+        self._complete(None)
+
+    def _handle(self, e):
+        self._timed_out = is_timeout(e) or self._deadline.expired
+        msg = f'Query error for service {self._service}: {repr(e)}'
+        self._handle_exc(msg)
+
+    def _complete(self, response):
+        self._done = True
+        self._stats.mark_end_time()
+        self._timings.add(QUERY_TOTAL, time.perf_counter() - self._started)
+        with self._timings.activate():
+            self.dispose_job()
+        self.gather_response_metadata(response)
+        if response is not None:
+            response.close()
+        self._release_sessions()
+
+
+class TapPipeline():
+    """
+    Runs a QueryRunner's tasks with up to window async TAP jobs outstanding.
+    Tasks for other kinds of service, and sync TAP tasks, are run in turn as
+    they come up.
+
+    Parameters
+    ----------
+    runner : QueryRunner
+        The runner whose queries are run and whose writers get the stats.
+    window : int
+        Maximum number of jobs outstanding at once.
+    poller : UwsPoller or None
+        Polls the jobs.  If None, the pipeline uses one polling thread of its own.
+    """
+
+    def __init__(self, runner, window, poller=None):
+        self._runner = runner
+        self._window = window
+        self._poller = poller
+
+    def run(self, tasks):
+        poller = self._poller if self._poller is not None else UwsPoller(threads=1)
+        try:
+            self._run(tasks, poller)
+        finally:
+            if poller is not self._poller:
+                poller.close()
+
+    def _run(self, tasks, poller):
+        scheduler = self._runner._new_scheduler(tasks)
+        finished = queue.Queue()
+        outstanding = {}
+
+        def start(task):
+            query = self._submit(task)
+            if not isinstance(query, PipelinedQuery) or query.done:
+                self._finish(scheduler, task, query)
+            else:
+                outstanding[query] = task
+                query.watch(poller, finished.put)
+
+        for ready_in in scheduler.schedule(start, outstanding, self._window):
+            if not outstanding:
+                time.sleep(ready_in)
+                continue
+
+            try:
+                query = finished.get(timeout=ready_in)
+            except queue.Empty:
+                continue
+            self._finish(scheduler, outstanding.pop(query), query)
+
+    def _submit(self, task):
+        """
+        Start the query for task.  Returns the PipelinedQuery, or for a task that
+        is not an async TAP query, the finished Query, or None if it could not
+        be created.
+        """
+        runner = self._runner
+        index, cone, service = task
+        if runner.getval(service, 'service_type') != 'tap' or runner._tap_mode_for(service) != 'async':
+            return runner._run_query(*task)
+        if not runner._circuit_allows(service):
+            return runner._skipped_query(cone, service)
+
+        query = None
+        try:
+            query = runner._create_query(cone, service, query_class=PipelinedQuery)
+            query.submit()
+        except Exception as e:
+            runner._handle_query_exc(query, cone, service, e)
+        return query
+
+    def _finish(self, scheduler, task, query):
+        runner = self._runner
+        if isinstance(query, PipelinedQuery):
+            query.finish()
+            runner._circuit_record(task[2], query)
+        scheduler.task_done(task)
+        runner._finish_task(task, query)
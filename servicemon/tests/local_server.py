@@ -0,0 +1,182 @@
+"""
+A minimal local HTTP server for tests that need real sockets.
+"""
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class LocalServer():
+    """
+    Serve canned responses from a background thread.
+
+    routes maps a URL path to either a (status, content_type, body[, headers])
+    tuple or a callable taking the request handler and returning such a tuple.
+    Any object with a dict-like get(path, default) may be used as routes.
+    The body may also be a list of bytes to send and float seconds to pause,
+    to simulate a slow server.
+    The number of connections accepted and the requests received are recorded.
+
+    Use as a context manager::
+
+        with LocalServer({'/cone': (200, 'text/xml', b'...')}) as server:
+            requests.get(server.url('/cone'))
+    """
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.connections = 0
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def url(self, path=''):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}{path}'
+
+    def __enter__(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._respond()
+
+            def do_POST(self):
+                self._respond()
+
+            def do_DELETE(self):
+                self._respond()
+
+            def do_HEAD(self):
+                self._respond()
+
+            def _respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.body = self.rfile.read(length) if length else b''
+                path = urlparse(self.path).path
+                with server._lock:
+                    server.requests.append((self.command, self.path, self.body))
+                route = server.routes.get(path, (404, 'text/plain', b'Not found'))
+                if callable(route):
+                    route = route(self)
+                status, content_type, body, *headers = route
+                parts = list(body) if isinstance(body, list) else [body]
+                length = sum(len(part) for part in parts if isinstance(part, bytes))
+                if parts and isinstance(parts[0], float):
+                    time.sleep(parts.pop(0))
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(length))
+                for key, value in (headers[0] if headers else {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    try:
+                        for part in parts:
+                            if isinstance(part, bytes):
+                                self.wfile.write(part)
+                                self.wfile.flush()
+                            else:
+                                time.sleep(part)
+                    except OSError:
+                        # The client gave up.
+                        pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        return False
+
+
+class FakeTapService():
+    """
+    Routes for a minimal TAP service at /tap with sync and UWS async endpoints.
+
+    Async jobs report EXECUTING for the first polls_to_complete polls of the job
+    document, then COMPLETED (or ERROR if fail is True).  Paths outside /tap are
+    looked up in the optional routes dict.
+    """
+
+    def __init__(self, votable, version='1.1', polls_to_complete=1, fail=False,
+                 routes=None):
+        self.votable = votable
+        self.routes = routes or {}
+        self.version = version
+        self.polls_to_complete = polls_to_complete
+        self.fail = fail
+        self.jobs = {}
+        self.deleted = []
+        self._lock = threading.Lock()
+
+    def get(self, path, default=None):
+        if path == '/tap/sync':
+            return (200, 'text/xml', self.votable)
+        if path == '/tap/async':
+            return self._create
+        if path.startswith('/tap/async/'):
+            return self._job_route(path[len('/tap/async/'):]) or default
+        return self.routes.get(path, default)
+
+    def _create(self, handler):
+        with self._lock:
+            job_id = f'job{len(self.jobs) + 1}'
+            self.jobs[job_id] = {'phase': 'PENDING', 'polls': 0}
+        return (303, 'text/plain', b'', {'Location': f'/tap/async/{job_id}'})
+
+    def _job_route(self, rest):
+        job_id, _, sub = rest.partition('/')
+        if job_id not in self.jobs:
+            return None
+
+        def route(handler):
+            job = self.jobs[job_id]
+            if handler.command == 'DELETE':
+                self.deleted.append(job_id)
+                return (303, 'text/plain', b'', {'Location': '/tap/async'})
+            if sub == 'phase':
+                job['phase'] = 'EXECUTING'
+                return (303, 'text/plain', b'', {'Location': f'/tap/async/{job_id}'})
+            if sub == 'results/result':
+                return (200, 'text/xml', self.votable)
+            if job['phase'] == 'EXECUTING':
+                job['polls'] += 1
+                if job['polls'] > self.polls_to_complete:
+                    job['phase'] = 'ERROR' if self.fail else 'COMPLETED'
+            return (200, 'text/xml', self.job_xml(job_id, job['phase']))
+
+        return route
+
+    def job_xml(self, job_id, phase):
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<uws:job xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0"
+         xmlns:xlink="http://www.w3.org/1999/xlink" version="{self.version}">
+  <uws:jobId>{job_id}</uws:jobId>
+  <uws:phase>{phase}</uws:phase>
+  <uws:creationTime>2021-03-01T10:00:00.000Z</uws:creationTime>
+  <uws:startTime>2021-03-01T10:00:01.500Z</uws:startTime>
+  <uws:endTime>2021-03-01T10:00:04.000Z</uws:endTime>
+  <uws:executionDuration>600</uws:executionDuration>
+  <uws:results>
+    <uws:result id="result" xlink:href="/tap/async/{job_id}/results/result"/>
+  </uws:results>
+</uws:job>
+""".encode()
@@ -0,0 +1,72 @@
+import time
+from datetime import datetime
+from itertools import islice
+
+import pytest
+
+from servicemon.arrivals import arrival_offsets
+from servicemon.query_runner import QueryRunner, _parse_query
+from servicemon.tests.local_server import LocalServer
+from servicemon.tests.test_query import votable_bytes
+
+
+def test_fixed():
+    assert list(islice(arrival_offsets('fixed', 4), 4)) == [0, 0.25, 0.5, 0.75]
+
+
+def test_poisson():
+    offsets = list(islice(arrival_offsets('poisson', 10, seed=3), 5001))
+    assert offsets == list(islice(arrival_offsets('poisson', 10, seed=3), 5001))
+    assert offsets == sorted(offsets)
+    assert offsets[-1] / 5000 == pytest.approx(0.1, rel=0.05)
+
+    with pytest.raises(ValueError):
+        next(arrival_offsets('poisson', 0))
+    with pytest.raises(ValueError):
+        next(arrival_offsets('bursty', 1))
+
+
+def parse_time(s):
+    return datetime.strptime(s, '%Y-%m-%d %H:%M:%S.%f').timestamp()
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_open_loop_records_intended_start(engine):
+    if engine == 'asyncio':
+        pytest.importorskip('aiohttp')
+
+    def slow_cone(handler):
+        # Slower than the arrival rate, so later queries start late.
+        time.sleep(0.1)
+        return (200, 'text/xml', votable_bytes(2))
+
+    with LocalServer({'/cone': slow_cone}) as server:
+        args = _parse_query([
+            'fake_services_file',
+            '--cone_file', 'my_cones.py',
+            '--engine', engine,
+            '--arrival', 'fixed', '--arrival_rate', '20'
+        ])
+        args.services = [{'base_name': 'Slow', 'service_type': 'cone',
+                          'access_url': server.url('/cone'), 'adql': ''}]
+        args.cone_file = [{'ra': float(i), 'dec': 0.0, 'radius': 0.1} for i in range(4)]
+        args.writers = []
+        qr = QueryRunner(args)
+
+        rows = []
+        qr._collect_stats = lambda stats: rows.append(stats.row_values())
+        qr.run()
+
+    rows.sort(key=lambda row: row['RA'])
+    intended = [parse_time(row['intended_start_time']) for row in rows]
+    started = [parse_time(row['start_time']) for row in rows]
+    assert [b - a for a, b in zip(intended, intended[1:])] == pytest.approx([0.05] * 3, abs=0.01)
+    assert all(s >= i - 0.001 for s, i in zip(started, intended))
+    assert started[-1] - intended[-1] > 0.2
+    assert all(row['num_rows'] == 2 for row in rows)
+
+
+def test_arrival_rate_required(capsys):
+    with pytest.raises(SystemExit):
+        _parse_query(['service_file.py', '--cone_file', 'my_cones.py', '--arrival', 'poisson'])
+    assert 'a positive --arrival_rate is required' in capsys.readouterr().err
@@ -0,0 +1,125 @@
+import pytest
+
+from servicemon.conftest import durations, run_rows
+from servicemon.query_runner import QueryRunner, _parse_query
+from servicemon.tests.local_server import LocalServer, FakeTapService
+from servicemon.tests.test_query import votable_bytes
+
+pytest.importorskip('aiohttp')
+
+
+def run_engine(server, engine, tap_mode, result_dir):
+    return run_rows(server, ['cone', 'tap'], 5,
+                    '--result_dir', str(result_dir), '--engine', engine, '--workers', '4',
+                    '--tap_mode', tap_mode, '--max_extra_durations', '16')
+
+
+@pytest.mark.parametrize('tap_mode', ['async', 'sync'])
+def test_asyncio_matches_threads(tmp_path, tap_mode):
+    tap = FakeTapService(votable_bytes(37), version='1.0', polls_to_complete=0,
+                         routes={'/cone': (200, 'text/xml', votable_bytes(12))})
+    with LocalServer(tap) as server:
+        thread_rows = run_engine(server, 'threads', tap_mode, tmp_path)
+        async_rows = run_engine(server, 'asyncio', tap_mode, tmp_path)
+
+    assert len(async_rows) == len(thread_rows) == 10
+
+    def key(row):
+        return (row['base_name'], str(row['RA']), row['ADQL'])
+
+    for trow, arow in zip(sorted(thread_rows, key=key), sorted(async_rows, key=key)):
+        assert key(trow) == key(arow)
+        for col in ('status', 'num_rows', 'num_columns', 'size', 'errmsg', 'query_status'):
+            assert arow[col] == trow[col], col
+        assert arow['status'] == 200
+        assert arow['num_rows'] == (12 if row_is_cone(arow) else 37)
+
+        tnames = set(durations(trow))
+        anames = set(durations(arow))
+        expected = {'ttfb', 'transfer'}
+        if not row_is_cone(arow) and tap_mode == 'async':
+            expected |= {'tap_submit', 'tap_run', 'tap_wait',
+                         'tap_raise_if_error', 'tap_fetch_response',
+                         'tap_server_queued', 'tap_server_exec'}
+        assert expected <= anames
+        assert expected <= tnames
+        if 'tap_server_queued' in expected:
+            for durs in (durations(trow), durations(arow)):
+                assert durs['tap_server_queued'] == pytest.approx(1.5)
+                assert durs['tap_server_exec'] == pytest.approx(2.5)
+
+
+def row_is_cone(row):
+    return row['base_name'] == 'LocalCone'
+
+
+def test_asyncio_service_error():
+    with LocalServer({'/cone': (500, 'text/plain', b'Oops')}) as server:
+        args = _parse_query([
+            'fake_services_file',
+            '--cone_file', 'my_cones.py',
+            '--engine', 'asyncio', '--workers', '2'
+        ])
+        args.services = [{'base_name': 'Broken', 'service_type': 'cone',
+                          'access_url': server.url('/cone'), 'adql': ''}]
+        args.cone_file = [{'ra': 10.0, 'dec': 20.0, 'radius': 0.1}] * 3
+        args.writers = []
+        qr = QueryRunner(args)
+        rows = []
+        qr._collect_stats = lambda stats: rows.append(stats.row_values())
+        qr.run()
+
+    assert len(rows) == 3
+    for row in rows:
+        assert row['status'] == 500
+        assert row['num_rows'] is None
+        assert 'Unable to parse VOTable' in row['errmsg']
+
+
+def test_asyncio_timeout():
+    body = votable_bytes(500)
+    routes = {'/slow': (200, 'text/xml', [3.0, body]),
+              '/stall': (200, 'text/xml', [body[:1000], 3.0, body[1000:]])}
+    with LocalServer(routes) as server:
+        args = _parse_query([
+            'fake_services_file',
+            '--cone_file', 'my_cones.py',
+            '--engine', 'asyncio', '--workers', '2',
+            '--read_timeout', '0.5'
+        ])
+        args.services = [{'base_name': 'Slow', 'service_type': 'cone',
+                          'access_url': server.url('/slow'), 'adql': '', 'total_timeout': 0.3},
+                         {'base_name': 'Stall', 'service_type': 'cone',
+                          'access_url': server.url('/stall'), 'adql': ''}]
+        args.cone_file = [{'ra': 10.0, 'dec': 20.0, 'radius': 0.1}]
+        args.writers = []
+        qr = QueryRunner(args)
+        rows = []
+        qr._collect_stats = lambda stats: rows.append(stats.row_values())
+        qr.run()
+
+    assert len(rows) == 2
+    for row in rows:
+        assert row['status'] == 'timeout'
+        assert row['query_total_dur'] < 2.0
+
+
+def test_asyncio_pool_size():
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(3))}) as server:
+        args = _parse_query([
+            'fake_services_file',
+            '--cone_file', 'my_cones.py',
+            '--engine', 'asyncio', '--workers', '4', '--pool_size', '1'
+        ])
+        args.services = [{'base_name': 'Local', 'service_type': 'cone',
+                          'access_url': server.url('/cone'), 'adql': ''}]
+        args.cone_file = [{'ra': 10.0 + i, 'dec': 20.0, 'radius': 0.1} for i in range(6)]
+        args.writers = []
+        qr = QueryRunner(args)
+        rows = []
+        qr._collect_stats = lambda stats: rows.append(stats.row_values())
+        qr.run()
+
+        # The queries took turns on the one connection allowed.
+        assert [row['status'] for row in rows] == [200] * 6
+        assert server.connections == 1
@@ -0,0 +1,153 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from servicemon.builtin_plugins import aws_writer
+from servicemon.plugin_support import SmPluginSupport, AbstractResultWriter
+from servicemon.query_runner import _parse_query
+from servicemon.tests.local_server import LocalServer
+from servicemon.tests.test_parquet_writer import make_stats
+
+
+@pytest.fixture(autouse=True)
+def not_on_ec2(monkeypatch):
+    monkeypatch.setattr(aws_writer, 'ec2_metadata', SimpleNamespace())
+
+
+def begin_writer(tmp_path, server, extra_kwargs=''):
+    SmPluginSupport.load_builtin_plugins()
+    args = _parse_query(['fake_services_file.py', '--cone_file', 'my_cones.py',
+                         '--result_dir', str(tmp_path)])
+    plugin = AbstractResultWriter.get_plugin_from_spec(
+        f"aws_writer:admin_url={server.url('/admin')},results_url={server.url('/submit')}{extra_kwargs}")
+    writer = plugin.cls()
+    writer.begin(args, **plugin.kwargs)
+    return writer
+
+
+def posted(server, path):
+    """
+    The JSON values posted to path, as multipart form data.
+    """
+    result = []
+    for method, req_path, body in server.requests:
+        if req_path == path:
+            part = body.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n--', 1)[0]
+            result.append(json.loads(part))
+    return result
+
+
+def test_rows_sent_in_batches(tmp_path):
+    routes = {'/admin': (200, 'text/plain', b'ok'), '/submit': (200, 'text/plain', [0.2, b'ok'])}
+    with LocalServer(routes) as server:
+        writer = begin_writer(tmp_path, server, ',batch_size=3,batch_seconds=0.5')
+        start = time.perf_counter()
+        for i in range(7):
+            writer.one_result(make_stats(i))
+        # The slow submissions do not hold up the queries.
+        assert time.perf_counter() - start < 0.2
+        writer.end()
+
+        admin = posted(server, '/admin')
+        batches = posted(server, '/submit')
+
+    assert [msg['endtime'] == '' for msg in admin] == [True, False]
+    assert [len(batch) if isinstance(batch, list) else 1 for batch in batches] == [3, 3, 1]
+    assert isinstance(batches[-1], dict)
+    rows = batches[0] + batches[1] + [batches[2]]
+    assert [row['name'] for row in rows] == [f'HSC_cone_{i}' for i in range(7)]
+    assert all(row['location'] for row in rows)
+    assert not (tmp_path / 'aws_writer.spool').exists()
+
+
+def test_unsent_rows_are_spooled_and_replayed(tmp_path):
+    spool = tmp_path / 'aws_writer.spool'
+    routes = {'/admin': (200, 'text/plain', b'ok'), '/submit': (500, 'text/plain', b'down')}
+    with LocalServer(routes) as server:
+        writer = begin_writer(tmp_path, server, ',batch_seconds=0,retries=2,backoff=0.01')
+        for i in range(3):
+            writer.one_result(make_stats(i))
+        # Let the sender use up its retries before the end.
+        for _ in range(100):
+            if spool.exists() and len(spool.read_text().splitlines()) == 3:
+                break
+            time.sleep(0.05)
+        writer.end()
+        attempts = len(posted(server, '/submit'))
+
+    lines = spool.read_text().splitlines()
+    assert [json.loads(line)['name'] for line in lines] == [f'HSC_cone_{i}' for i in range(3)]
+    assert attempts % 3 == 0
+
+    routes['/submit'] = (200, 'text/plain', b'ok')
+    with LocalServer(routes) as server:
+        writer = begin_writer(tmp_path, server)
+        writer.one_result(make_stats(3))
+        writer.end()
+        batches = posted(server, '/submit')
+
+    rows = [row for batch in batches for row in (batch if isinstance(batch, list) else [batch])]
+    assert [row['name'] for row in rows] == [f'HSC_cone_{i}' for i in range(4)]
+    assert not spool.exists()
+    assert not (tmp_path / 'aws_writer.spool.replay').exists()
+
+
+def test_rows_sent_singly_by_default(tmp_path):
+    routes = {'/admin': (200, 'text/plain', b'ok'), '/submit': (200, 'text/plain', b'ok')}
+    with LocalServer(routes) as server:
+        writer = begin_writer(tmp_path, server)
+        for i in range(3):
+            writer.one_result(make_stats(i))
+        writer.end()
+        batches = posted(server, '/submit')
+
+    assert all(isinstance(batch, dict) for batch in batches)
+    assert [batch['name'] for batch in batches] == [f'HSC_cone_{i}' for i in range(3)]
+
+
+def test_error_body_is_spooled(tmp_path):
+    spool = tmp_path / 'aws_writer.spool'
+    routes = {'/admin': (200, 'text/plain', b'ok'),
+              '/submit': (200, 'text/plain', b'ERROR: unable to parse JSON')}
+    with LocalServer(routes) as server:
+        writer = begin_writer(tmp_path, server, ',retries=1,backoff=0.01')
+        writer.one_result(make_stats(0))
+        writer.end()
+        attempts = len(posted(server, '/submit'))
+
+    assert attempts >= 1
+    assert [json.loads(line)['name'] for line in spool.read_text().splitlines()] == ['HSC_cone_0']
+
+
+def test_echoed_error_text_is_not_a_failure(tmp_path):
+    stats = make_stats(0)
+    stats.errmsg = 'Query error: timeout'
+    echo = ('DATA> ' + json.dumps(dict(stats.row_values()))).encode()
+    routes = {'/admin': (200, 'text/plain', b'ok'), '/submit': (200, 'text/plain', echo)}
+    with LocalServer(routes) as server:
+        writer = begin_writer(tmp_path, server, ',retries=1,backoff=0.01')
+        writer.one_result(stats)
+        writer.end()
+        attempts = len(posted(server, '/submit'))
+
+    assert attempts == 1
+    assert not (tmp_path / 'aws_writer.spool').exists()
+
+
+def test_replay_skips_rows_already_sent(tmp_path):
+    # A run that was killed after sending two of the three rows it replayed.
+    rows = [json.dumps({'name': f'HSC_cone_{i}'}) for i in range(3)]
+    (tmp_path / 'aws_writer.spool.replay').write_text('#abc\n' + ''.join(row + '\n' for row in rows))
+    (tmp_path / 'aws_writer.spool.replay.sent').write_text('abc 2')
+    (tmp_path / 'aws_writer.spool').write_text(json.dumps({'name': 'HSC_cone_3'}) + '\n')
+
+    routes = {'/admin': (200, 'text/plain', b'ok'), '/submit': (200, 'text/plain', b'ok')}
+    with LocalServer(routes) as server:
+        writer = begin_writer(tmp_path, server)
+        writer.end()
+        batches = posted(server, '/submit')
+
+    assert [batch['name'] for batch in batches] == ['HSC_cone_2', 'HSC_cone_3']
+    assert list(tmp_path.iterdir()) == []
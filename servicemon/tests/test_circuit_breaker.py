@@ -0,0 +1,90 @@
+import pytest
+
+from servicemon.circuit_breaker import CircuitBreaker
+from servicemon.conftest import FakeClock
+from servicemon.query_runner import QueryRunner, _parse_query
+from servicemon.tests.local_server import LocalServer
+from servicemon.tests.test_query import votable_bytes
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker(3, clock=FakeClock())
+    for _ in range(2):
+        assert breaker.allow('a')
+        breaker.record('a', False)
+    breaker.record('a', True)
+    for _ in range(2):
+        breaker.record('a', False)
+    assert breaker.allow('a')
+
+    breaker.record('a', False)
+    assert breaker.is_open('a')
+    assert not breaker.allow('a')
+    assert breaker.allow('b')
+
+
+def test_probes_with_exponential_backoff():
+    clock = FakeClock()
+    breaker = CircuitBreaker(1, backoff=10, max_backoff=25, clock=clock)
+    breaker.record('a', False)
+
+    clock.now = 9.9
+    assert not breaker.allow('a')
+    clock.now = 10
+    assert breaker.allow('a')
+    # Only one probe at a time, and late results of earlier queries are ignored.
+    assert not breaker.allow('a')
+    breaker.record('a', False)
+
+    clock.now = 29.9
+    assert not breaker.allow('a')
+    clock.now = 30
+    assert breaker.allow('a')
+    breaker.record('a', False)
+
+    # The backoff is capped.
+    clock.now = 54.9
+    assert not breaker.allow('a')
+    clock.now = 55
+    assert breaker.allow('a')
+    breaker.record('a', True)
+    assert not breaker.is_open('a')
+    assert breaker.allow('a')
+
+
+def test_threshold_must_be_positive():
+    with pytest.raises(ValueError):
+        CircuitBreaker(0)
+
+
+def test_runner_skips_dead_service(tmp_path):
+    journal_file = tmp_path / 'run.journal'
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(3)),
+                      '/dead': (500, 'text/plain', b'down')}) as server:
+        args = _parse_query([
+            'fake_services_file',
+            '--cone_file', 'my_cones.py',
+            '--breaker_threshold', '2',
+            '--journal', str(journal_file)
+        ])
+        args.services = [{'base_name': 'Live', 'service_type': 'cone',
+                          'access_url': server.url('/cone'), 'adql': ''},
+                         {'base_name': 'Dead', 'service_type': 'cone',
+                          'access_url': server.url('/dead'), 'adql': ''}]
+        args.cone_file = [{'ra': float(i), 'dec': 0.0, 'radius': 0.1} for i in range(5)]
+        args.writers = []
+        qr = QueryRunner(args)
+
+        rows = []
+        qr._collect_stats = lambda stats: rows.append(dict(stats.row_values()))
+        qr.run()
+
+    live = [row for row in rows if row['base_name'] == 'Live']
+    dead = [row for row in rows if row['base_name'] == 'Dead']
+    assert len(live) == 5 and all(row['errmsg'] == ':' for row in live)
+    assert [row['status'] for row in dead] == [500, 500, 'skipped', 'skipped', 'skipped']
+    assert all(row['errmsg'].endswith('skipped: circuit open') for row in dead[2:])
+
+    # The skipped queries are left for a resumed run.
+    lines = journal_file.read_text().splitlines()
+    assert sorted(lines) == sorted([f'{i}\tLive_cone' for i in range(5)] + ['0\tDead_cone', '1\tDead_cone'])
@@ -1,5 +1,8 @@
 import os
+import signal
 import shutil
+import threading
+import time
 import pytest
 from pathlib import Path
 from datetime import datetime
@@ -101,6 +104,7 @@ def write_some_results(cw):
     cw.one_result(results)
     results.set_values({'a': 'vala', 'b': 'valb', 'c': 'valc'})
     cw.one_result(results)
+    cw.end()
     return resfile
 
 
@@ -116,13 +120,16 @@ def begin_outfile_stdout():
     return cw
 
 
-def begin_w_outfile(dtstr):
+def begin_w_outfile(dtstr, extra_kwargs=None):
     args = _parse_query([
         'fake_services_file.py',
         '--cone_file', 'my_cones.py',
         '--result_dir', 'my_fake_result_dir2'
     ])
-    cw_plugin = AbstractResultWriter.get_plugin_from_spec(f'csv_writer:outfile=my_fake_result_dir2/myout-{dtstr}.csv')
+    spec = f'csv_writer:outfile=my_fake_result_dir2/myout-{dtstr}.csv'
+    if extra_kwargs is not None:
+        spec += f',{extra_kwargs}'
+    cw_plugin = AbstractResultWriter.get_plugin_from_spec(spec)
     cw = cw_plugin.cls()
     cw.begin(args, **cw_plugin.kwargs)
     return cw
@@ -155,3 +162,125 @@ class Results():
 
     def row_values(self):
         return self._vals
+
+
+@pytest.mark.usefixtures("cleandirs")
+def test_buffered_writes(capsys, monkeypatch):
+    SmPluginSupport.load_builtin_plugins()
+    resfile = Path('my_fake_result_dir2') / Path('myout-buffered.csv')
+
+    cw = begin_w_outfile('buffered', 'buffering=1000000,flush_interval=3600,fsync_interval=3600')
+    calls = []
+
+    def counted(name):
+        method = getattr(cw, name)
+
+        def wrapper(*args, **kwargs):
+            calls.append(name)
+            return method(*args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(cw, '_open', counted('_open'))
+    monkeypatch.setattr(cw, '_flush', counted('_flush'))
+    results = Results(['a', 'b', 'c'])
+    for i in range(1000):
+        results.set_values({'a': i, 'b': 2, 'c': 3})
+        cw.one_result(results)
+
+    # The file was opened once and nothing has reached it until the end.
+    assert calls == ['_open']
+    file = cw._file
+    assert resfile.stat().st_size == 0
+    cw.end()
+    assert calls == ['_open', '_flush']
+    assert file.closed
+
+    t = Table.read(resfile, format='csv')
+    assert len(t) == 1000
+    assert list(t['a'][:3]) == [0, 1, 2]
+
+    # A flush_interval of 0 flushes every row.
+    cw = begin_w_outfile('every_row', 'flush_interval=0')
+    write_some_results(cw)
+    t = Table.read(Path('my_fake_result_dir2') / Path('myout-every_row.csv'), format='csv')
+    assert len(t) == 2
+
+
+@pytest.mark.usefixtures("cleandirs")
+def test_flush_on_sigterm(capsys):
+    SmPluginSupport.load_builtin_plugins()
+    resfile = Path('my_fake_result_dir2') / Path('myout-sigterm.csv')
+    args = _parse_query(['fake_services_file.py', '--cone_file', 'my_cones.py'])
+    received = []
+    prev = signal.signal(signal.SIGTERM, lambda signum, frame: received.append(signum))
+    try:
+        cw_plugin = AbstractResultWriter.get_plugin_from_spec(
+            f'csv_writer:outfile={resfile},flush_interval=3600')
+        cw = cw_plugin.cls()
+        cw.begin(args, **cw_plugin.kwargs)
+        results = Results(['a', 'b', 'c'])
+        results.set_values({'a': 1, 'b': 2, 'c': 3})
+        cw.one_result(results)
+        assert resfile.stat().st_size == 0
+
+        signal.raise_signal(signal.SIGTERM)
+        assert received == [signal.SIGTERM]
+        assert len(Table.read(resfile, format='csv')) == 1
+
+        # The previous handler is restored at the end.
+        cw.end()
+        signal.raise_signal(signal.SIGTERM)
+        assert received == [signal.SIGTERM] * 2
+        assert signal.getsignal(signal.SIGTERM) is not cw._on_sigterm
+    finally:
+        signal.signal(signal.SIGTERM, prev)
+
+
+@pytest.mark.usefixtures("cleandirs")
+def test_new_columns_raise(capsys):
+    SmPluginSupport.load_builtin_plugins()
+    cw = begin_w_outfile('columns')
+    first = Results(['a', 'b'])
+    first.set_values({'a': 1, 'b': 2})
+    cw.one_result(first)
+    later = Results(['a', 'b', 'c'])
+    later.set_values({'a': 1, 'b': 2, 'c': 3})
+    with pytest.raises(ValueError):
+        cw.one_result(later)
+    cw.end()
+
+
+@pytest.mark.usefixtures("cleandirs")
+def test_sigterm_waits_for_row_being_written(capsys):
+    SmPluginSupport.load_builtin_plugins()
+    resfile = Path('my_fake_result_dir2') / Path('myout-sigterm_thread.csv')
+    args = _parse_query(['fake_services_file.py', '--cone_file', 'my_cones.py'])
+    prev = signal.signal(signal.SIGTERM, lambda signum, frame: None)
+    try:
+        cw_plugin = AbstractResultWriter.get_plugin_from_spec(
+            f'csv_writer:outfile={resfile},flush_interval=3600')
+        cw = cw_plugin.cls()
+        cw.begin(args, **cw_plugin.kwargs)
+        results = Results(['a', 'b', 'c'])
+        results.set_values({'a': 1, 'b': 2, 'c': 3})
+
+        # Another thread, such as a writer dispatch thread, is writing a row.
+        writing = threading.Event()
+
+        def write_row():
+            with cw._lock:
+                writing.set()
+                time.sleep(0.2)
+                cw.one_result(results)
+
+        writer = threading.Thread(target=write_row)
+        writer.start()
+        assert writing.wait(5)
+        signal.raise_signal(signal.SIGTERM)
+
+        # The handler waited for the row, then flushed it.
+        assert len(Table.read(resfile, format='csv')) == 1
+        writer.join()
+        cw.end()
+    finally:
+        signal.signal(signal.SIGTERM, prev)
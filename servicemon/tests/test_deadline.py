@@ -0,0 +1,98 @@
+import time
+
+import pytest
+import requests
+from pyvo.dal.exceptions import DALServiceError
+from urllib3.exceptions import ReadTimeoutError
+
+from servicemon.conftest import FakeClock
+from servicemon.deadline import Deadline, QueryTimeout, current_deadline, is_timeout
+from servicemon.query import Query
+from servicemon.query_runner import QueryRunner, _parse_query
+from servicemon.session_pool import SessionPool
+from servicemon.tests.local_server import LocalServer
+from servicemon.tests.test_query import votable_bytes
+
+
+def test_request_timeout():
+    clock = FakeClock()
+    deadline = Deadline(connect=5, read=30, total=20, clock=clock)
+    assert current_deadline() is None
+    with deadline.activate():
+        assert current_deadline() is deadline
+        assert deadline.request_timeout() == (5, 20)
+        # A request's own timeout is used in place of the read limit.
+        assert deadline.request_timeout(12) == (12, 12)
+        assert deadline.request_timeout((1, 125)) == (1, 20)
+
+        clock.now = 18
+        assert deadline.request_timeout() == (2, 2)
+        clock.now = 20
+        assert deadline.expired
+        with pytest.raises(QueryTimeout):
+            deadline.request_timeout()
+    assert current_deadline() is None
+
+    assert Deadline(read=30).request_timeout() == (None, 30)
+
+
+def test_is_timeout():
+    assert is_timeout(QueryTimeout('late'))
+    assert is_timeout(requests.ReadTimeout())
+    assert not is_timeout(ValueError('bad'))
+
+    try:
+        try:
+            raise ReadTimeoutError(None, '/cone', 'Read timed out.')
+        except ReadTimeoutError as e:
+            raise requests.ConnectionError(e)
+    except requests.ConnectionError as e:
+        assert is_timeout(e)
+
+    assert is_timeout(DALServiceError('Timed out', cause=requests.ConnectTimeout()))
+    assert not is_timeout(DALServiceError('Oops', 500))
+
+
+def run_query(service, out_dir, save_results, **limits):
+    query = Query(service, (10.0, 20.0), 0.1, str(out_dir), save_results=save_results,
+                  session_pool=SessionPool(), deadline=Deadline(**limits))
+    start = time.monotonic()
+    query.run()
+    return query, time.monotonic() - start
+
+
+@pytest.mark.parametrize('save_results', [False, True])
+def test_cancel_stalled_stream(tmp_path, save_results):
+    body = votable_bytes(500)
+    routes = {'/stall': (200, 'text/xml', [body[:1000], 3.0, body[1000:]]),
+              '/trickle': (200, 'text/xml', [body[:1000]] + [0.05, b' '] * 60 + [body[1000:]]),
+              '/slow': (200, 'text/xml', [3.0, body])}
+    with LocalServer(routes) as server:
+        def service(path):
+            return {'base_name': 'Local', 'service_type': 'cone',
+                    'access_url': server.url(path), 'adql': ''}
+
+        for path, limits in (('/stall', {'read': 0.3}),
+                             ('/trickle', {'read': 1.0, 'total': 0.5}),
+                             ('/slow', {'total': 0.3})):
+            query, elapsed = run_query(service(path), tmp_path, save_results, **limits)
+            rv = query.stats.row_values()
+            assert query.timed_out, path
+            assert rv['status'] == 'timeout'
+            assert rv['errmsg'] != ':'
+            assert elapsed < 2.0
+
+        query, _ = run_query(service('/trickle'), tmp_path, save_results, read=1.0, total=10)
+        assert not query.timed_out
+        assert query.stats.row_values()['status'] == 200
+
+
+def test_service_timeouts_override_args():
+    args = _parse_query(['fake_services_file', '--cone_file', 'my_cones.py',
+                         '--read_timeout', '7', '--total_timeout', '100'])
+    args.services = [{'base_name': 'A', 'service_type': 'cone',
+                      'access_url': 'http://a.example.org/cone', 'total_timeout': 5}]
+    args.cone_file = []
+    qr = QueryRunner(args)
+    deadline = qr._deadline_for(qr._services[0])
+    assert (deadline.connect, deadline.read, deadline.total) == (30.0, 7.0, 5.0)
@@ -0,0 +1,100 @@
+import csv
+import threading
+
+import pytest
+
+from servicemon.conftest import durations, run_rows
+from servicemon.job_cleaner import JobCleaner
+from servicemon.pyvo_wrappers import TAPServiceSM
+from servicemon.query_runner import QueryRunner, _parse_query
+from servicemon.session_pool import SessionPool
+from servicemon.tests.local_server import LocalServer, FakeTapService
+from servicemon.tests.test_query import votable_bytes
+
+
+def test_cleaner_deletes_in_batches(tmp_path):
+    tap = FakeTapService(votable_bytes(3), version='1.0')
+    with LocalServer(tap) as server:
+        pool = SessionPool()
+        service = TAPServiceSM(server.url('/tap'), session=pool.get(server.url('/tap')))
+        job_urls = [service.submit_async_timed('select * from t').url for _ in range(7)]
+
+        cleaner = JobCleaner(pool, workers=2, batch_size=3, log_path=tmp_path / 'deletes.csv')
+        for url in job_urls:
+            cleaner.add(url, 'LocalTap')
+        cleaner.add(server.url('/tap/async/no_such_job'), 'LocalTap')
+        delete_threads = [t for t in threading.enumerate() if t.name.startswith('sm_job_delete')]
+        cleaner.close()
+
+        assert sorted(tap.deleted) == sorted(f'job{i + 1}' for i in range(7))
+        assert len(delete_threads) == 2
+        assert not any(t.is_alive() for t in delete_threads)
+
+    summary = cleaner.summary()
+    assert list(summary['base_name']) == ['LocalTap']
+    assert summary['deleted'][0] == 7
+    assert summary['failed'][0] == 1
+    assert 0 < summary['p50'][0] <= summary['max'][0]
+
+    with pytest.raises(RuntimeError):
+        cleaner.add(job_urls[0])
+
+    with open(tmp_path / 'deletes.csv', newline='') as f:
+        logged = list(csv.DictReader(f))
+    assert sorted(row['job_url'] for row in logged) == sorted(job_urls + [server.url('/tap/async/no_such_job')])
+    assert sum(bool(row['errmsg']) for row in logged) == 1
+    assert all(float(row['tap_delete']) > 0 for row in logged if not row['errmsg'])
+    assert all(row['base_name'] == 'LocalTap' for row in logged)
+
+
+def run_tap_rows(server, *extra_args):
+    return run_rows(server, ['tap'], 4, *extra_args)
+
+
+@pytest.mark.parametrize('delete_jobs', ['background', 'inline', 'never'])
+@pytest.mark.parametrize('flow', [[], ['--tap_pipeline', '3'], ['--uws_pollers', '0']])
+def test_delete_jobs(tmp_path, fast_polls, delete_jobs, flow):
+    tap = FakeTapService(votable_bytes(5), version='1.0', polls_to_complete=1)
+    with LocalServer(tap) as server:
+        rows = run_tap_rows(server, '--result_dir', str(tmp_path), '--delete_jobs', delete_jobs, *flow)
+
+    assert len(rows) == 4
+    assert all(row['num_rows'] == 5 for row in rows)
+    if delete_jobs == 'never':
+        assert tap.deleted == []
+    else:
+        assert sorted(tap.deleted) == ['job1', 'job2', 'job3', 'job4']
+    for row in rows:
+        assert ('tap_delete' in durations(row)) == (delete_jobs == 'inline')
+    # Background deletions are timed in a file of their own.
+    logs = list(tmp_path.glob('tap_delete_*.csv'))
+    assert len(logs) == (delete_jobs == 'background')
+    if logs:
+        with open(logs[0], newline='') as f:
+            assert len(list(csv.DictReader(f))) == 4
+
+
+def test_delete_jobs_asyncio(tmp_path, fast_polls):
+    pytest.importorskip('aiohttp')
+    tap = FakeTapService(votable_bytes(5), version='1.0', polls_to_complete=0)
+    with LocalServer(tap) as server:
+        background = run_tap_rows(server, '--result_dir', str(tmp_path), '--engine', 'asyncio', '--workers', '2')
+        assert len(tap.deleted) == 4
+        inline = run_tap_rows(server, '--result_dir', str(tmp_path), '--engine', 'asyncio', '--workers', '2',
+                              '--delete_jobs', 'inline')
+        assert len(tap.deleted) == 8
+
+    assert not any('tap_delete' in durations(row) for row in background)
+    assert all('tap_delete' in durations(row) for row in inline)
+
+
+def test_programmatic_default_matches_cli(tmp_path):
+    args = _parse_query(['fake_services_file', '--cone_file', 'my_cones.py', '--result_dir', str(tmp_path)])
+    args.services = []
+    args.cone_file = []
+    cli_default = args.delete_jobs
+    # Callers building their own args may leave it out.
+    del args.delete_jobs
+    qr = QueryRunner(args)
+    assert qr._delete_jobs == cli_default == 'background'
+    qr._job_cleaner.close()
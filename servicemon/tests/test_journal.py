@@ -0,0 +1,30 @@
+from servicemon.journal import ProgressJournal, read_completed
+
+
+def test_record_and_reopen(tmp_path):
+    path = tmp_path / 'sub' / 'run.journal'
+    journal = ProgressJournal(str(path))
+    assert journal.completed == set()
+    journal.record(0, 'IPAC_2MASS_tap-async')
+    journal.record(0, 'NED_cone')
+    journal.record(1, 'NED_cone')
+    assert journal.is_completed(0, 'NED_cone')
+    assert not journal.is_completed(1, 'IPAC_2MASS_tap-async')
+    journal.close()
+
+    assert read_completed(str(path)) == {(0, 'IPAC_2MASS_tap-async'), (0, 'NED_cone'),
+                                         (1, 'NED_cone')}
+    assert read_completed(str(tmp_path / 'missing.journal')) == set()
+
+
+def test_partial_last_line(tmp_path):
+    path = tmp_path / 'run.journal'
+    path.write_text('0\tNED_cone\n1\tNED_co')
+
+    journal = ProgressJournal(str(path))
+    assert journal.completed == {(0, 'NED_cone')}
+    journal.record(1, 'NED_cone')
+    journal.close()
+
+    assert path.read_text() == '0\tNED_cone\n1\tNED_cone\n'
+    assert read_completed(str(path)) == {(0, 'NED_cone'), (1, 'NED_cone')}
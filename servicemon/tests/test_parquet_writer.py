@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from servicemon.plugin_support import SmPluginSupport, AbstractResultWriter
+from servicemon.query_runner import _parse_query
+from servicemon.query_stats import QueryStats
+
+
+def make_stats(i):
+    stats = QueryStats(f'HSC_cone_{i}', 'HSC' if i % 2 else 'PS1', 'cone', 'http://example.org/cone',
+                       {'RA': 10.0 + i, 'DEC': 20.0, 'SR': 0.1},
+                       ['status', 'size', 'num_rows', 'num_columns', 'query_status'],
+                       max_extra_durations=2)
+    stats.mark_start_time()
+    stats.mark_end_time()
+    stats.query_total_dur = 0.5 + i
+    stats.add_named_duration('ttfb', 0.25)
+    if i == 3:
+        stats.errmsg += 'Query error'
+        stats.result_meta = {'status': 'timeout'}
+    else:
+        stats.result_meta = {'status': 200, 'size': 1000 + i, 'num_rows': i, 'num_columns': 4,
+                             'query_status': 'OK'}
+    return stats
+
+
+def test_parquet_writer(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    SmPluginSupport.load_builtin_plugins()
+    outfile = tmp_path / 'out' / 'results.parquet'
+    args = _parse_query(['fake_services_file.py', '--cone_file', 'my_cones.py',
+                         '--result_dir', str(tmp_path)])
+    plugin = AbstractResultWriter.get_plugin_from_spec(f'parquet_writer:outfile={outfile},row_group=5')
+    writer = plugin.cls()
+    writer.begin(args, **plugin.kwargs)
+
+    start = time.time()
+    for i in range(12):
+        writer.one_result(make_stats(i))
+    writer.end()
+
+    pfile = pq.ParquetFile(outfile)
+    assert pfile.metadata.num_rows == 12
+    assert [pfile.metadata.row_group(i).num_rows for i in range(pfile.num_row_groups)] == [5, 5, 2]
+
+    df = pq.read_table(outfile).to_pandas()
+    assert str(df['base_name'].dtype) == 'category'
+    assert set(df['base_name']) == {'HSC', 'PS1'}
+    assert str(df['extra_dur0_name'].dtype) == 'category'
+    assert str(df['start_time'].dtype).startswith('datetime64')
+    assert abs(df['start_time'][0].timestamp() - start) < 60
+    assert df['query_total_dur'].tolist() == [0.5 + i for i in range(12)]
+    assert df['extra_dur0_value'].tolist() == [0.25] * 12
+    assert df['extra_dur1_value'].isna().all()
+    assert df['RA'][11] == 21.0
+    assert df['num_rows'][11] == 11
+    assert df['num_rows'].isna().tolist() == [i == 3 for i in range(12)]
+    assert df['status'].tolist()[2:4] == ['200', 'timeout']
+    assert df['errmsg'][3] == ':Query error'
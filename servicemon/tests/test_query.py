@@ -1,5 +1,13 @@
+import io
 import re
-from servicemon.query import compute_user_agent
+import hashlib
+
+from astropy.table import Table
+from astropy.io.votable import from_table, writeto
+
+from servicemon.query import Query, compute_user_agent
+from servicemon.session_pool import SessionPool
+from servicemon.tests.local_server import LocalServer, FakeTapService
 
 
 def test_user_agent(capsys):
@@ -12,3 +20,97 @@ def test_user_agent(capsys):
         r'servicemon\/[0-9]\.[0-9][^ ]* \(IVOA\-monitor https\:\/\/github.com\/NASA-NAVO\/servicemon\) Python/3\.')
     match = re.search(expected, default_ua)
     assert match
+
+
+def votable_bytes(nrows):
+    t = Table({'a': list(range(nrows)), 'b': ['x'] * nrows})
+    buf = io.BytesIO()
+    writeto(from_table(t), buf)
+    return buf.getvalue()
+
+
+def test_stream_sink_and_file(tmp_path):
+    body = votable_bytes(500)
+    with LocalServer({'/cone': (200, 'text/xml', body)}) as server:
+        service = {'base_name': 'Local', 'service_type': 'cone',
+                   'access_url': server.url('/cone'), 'adql': ''}
+        pool = SessionPool()
+
+        for save_results in (False, True, False):
+            query = Query(service, (10.0, 20.0), 0.1, tmp_path, save_results=save_results,
+                          session_pool=pool, digest='sha256')
+            query.run()
+            rv = query.stats.row_values()
+            assert rv['errmsg'] == ':'
+            assert rv['status'] == 200
+            assert rv['size'] == len(body)
+            assert rv['num_rows'] == 500
+            assert rv['num_columns'] == 2
+            assert rv['digest'] == hashlib.sha256(body).hexdigest()
+            assert rv['stream_to_file_dur'] > 0
+
+        # Only the saved result was written, and the connection was reused throughout.
+        assert [p.name for p in (tmp_path / 'Local').iterdir()] == [query._filename.name]
+        assert server.connections == 1
+
+
+def test_query_releases_sessions(tmp_path, monkeypatch):
+    closed = []
+    monkeypatch.setattr(SessionPool, 'close', lambda pool: closed.append(pool))
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(5))}) as server:
+        service = {'base_name': 'Local', 'service_type': 'cone',
+                   'access_url': server.url('/cone'), 'adql': ''}
+
+        # The query's own pool is closed once it ends, but not a shared one.
+        query = Query(service, (10.0, 20.0), 0.1, tmp_path)
+        query.run()
+        own_pool = query._session_pool
+        assert closed == [own_pool]
+
+        pool = SessionPool(cold=True)
+        query = Query(service, (10.0, 20.0), 0.1, tmp_path, session_pool=pool)
+        query.run()
+        assert query.stats.row_values()['status'] == 200
+        assert closed == [own_pool]
+        assert not pool._cold_sessions
+
+
+def test_extra_durations_limit(tmp_path):
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(5))}) as server:
+        service = {'base_name': 'Local', 'service_type': 'cone',
+                   'access_url': server.url('/cone'), 'adql': ''}
+        pool = SessionPool(cold=True)
+
+        query = Query(service, (10.0, 20.0), 0.1, tmp_path, session_pool=pool)
+        query.run()
+        rv = query.stats.row_values()
+        assert [rv[f'extra_dur{i}_name'] for i in range(5)] == ['ttfb', 'transfer', 'dns', 'connect', None]
+        assert 'extra_dur7_name' in rv and 'extra_dur8_name' not in rv
+
+        # Durations that do not fit are left out, not an error.
+        query = Query(service, (10.0, 20.0), 0.1, tmp_path, session_pool=pool, max_extra_durations=2)
+        query.run()
+        rv = query.stats.row_values()
+        assert rv['errmsg'] == ':'
+        assert [rv['extra_dur0_name'], rv['extra_dur1_name']] == ['ttfb', 'transfer']
+        assert 'extra_dur2_name' not in rv
+
+
+def test_extra_durations_keep_connection_phases(tmp_path):
+    tap = FakeTapService(votable_bytes(5), version='1.0', polls_to_complete=0)
+    with LocalServer(tap) as server:
+        service = {'base_name': 'LocalTap', 'service_type': 'tap', 'access_url': server.url('/tap'),
+                   'adql': 'select * from t where contains(point(ra, dec), circle({}, {}, {})) = 1'}
+        pool = SessionPool(cold=True)
+        query = Query(service, (10.0, 20.0), 0.1, tmp_path, session_pool=pool, delete_jobs='inline')
+        query.run()
+        pool.close()
+
+    rv = query.stats.row_values()
+    assert rv['errmsg'] == ':'
+    names = [rv[f'extra_dur{i}_name'] for i in range(8)]
+    # More than 8 were measured, so the TAP durations that say least were left out.
+    assert set(names) == {'ttfb', 'transfer', 'dns', 'connect', 'tap_delete',
+                          'tap_wait', 'tap_server_queued', 'tap_server_exec'}
+    # The kept ones are in the usual order.
+    assert names.index('tap_wait') < names.index('ttfb')
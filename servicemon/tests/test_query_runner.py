@@ -1,5 +1,13 @@
+import time
+import threading
+from collections import Counter
+from types import SimpleNamespace
+
 import pytest
+from servicemon.conftest import run_rows
 from servicemon.query_runner import QueryRunner
+from servicemon.tests.local_server import LocalServer, FakeTapService
+from servicemon.tests.test_query import votable_bytes
 
 from servicemon.query_runner import (
     _parse_query, _parse_replay,
@@ -37,6 +45,37 @@ def test_global_query_args(capsys):
                           'tap_mode': 'async',
                           'user_agent': None,
                           'verbose': False,
+                          'workers': 1,
+                          'per_host_limit': None,
+                          'pool_size': 10,
+                          'max_extra_durations': 8,
+                          'cold_connections': False,
+                          'digest': None,
+                          'engine': 'threads',
+                          'processes': 1,
+                          'shard_by': 'range',
+                          'journal': None,
+                          'resume': False,
+                          'host_max_qps': None,
+                          'arrival': 'closed',
+                          'arrival_rate': None,
+                          'arrival_seed': None,
+                          'ramp': None,
+                          'step_duration': 300.0,
+                          'breaker_threshold': 0,
+                          'breaker_backoff': 30.0,
+                          'breaker_max_backoff': 1800.0,
+                          'connect_timeout': 30.0,
+                          'read_timeout': 60.0,
+                          'total_timeout': None,
+                          'tap_pipeline': 1,
+                          'uws_pollers': 4,
+                          'delete_jobs': 'background',
+                          'delete_workers': 2,
+                          'pair_order': 'fixed',
+                          'pair_seed': None,
+                          'writer_queue': 1000,
+                          'writer_overflow': 'block',
                           'writers': ['csv_writer']}
 
     # Without defaults for auto-generated cones.
@@ -65,6 +104,37 @@ def test_global_query_args(capsys):
                           'tap_mode': 'sync',
                           'user_agent': custom_agent,
                           'verbose': True,
+                          'workers': 1,
+                          'per_host_limit': None,
+                          'pool_size': 10,
+                          'max_extra_durations': 8,
+                          'cold_connections': False,
+                          'digest': None,
+                          'engine': 'threads',
+                          'processes': 1,
+                          'shard_by': 'range',
+                          'journal': None,
+                          'resume': False,
+                          'host_max_qps': None,
+                          'arrival': 'closed',
+                          'arrival_rate': None,
+                          'arrival_seed': None,
+                          'ramp': None,
+                          'step_duration': 300.0,
+                          'breaker_threshold': 0,
+                          'breaker_backoff': 30.0,
+                          'breaker_max_backoff': 1800.0,
+                          'connect_timeout': 30.0,
+                          'read_timeout': 60.0,
+                          'total_timeout': None,
+                          'tap_pipeline': 1,
+                          'uws_pollers': 4,
+                          'delete_jobs': 'background',
+                          'delete_workers': 2,
+                          'pair_order': 'fixed',
+                          'pair_seed': None,
+                          'writer_queue': 1000,
+                          'writer_overflow': 'block',
                           'writers': ['my_writer1', 'my_writer2:karg1=val1,kwarg2=val2']}
 
     # Without defatults for cone_file specified.
@@ -91,6 +161,37 @@ def test_global_query_args(capsys):
                           'tap_mode': 'sync',
                           'user_agent': None,
                           'verbose': True,
+                          'workers': 1,
+                          'per_host_limit': None,
+                          'pool_size': 10,
+                          'max_extra_durations': 8,
+                          'cold_connections': False,
+                          'digest': None,
+                          'engine': 'threads',
+                          'processes': 1,
+                          'shard_by': 'range',
+                          'journal': None,
+                          'resume': False,
+                          'host_max_qps': None,
+                          'arrival': 'closed',
+                          'arrival_rate': None,
+                          'arrival_seed': None,
+                          'ramp': None,
+                          'step_duration': 300.0,
+                          'breaker_threshold': 0,
+                          'breaker_backoff': 30.0,
+                          'breaker_max_backoff': 1800.0,
+                          'connect_timeout': 30.0,
+                          'read_timeout': 60.0,
+                          'total_timeout': None,
+                          'tap_pipeline': 1,
+                          'uws_pollers': 4,
+                          'delete_jobs': 'background',
+                          'delete_workers': 2,
+                          'pair_order': 'fixed',
+                          'pair_seed': None,
+                          'writer_queue': 1000,
+                          'writer_overflow': 'block',
                           'writers': ['my_writer1', 'my_writer2:karg1=val1,kwarg2=val2']}
 
     # With short args
@@ -116,6 +217,37 @@ def test_global_query_args(capsys):
                           'tap_mode': 'sync',
                           'user_agent': None,
                           'verbose': True,
+                          'workers': 1,
+                          'per_host_limit': None,
+                          'pool_size': 10,
+                          'max_extra_durations': 8,
+                          'cold_connections': False,
+                          'digest': None,
+                          'engine': 'threads',
+                          'processes': 1,
+                          'shard_by': 'range',
+                          'journal': None,
+                          'resume': False,
+                          'host_max_qps': None,
+                          'arrival': 'closed',
+                          'arrival_rate': None,
+                          'arrival_seed': None,
+                          'ramp': None,
+                          'step_duration': 300.0,
+                          'breaker_threshold': 0,
+                          'breaker_backoff': 30.0,
+                          'breaker_max_backoff': 1800.0,
+                          'connect_timeout': 30.0,
+                          'read_timeout': 60.0,
+                          'total_timeout': None,
+                          'tap_pipeline': 1,
+                          'uws_pollers': 4,
+                          'delete_jobs': 'background',
+                          'delete_workers': 2,
+                          'pair_order': 'fixed',
+                          'pair_seed': None,
+                          'writer_queue': 1000,
+                          'writer_overflow': 'block',
                           'writers': ['my_writer1', 'my_writer2:karg1=val1,kwarg2=val2']}
 
 
@@ -167,6 +299,37 @@ def test_global_replay_args(capsys):
                           'tap_mode': 'async',
                           'user_agent': None,
                           'verbose': False,
+                          'workers': 1,
+                          'per_host_limit': None,
+                          'pool_size': 10,
+                          'max_extra_durations': 8,
+                          'cold_connections': False,
+                          'digest': None,
+                          'engine': 'threads',
+                          'processes': 1,
+                          'shard_by': 'range',
+                          'journal': None,
+                          'resume': False,
+                          'host_max_qps': None,
+                          'arrival': 'closed',
+                          'arrival_rate': None,
+                          'arrival_seed': None,
+                          'ramp': None,
+                          'step_duration': 300.0,
+                          'breaker_threshold': 0,
+                          'breaker_backoff': 30.0,
+                          'breaker_max_backoff': 1800.0,
+                          'connect_timeout': 30.0,
+                          'read_timeout': 60.0,
+                          'total_timeout': None,
+                          'tap_pipeline': 1,
+                          'uws_pollers': 4,
+                          'delete_jobs': 'background',
+                          'delete_workers': 2,
+                          'pair_order': 'fixed',
+                          'pair_seed': None,
+                          'writer_queue': 1000,
+                          'writer_overflow': 'block',
                           'writers': ['csv_writer']}
 
     # Without defaults.
@@ -190,6 +353,37 @@ def test_global_replay_args(capsys):
                           'tap_mode': 'sync',
                           'user_agent': custom_agent,
                           'verbose': True,
+                          'workers': 1,
+                          'per_host_limit': None,
+                          'pool_size': 10,
+                          'max_extra_durations': 8,
+                          'cold_connections': False,
+                          'digest': None,
+                          'engine': 'threads',
+                          'processes': 1,
+                          'shard_by': 'range',
+                          'journal': None,
+                          'resume': False,
+                          'host_max_qps': None,
+                          'arrival': 'closed',
+                          'arrival_rate': None,
+                          'arrival_seed': None,
+                          'ramp': None,
+                          'step_duration': 300.0,
+                          'breaker_threshold': 0,
+                          'breaker_backoff': 30.0,
+                          'breaker_max_backoff': 1800.0,
+                          'connect_timeout': 30.0,
+                          'read_timeout': 60.0,
+                          'total_timeout': None,
+                          'tap_pipeline': 1,
+                          'uws_pollers': 4,
+                          'delete_jobs': 'background',
+                          'delete_workers': 2,
+                          'pair_order': 'fixed',
+                          'pair_seed': None,
+                          'writer_queue': 1000,
+                          'writer_overflow': 'block',
                           'writers': ['my_writer1', 'my_writer2:karg1=val1,kwarg2=val2']}
 
 
@@ -234,3 +428,176 @@ def test_service_validation(capsys):
                       '  Some result writers may fail.') as record:
         qr._validate_services(args.services)
     assert len(record) == 1
+
+
+def test_concurrent_per_host_limit():
+    args = _parse_query([
+        'fake_services_file',
+        '--cone_file', 'my_cones.py',
+        '--workers', '4', '--per_host_limit', '2'
+    ])
+    args.services = [
+        {'service_type': 'cone', 'access_url': 'http://a.example.org/cone'},
+        {'service_type': 'cone', 'access_url': 'http://b.example.org/cone'},
+    ]
+    args.cone_file = [{'ra': 10.0, 'dec': 20.0, 'radius': 0.1}] * 6
+    args.writers = []
+    qr = QueryRunner(args)
+
+    lock = threading.Lock()
+    active = Counter()
+    max_active = Counter()
+    collected = []
+
+    def fake_run_query(index, cone, service):
+        host = qr._service_host(service)
+        with lock:
+            active[host] += 1
+            max_active[host] = max(max_active[host], active[host])
+        time.sleep(0.02)
+        with lock:
+            active[host] -= 1
+        return SimpleNamespace(stats=(index, host))
+
+    qr._run_query = fake_run_query
+    qr._collect_stats = collected.append
+    qr.run()
+
+    assert len(collected) == 12
+    assert sorted(collected) == sorted((i, h) for i in range(6)
+                                       for h in ('a.example.org', 'b.example.org'))
+    assert max_active['a.example.org'] == 2
+    assert max_active['b.example.org'] == 2
+
+
+@pytest.mark.parametrize('shard_by', ['range', 'round_robin'])
+def test_shards_cover_selection(shard_by):
+    args = _parse_query([
+        'fake_services_file',
+        '--cone_file', 'my_cones.py',
+        '--start_index', '2', '--cone_limit', '7',
+        '--shard_by', shard_by
+    ])
+    args.services = [{'service_type': 'cone', 'access_url': 'http://a.example.org/cone'}]
+    args.cone_file = [{'ra': float(i), 'dec': 0.0, 'radius': 0.1} for i in range(20)]
+    args.writers = []
+
+    shards = []
+    for i in range(3):
+        qr = QueryRunner(args, shard=(i, 3))
+        shards.append([index for index, _ in qr._selected(qr._cones)])
+
+    assert sorted(sum(shards, [])) == list(range(2, 9))
+    assert [len(s) for s in shards] in ([2, 2, 3], [3, 2, 2])
+    if shard_by == 'range':
+        assert shards == [[2, 3], [4, 5], [6, 7, 8]]
+    else:
+        assert shards == [[2, 5, 8], [3, 6], [4, 7]]
+
+
+def test_resume_skips_journaled_tasks(tmp_path):
+    journal_file = str(tmp_path / 'run.journal')
+
+    def run(resume, fail_at=None):
+        input_args = ['fake_services_file', '--cone_file', 'my_cones.py',
+                      '--journal', journal_file]
+        if resume:
+            input_args.append('--resume')
+        args = _parse_query(input_args)
+        args.services = [
+            {'base_name': 'A', 'service_type': 'cone', 'access_url': 'http://a.example.org/cone'},
+            {'base_name': 'B', 'service_type': 'tap', 'access_url': 'http://b.example.org/tap'},
+        ]
+        args.cone_file = [{'ra': float(i), 'dec': 0.0, 'radius': 0.1} for i in range(4)]
+        args.writers = []
+        qr = QueryRunner(args)
+
+        ran = []
+
+        def fake_run_query(index, cone, service):
+            if (index, service['base_name']) == fail_at:
+                raise RuntimeError('Spot instance reclaimed')
+            ran.append((index, service['base_name']))
+            return SimpleNamespace(stats=None, skipped=False)
+
+        qr._run_query = fake_run_query
+        qr._collect_stats = lambda stats: None
+        try:
+            qr.run()
+        except RuntimeError:
+            pass
+        return ran
+
+    first = run(resume=False, fail_at=(2, 'B'))
+    assert first == [(0, 'A'), (0, 'B'), (1, 'A'), (1, 'B'), (2, 'A')]
+
+    second = run(resume=True)
+    assert second == [(2, 'B'), (3, 'A'), (3, 'B')]
+
+    with open(journal_file) as f:
+        lines = f.read().splitlines()
+    assert lines[:2] == ['0\tA_cone', '0\tB_tap-async']
+    assert len(lines) == 8
+
+
+def test_resume_requires_journal(capsys):
+    with pytest.raises(SystemExit):
+        _ = _parse_query(['service_file.py', '--cone_file', 'my_cones.py', '--resume'])
+    assert 'argument --journal is required with --resume' in errstr(capsys)
+
+
+def run_pairs(server, *extra_args):
+    return run_rows(server, ['cone', 'tap'], 6, '--tap_mode', 'both', '--uws_pollers', '0', *extra_args)
+
+
+@pytest.mark.parametrize('pair_order', ['fixed', 'random'])
+def test_tap_mode_both(tmp_path, pair_order):
+    tap = FakeTapService(votable_bytes(4), version='1.0', polls_to_complete=0,
+                         routes={'/cone': (200, 'text/xml', votable_bytes(2))})
+    with LocalServer(tap) as server:
+        rows = run_pairs(server, '--result_dir', str(tmp_path), '--pair_order', pair_order, '--pair_seed', '3')
+
+    cone_rows = [row for row in rows if row['service_type'] == 'cone']
+    tap_rows = [row for row in rows if row['service_type'] == 'tap']
+    assert len(cone_rows) == 6 and len(tap_rows) == 12
+    assert all(row['pair_id'] is None and row['pair_position'] is None for row in cone_rows)
+    assert all(row['num_rows'] == 4 and row['errmsg'] == ':' for row in tap_rows)
+
+    pairs = {}
+    for row in tap_rows:
+        pairs.setdefault(row['pair_id'], []).append(row)
+    run_id = tap_rows[0]['pair_id'].split('_')[0]
+    assert sorted(pairs) == [f'{run_id}_LocalTap_{i}' for i in range(6)]
+    orders = []
+    for pair in pairs.values():
+        assert [row['pair_position'] for row in pair] == [0, 1]
+        assert pair[0]['RA'] == pair[1]['RA']
+        orders.append(tuple(row['name'].split('_')[1] for row in pair))
+    assert set(orders) <= {('tap-sync', 'tap-async'), ('tap-async', 'tap-sync')}
+    if pair_order == 'fixed':
+        assert set(orders) == {('tap-sync', 'tap-async')}
+    else:
+        assert len(set(orders)) == 2
+
+
+@pytest.mark.parametrize('overlapping', [['--ramp', '1,2'], ['--tap_pipeline', '4'], ['--workers', '2'],
+                                         ['--engine', 'asyncio'], ['--processes', '2'],
+                                         ['--arrival', 'poisson', '--arrival_rate', '5']])
+def test_tap_mode_both_rejected_with_overlap(capsys, overlapping):
+    with pytest.raises(SystemExit):
+        _parse_query(['fake_services_file', '--cone_file', 'my_cones.py',
+                      '--tap_mode', 'both', *overlapping])
+    assert 'argument --tap_mode both cannot be used with --ramp' in errstr(capsys)
+
+
+def test_pair_ids_differ_between_runs(tmp_path):
+    tap = FakeTapService(votable_bytes(4), version='1.0', polls_to_complete=0,
+                         routes={'/cone': (200, 'text/xml', votable_bytes(2))})
+    with LocalServer(tap) as server:
+        first = run_pairs(server, '--result_dir', str(tmp_path))
+        second = run_pairs(server, '--result_dir', str(tmp_path))
+
+    first_ids = {row['pair_id'] for row in first if row['pair_id'] is not None}
+    second_ids = {row['pair_id'] for row in second if row['pair_id'] is not None}
+    assert len(first_ids) == len(second_ids) == 6
+    assert not first_ids & second_ids
@@ -1,5 +1,5 @@
 import pytest
-from servicemon.query_stats import QueryStats
+from servicemon.query_stats import QueryStats, column_kind
 
 
 def test_params():
@@ -92,3 +92,49 @@ def test_extra_durations():
         qs.add_named_duration('toomany', 42)
     assert ('Too many intervals added'
             in str(e_info.value))
+
+
+def test_intended_start_time():
+    unscheduled = QueryStats('name', 'base_name', 'cone', 'http://access.url',
+                             {'RA': 123.4, 'DEC': 56.7, 'SR': 8.9}, {})
+    unscheduled.mark_start_time()
+    assert 'intended_start_time' not in unscheduled.columns()
+    assert 'intended_start_time' not in unscheduled.row_values()
+
+    qs = QueryStats('name', 'base_name', 'cone', 'http://access.url',
+                    {'RA': 123.4, 'DEC': 56.7, 'SR': 8.9}, {}, scheduled=True)
+    cols = qs.columns()
+    assert cols.index('intended_start_time') == cols.index('end_time') + 1
+
+    qs.mark_start_time()
+    rv = qs.row_values()
+    assert rv['intended_start_time'] == rv['start_time']
+
+    qs.mark_start_time(intended=0.0)
+    assert qs.row_values()['intended_start_time'] == QueryStats._format_time(0.0)
+    assert qs.row_values()['start_time'] > qs.row_values()['intended_start_time']
+
+
+def test_tags():
+    qs = QueryStats('name', 'base_name', 'cone', 'http://access.url',
+                    {'RA': 123.4, 'DEC': 56.7, 'SR': 8.9}, {}, tags={'ramp_step': 2})
+    assert qs.columns()[-1] == 'ramp_step'
+    assert qs.row_values()['ramp_step'] == 2
+    assert qs.tags == {'ramp_step': 2}
+
+    untagged = QueryStats('name', 'base_name', 'cone', 'http://access.url',
+                          {'RA': 123.4, 'DEC': 56.7, 'SR': 8.9}, {})
+    assert 'ramp_step' not in untagged.columns()
+
+
+def test_column_kinds():
+    qs = QueryStats('HSC_cone_123.4_56.7_8.9', 'HSC', 'cone', 'http://google.com',
+                    {'RA': 123.4, 'DEC': 56.7, 'SR': 8.9},
+                    ['status', 'size', 'num_rows', 'num_columns', 'query_status'],
+                    max_extra_durations=2, tags={'ramp_step': 1, 'label': 'x'}, scheduled=True)
+    kinds = {col: column_kind(col) for col in qs.columns()}
+    assert kinds['start_time'] == kinds['intended_start_time'] == 'timestamp'
+    assert kinds['query_total_dur'] == kinds['extra_dur1_value'] == kinds['RA'] == 'float'
+    assert kinds['num_rows'] == kinds['size'] == kinds['ramp_step'] == 'int'
+    assert kinds['base_name'] == kinds['extra_dur0_name'] == kinds['status'] == 'category'
+    assert kinds['name'] == kinds['errmsg'] == kinds['other_params'] == kinds['label'] == 'string'
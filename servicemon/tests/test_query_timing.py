@@ -0,0 +1,75 @@
+import time
+import threading
+from types import SimpleNamespace
+
+import pytest
+from astropy.time import Time
+
+from servicemon.query_timing import QueryTimings, timed, current_timings, record_uws_times
+
+
+@timed('decorated')
+def sleep_a_bit(secs):
+    time.sleep(secs)
+
+
+def test_accumulate():
+    qt = QueryTimings()
+    assert current_timings() is None
+    with qt.activate():
+        assert current_timings() is qt
+        with timed('block'):
+            time.sleep(0.01)
+        with timed('block'):
+            time.sleep(0.01)
+        sleep_a_bit(0.01)
+    assert current_timings() is None
+
+    assert qt.get('block') >= 0.02
+    assert qt.get('decorated') >= 0.01
+    assert 'missing' not in qt
+    assert qt.get('missing') is None
+
+    # Nothing is recorded with no current timings.
+    with timed('orphan'):
+        pass
+    assert 'orphan' not in qt
+
+
+def test_threads_are_isolated():
+    results = {}
+
+    def worker(secs):
+        qt = QueryTimings()
+        with qt.activate():
+            sleep_a_bit(secs)
+        results[secs] = qt.get('decorated')
+
+    threads = [threading.Thread(target=worker, args=(secs,)) for secs in (0.01, 0.1)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert 0.01 <= results[0.01] < 0.1
+    assert results[0.1] >= 0.1
+
+
+def test_record_uws_times():
+    job = SimpleNamespace(creationtime=Time('2021-03-01T10:00:00'),
+                          starttime=Time('2021-03-01T10:00:01.5'),
+                          endtime=Time('2021-03-01T10:00:04'))
+    qt = QueryTimings()
+    with qt.activate():
+        record_uws_times(job)
+    assert qt.get('tap_server_queued') == pytest.approx(1.5)
+    assert qt.get('tap_server_exec') == pytest.approx(2.5)
+
+    # Phases with missing or inconsistent times are left out.
+    job.creationtime = Time('2021-03-01T10:00:02')
+    job.endtime = None
+    qt = QueryTimings()
+    with qt.activate():
+        record_uws_times(job)
+    assert 'tap_server_queued' not in qt
+    assert 'tap_server_exec' not in qt
@@ -0,0 +1,105 @@
+import io
+
+import numpy as np
+import pytest
+
+from servicemon.cone import Cone
+from servicemon.query_runner import QueryRunner, _parse_query
+from servicemon.ramp import RampRunner, ramp_summary
+from servicemon.tests.local_server import LocalServer
+from servicemon.tests.test_query import votable_bytes
+
+
+def test_ramp_tags_rows(capsys):
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(3))}) as server:
+        args = _parse_query([
+            'fake_services_file',
+            '--cone_file', 'my_cones.py',
+            '--ramp', '1,2', '--step_duration', '0.2'
+        ])
+        args.services = [{'base_name': 'Local', 'service_type': 'cone',
+                          'access_url': server.url('/cone'), 'adql': ''}]
+        args.cone_file = [{'ra': float(i), 'dec': 0.0, 'radius': 0.1} for i in range(3)]
+        args.writers = []
+        qr = QueryRunner(args)
+
+        rows = []
+        qr._collect_stats = lambda stats: rows.append(stats.row_values())
+        qr.run()
+
+    steps = [row['ramp_step'] for row in rows]
+    assert set(steps) == {0, 1}
+    assert steps == sorted(steps)
+    assert all(row['ramp_concurrency'] == row['ramp_step'] + 1 for row in rows)
+    assert list(rows[0].keys())[-2:] == ['ramp_step', 'ramp_concurrency']
+
+    # The cones are cycled through for the whole step.
+    assert {row['RA'] for row in rows} == {0.0, 1.0, 2.0}
+    assert len(rows) > 3
+
+    assert 'throughput' in capsys.readouterr().out
+
+
+def test_ramp_random_cones_for_every_service():
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(3))}) as server:
+        args = _parse_query(['fake_services_file', '--num_cones', '2', '--ramp', '1,2',
+                             '--step_duration', '0.1'])
+        # As sm_query does.
+        args.cone_file = Cone.generate_random(args.num_cones, args.min_radius, args.max_radius)
+        args.services = [{'base_name': name, 'service_type': 'cone',
+                          'access_url': server.url('/cone'), 'adql': ''} for name in ('A', 'B')]
+        args.writers = []
+        qr = QueryRunner(args)
+
+        rows = []
+        qr._collect_stats = lambda stats: rows.append(stats.row_values())
+        RampRunner(qr, [1, 2], 0.3, out=io.StringIO()).run()
+
+    for name in ('A', 'B'):
+        for step in (0, 1):
+            cones = {(row['RA'], row['DEC']) for row in rows
+                     if row['base_name'] == name and row['ramp_step'] == step}
+            assert len(cones) == 2
+
+
+def test_ramp_runner_summary():
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(3))}) as server:
+        args = _parse_query(['fake_services_file', '--num_cones', '2', '--ramp', '1,3'])
+        args.services = [{'base_name': 'Local', 'service_type': 'cone',
+                          'access_url': server.url('/cone'), 'adql': ''}]
+        args.writers = []
+        qr = QueryRunner(args)
+        qr._collect_stats = lambda stats: None
+
+        out = io.StringIO()
+        summary = RampRunner(qr, [1, 3], 0.1, out=out).run()
+
+    assert list(summary['concurrency']) == [1, 3]
+    assert all(summary['queries'] >= summary['concurrency'])
+    assert 'p99' in out.getvalue()
+
+
+def test_ramp_summary():
+    results = [('A', 0, 1, 2.0, {'query_total_dur': float(d), 'errmsg': ':'}) for d in range(1, 101)]
+    results.append(('A', 1, 4, 1.0, {'query_total_dur': None, 'errmsg': 'Timed out'}))
+    summary = ramp_summary(results)
+
+    assert len(summary) == 2
+    first, second = summary
+    assert first['queries'] == 100 and first['errors'] == 0
+    assert first['throughput'] == pytest.approx(50.0)
+    assert first['p50'] == pytest.approx(50.5)
+    assert first['p99'] == pytest.approx(np.percentile(np.arange(1, 101), 99))
+    assert second['concurrency'] == 4 and second['errors'] == 1
+    assert np.isnan(second['p50'])
+
+
+def test_ramp_requires_closed_loop():
+    with pytest.raises(SystemExit):
+        _parse_query(['fake_services_file', '--cone_file', 'my_cones.py',
+                      '--ramp', '1,2', '--arrival', 'fixed', '--arrival_rate', '5'])
+    with pytest.raises(SystemExit):
+        _parse_query(['fake_services_file', '--cone_file', 'my_cones.py', '--ramp', '0,2'])
+    with pytest.raises(SystemExit):
+        _parse_query(['fake_services_file', '--cone_file', 'my_cones.py',
+                      '--ramp', '1,2', '--engine', 'asyncio'])
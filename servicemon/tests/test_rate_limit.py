@@ -0,0 +1,144 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from servicemon.conftest import FakeClock
+from servicemon.rate_limit import TokenBucket, RateLimiter
+from servicemon.query_runner import QueryRunner, HostScheduler, _parse_query
+
+
+def test_token_bucket():
+    clock = FakeClock(100.0)
+    bucket = TokenBucket(2, clock=clock)
+    assert bucket.delay() == 0
+    bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+    clock.now += 0.2
+    assert bucket.delay() == pytest.approx(0.3)
+    clock.now += 0.3
+    assert bucket.delay() == 0
+    bucket.take()
+
+    # Idle time does not accumulate beyond the burst size.
+    clock.now += 10
+    bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+
+    burst = TokenBucket(1, burst=3, clock=clock)
+    for _ in range(3):
+        assert burst.delay() == 0
+        burst.take()
+    assert burst.delay() == pytest.approx(1)
+
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+def test_rate_limiter_service_and_host():
+    clock = FakeClock(100.0)
+    services = {
+        'a1': {'host': 'a', 'max_qps': 1},
+        'a2': {'host': 'a', 'max_qps': None},
+        'b1': {'host': 'b', 'max_qps': 4},
+    }
+    limiter = RateLimiter(lambda s: services[s]['host'], lambda s: s,
+                          lambda s: services[s]['max_qps'], host_max_qps=2, clock=clock)
+
+    limiter.take('a1')
+    assert limiter.delay('a1') == pytest.approx(1)
+    assert limiter.delay('a2') == pytest.approx(0.5)  # The host limit.
+    assert limiter.delay('b1') == 0
+    limiter.take('b1')
+    assert limiter.delay('b1') == pytest.approx(0.5)
+
+    scaled = RateLimiter(lambda s: services[s]['host'], lambda s: s,
+                         lambda s: services[s]['max_qps'], scale=0.5, clock=clock)
+    scaled.take('a1')
+    assert scaled.delay('a1') == pytest.approx(2)
+    assert scaled.delay('a2') == 0
+
+
+def test_scheduler_lets_unlimited_services_go_ahead():
+    clock = FakeClock(100.0)
+    limiter = RateLimiter(lambda s: s, lambda s: s,
+                          lambda s: 1 if s == 'slow' else None, clock=clock)
+    tasks = [(i, None, service) for i in range(3) for service in ('slow', 'fast')]
+    scheduler = HostScheduler(tasks, lambda s: s, rate_limiter=limiter)
+
+    started = []
+    while True:
+        task = scheduler.next_task()
+        if task is None:
+            delay = scheduler.next_ready_in()
+            if delay is None:
+                break
+            clock.now += delay
+            continue
+        started.append((clock.now - 100.0, task[0], task[2]))
+        scheduler.task_done(task)
+
+    assert started == [(0.0, 0, 'slow'), (0.0, 0, 'fast'), (0.0, 1, 'fast'), (0.0, 2, 'fast'),
+                       (1.0, 1, 'slow'), (2.0, 2, 'slow')]
+
+
+def test_scheduler_schedule():
+    clock = FakeClock(100.0)
+    limiter = RateLimiter(lambda s: s, lambda s: s,
+                          lambda s: 1 if s == 'slow' else None, clock=clock)
+    tasks = [(i, None, service) for i in range(3) for service in ('slow', 'fast')]
+    scheduler = HostScheduler(tasks, lambda s: s, per_host_limit=1, rate_limiter=limiter)
+
+    in_flight = []
+    started = []
+
+    def start(task):
+        started.append((clock.now - 100.0, task[0], task[2]))
+        in_flight.append(task)
+
+    timeouts = []
+    for timeout in scheduler.schedule(start, in_flight, 2):
+        timeouts.append(timeout)
+        if in_flight:
+            # The oldest task in flight finishes.
+            scheduler.task_done(in_flight.pop(0))
+        else:
+            clock.now += timeout
+
+    # A wait has a timeout only while there is room for the rate-limited slow
+    # task and its host has none in flight.
+    assert started == [(0.0, 0, 'slow'), (0.0, 0, 'fast'), (0.0, 1, 'fast'), (0.0, 2, 'fast'),
+                       (1.0, 1, 'slow'), (2.0, 2, 'slow')]
+    assert timeouts == [None, 1.0, 1.0, 1.0, 1.0, None, 1.0, None]
+
+
+@pytest.mark.parametrize('workers', ['1', '3'])
+def test_runner_max_qps(workers):
+    args = _parse_query([
+        'fake_services_file',
+        '--cone_file', 'my_cones.py',
+        '--workers', workers
+    ])
+    args.services = [
+        {'base_name': 'Slow', 'service_type': 'cone', 'access_url': 'http://a.example.org/cone',
+         'max_qps': 20},
+        {'base_name': 'Fast', 'service_type': 'cone', 'access_url': 'http://a.example.org/cone2'},
+    ]
+    args.cone_file = [{'ra': float(i), 'dec': 0.0, 'radius': 0.1} for i in range(5)]
+    args.writers = []
+    qr = QueryRunner(args)
+
+    starts = {'Slow': [], 'Fast': []}
+
+    def fake_run_query(index, cone, service):
+        starts[service['base_name']].append(time.monotonic())
+        return SimpleNamespace(stats=None)
+
+    qr._run_query = fake_run_query
+    qr._collect_stats = lambda stats: None
+    qr.run()
+
+    assert len(starts['Slow']) == len(starts['Fast']) == 5
+    slow = starts['Slow']
+    assert all(b - a >= 0.049 for a, b in zip(slow, slow[1:]))
+    assert starts['Fast'][-1] < slow[-1]
@@ -0,0 +1,90 @@
+import csv
+import logging
+
+import pytest
+
+from servicemon.run_all import RunAll, _parse_run_all, sm_run_all
+from servicemon.tests.local_server import LocalServer
+from servicemon.tests.test_query import votable_bytes
+
+
+def make_input(tmp_path, url):
+    input_dir = tmp_path / 'input'
+    for provider, names in (('archive_a', ['a1', 'a2']), ('archive_b', ['b1']),
+                            ('empty', [])):
+        (input_dir / provider).mkdir(parents=True)
+        for name in names:
+            (input_dir / provider / f'{name}_cone.py').write_text(
+                f"[{{'base_name': '{name}', 'service_type': 'cone', "
+                f"'access_url': '{url}', 'adql': ''}}]")
+    (input_dir / 'cones.py').write_text(
+        str([{'ra': float(i), 'dec': 0.0, 'radius': 0.1} for i in range(3)]))
+    return input_dir
+
+
+def test_lanes(tmp_path):
+    input_dir = make_input(tmp_path, 'http://localhost/cone')
+    args = _parse_run_all([str(input_dir), '--cone_file', str(input_dir / 'cones.py')])
+    run_all = RunAll(args)
+    assert list(run_all.lanes) == ['archive_a', 'archive_b']
+    assert [path.rpartition('/')[2] for path, _ in run_all.lanes['archive_a']] == \
+        ['a1_cone.py', 'a2_cone.py']
+    assert len(run_all.lanes['archive_a'][0][1]) == 1
+
+
+@pytest.fixture
+def restore_logging():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield
+    for h in root.handlers[:]:
+        if h not in handlers:
+            root.removeHandler(h)
+            h.close()
+    root.setLevel(level)
+
+
+def test_run_all_shared_writer(tmp_path, restore_logging):
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(4))}) as server:
+        input_dir = make_input(tmp_path, server.url('/cone'))
+        outfile = tmp_path / 'out' / 'all.csv'
+        journal = tmp_path / 'out' / 'all.journal'
+        sm_run_all([str(input_dir), '--cone_file', str(input_dir / 'cones.py'),
+                    '--writer', f'csv_writer:outfile={outfile}',
+                    '--journal', str(journal),
+                    '--script_output_dir', str(tmp_path / 'logs')])
+
+    with open(outfile) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 9
+    assert sorted({row['base_name'] for row in rows}) == ['a1', 'a2', 'b1']
+    assert all(row['num_rows'] == '4' for row in rows)
+
+    assert len(journal.read_text().splitlines()) == 9
+    logs = list((tmp_path / 'logs').iterdir())
+    assert len(logs) == 1
+    assert 'Lane archive_b: finished' in logs[0].read_text()
+
+
+def test_random_cones_shared_by_lanes(tmp_path, restore_logging):
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(4))}) as server:
+        input_dir = make_input(tmp_path, server.url('/cone'))
+        outfile = tmp_path / 'out' / 'all.csv'
+        sm_run_all([str(input_dir), '--num_cones', '2',
+                    '--writer', f'csv_writer:outfile={outfile}'])
+
+    with open(outfile) as f:
+        rows = list(csv.DictReader(f))
+    # Every service file of every lane gets the same two cones.
+    assert sorted(row['base_name'] for row in rows) == ['a1', 'a1', 'a2', 'a2', 'b1', 'b1']
+    cones = {}
+    for row in rows:
+        cones.setdefault(row['base_name'], set()).add((row['RA'], row['DEC']))
+    assert len(cones['a1']) == 2
+    assert cones['a1'] == cones['a2'] == cones['b1']
+
+
+def test_input_dir_must_exist(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        _parse_run_all([str(tmp_path / 'missing'), '--num_cones', '3'])
+    assert 'is not a directory' in capsys.readouterr().err
@@ -0,0 +1,60 @@
+from servicemon.session_pool import SessionPool
+from servicemon.tests.local_server import LocalServer
+
+
+def test_sessions_per_host():
+    pool = SessionPool(pool_size=3, agent='MyAgent/1.0')
+    s1 = pool.get('http://a.example.org/cone?RA=1')
+    s2 = pool.get('http://a.example.org/tap/sync')
+    s3 = pool.get('https://a.example.org/cone')
+    s4 = pool.get('http://b.example.org/cone')
+    assert s1 is s2
+    assert s1 is not s3
+    assert s1 is not s4
+    assert s1.headers['User-Agent'] == 'MyAgent/1.0'
+    assert s1.get_adapter('http://a.example.org/')._pool_maxsize == 3
+    pool.close()
+    assert pool.get('http://a.example.org/cone') is not s1
+
+
+def test_cold_sessions():
+    pool = SessionPool(cold=True)
+    s1 = pool.get('http://a.example.org/cone')
+    s2 = pool.get('http://a.example.org/cone')
+    assert s1 is not s2
+    assert s1.headers['Connection'] == 'close'
+
+
+def test_connection_reuse():
+    with LocalServer({'/cone': (200, 'text/xml', b'<VOTABLE/>')}) as server:
+        pool = SessionPool()
+        for _ in range(3):
+            response = pool.get(server.url()).get(server.url('/cone'))
+            assert response.content == b'<VOTABLE/>'
+        assert server.connections == 1
+        pool.close()
+
+        pool = SessionPool(cold=True)
+        for _ in range(3):
+            response = pool.get(server.url()).get(server.url('/cone'))
+            assert response.content == b'<VOTABLE/>'
+        assert server.connections == 4
+
+
+def test_cold_sessions_are_released(monkeypatch):
+    closed = []
+    monkeypatch.setattr('requests.Session.close', lambda session: closed.append(session))
+
+    pool = SessionPool(cold=True)
+    s1 = pool.get('http://a.example.org/cone')
+    s2 = pool.get('http://a.example.org/cone')
+    pool.release(s1)
+    assert closed == [s1]
+    pool.close()
+    assert closed == [s1, s2]
+
+    pool = SessionPool()
+    s3 = pool.get('http://a.example.org/cone')
+    pool.release(s3)
+    assert closed == [s1, s2]
+    assert pool.get('http://a.example.org/cone') is s3
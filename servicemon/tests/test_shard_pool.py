@@ -0,0 +1,102 @@
+import pytest
+
+from servicemon.cone import Cone
+from servicemon.query_runner import QueryRunner, _parse_query
+from servicemon.tests.local_server import LocalServer
+from servicemon.tests.test_query import votable_bytes
+
+
+def test_processes_merge_by_start_time():
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(3))}) as server:
+        args = _parse_query([
+            'fake_services_file',
+            '--cone_file', 'my_cones.py',
+            '--processes', '2', '--shard_by', 'round_robin',
+            '--start_index', '1', '--cone_limit', '5'
+        ])
+        args.services = [{'base_name': 'Local', 'service_type': 'cone',
+                          'access_url': server.url('/cone'), 'adql': ''}]
+        args.cone_file = [{'ra': float(i), 'dec': 0.0, 'radius': 0.1} for i in range(8)]
+        args.writers = []
+        qr = QueryRunner(args)
+
+        rows = []
+        qr._collect_stats = lambda stats: rows.append(stats.row_values())
+        qr.run()
+
+    assert sorted(row['RA'] for row in rows) == [1.0, 2.0, 3.0, 4.0, 5.0]
+    start_times = [row['start_time'] for row in rows]
+    assert start_times == sorted(start_times)
+    assert all(row['num_rows'] == 3 for row in rows)
+
+
+def test_processes_with_random_cones():
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(3))}) as server:
+        args = _parse_query(['fake_services_file', '--num_cones', '3', '--processes', '2'])
+        # As sm_query does.
+        args.cone_file = Cone.generate_random(args.num_cones, args.min_radius, args.max_radius)
+        args.services = [{'base_name': 'Local', 'service_type': 'cone',
+                          'access_url': server.url('/cone'), 'adql': ''}]
+        args.writers = []
+        qr = QueryRunner(args)
+
+        rows = []
+        qr._collect_stats = lambda stats: rows.append(stats.row_values())
+        qr.run()
+
+    assert len(rows) == 3
+    assert len({(row['RA'], row['DEC']) for row in rows}) == 3
+
+
+def test_processes_journal_and_resume(tmp_path):
+    journal_file = tmp_path / 'run.journal'
+    journal_file.write_text('1\tLocal_cone\n3\tLocal_cone\n')
+
+    with LocalServer({'/cone': (200, 'text/xml', votable_bytes(3))}) as server:
+        args = _parse_query([
+            'fake_services_file',
+            '--cone_file', 'my_cones.py',
+            '--processes', '2',
+            '--journal', str(journal_file), '--resume'
+        ])
+        args.services = [{'base_name': 'Local', 'service_type': 'cone',
+                          'access_url': server.url('/cone'), 'adql': ''}]
+        args.cone_file = [{'ra': float(i), 'dec': 0.0, 'radius': 0.1} for i in range(5)]
+        args.writers = []
+        qr = QueryRunner(args)
+
+        rows = []
+        qr._collect_stats = lambda stats: rows.append(stats.row_values())
+        qr.run()
+
+    assert sorted(row['RA'] for row in rows) == [0.0, 2.0, 4.0]
+    lines = journal_file.read_text().splitlines()
+    assert sorted(lines) == [f'{i}\tLocal_cone' for i in range(5)]
+
+
+def test_processes_share_per_host_limit(capsys):
+    args = _parse_query(['fake_services_file', '--cone_file', 'my_cones.py',
+                         '--workers', '4', '--per_host_limit', '5'])
+    args.services = [{'base_name': 'Local', 'service_type': 'cone',
+                      'access_url': 'http://a.example.org/cone', 'adql': ''}]
+    args.cone_file = []
+
+    assert QueryRunner(args)._new_scheduler([])._per_host_limit == 5
+    limits = [QueryRunner(args, shard=(i, 3))._new_scheduler([])._per_host_limit for i in range(3)]
+    assert limits == [2, 2, 1]
+    args.per_host_limit = 3
+    limits = [QueryRunner(args, shard=(i, 3))._new_scheduler([])._per_host_limit for i in range(3)]
+    assert limits == [1, 1, 1]
+
+    with pytest.raises(SystemExit):
+        _parse_query(['fake_services_file', '--cone_file', 'my_cones.py',
+                      '--processes', '4', '--per_host_limit', '2'])
+    assert '--per_host_limit must be at least --processes' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('overlap', [['--workers', '2'], ['--tap_pipeline', '2'],
+                                     ['--arrival', 'poisson', '--arrival_rate', '5']])
+def test_processes_rejected_with_overlap(overlap, capsys):
+    with pytest.raises(SystemExit):
+        _parse_query(['fake_services_file', '--cone_file', 'my_cones.py', '--processes', '2'] + overlap)
+    assert 'argument --processes cannot be used with --workers' in capsys.readouterr().err
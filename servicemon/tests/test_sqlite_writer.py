@@ -0,0 +1,84 @@
+import time
+import sqlite3
+
+from servicemon.plugin_support import SmPluginSupport, AbstractResultWriter
+from servicemon.query_runner import _parse_query
+from servicemon.tests.test_parquet_writer import make_stats
+
+
+def begin_writer(tmp_path, outfile, extra_kwargs=''):
+    SmPluginSupport.load_builtin_plugins()
+    args = _parse_query(['fake_services_file.py', '--cone_file', 'my_cones.py',
+                         '--result_dir', str(tmp_path)])
+    plugin = AbstractResultWriter.get_plugin_from_spec(f'sqlite_writer:outfile={outfile}{extra_kwargs}')
+    writer = plugin.cls()
+    writer.begin(args, **plugin.kwargs)
+    return writer
+
+
+def count_rows(outfile):
+    conn = sqlite3.connect(str(outfile))
+    try:
+        return conn.execute('select count(*) from results').fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
+
+
+def test_sqlite_writer(tmp_path):
+    outfile = tmp_path / 'db' / 'results.sqlite'
+    writer = begin_writer(tmp_path, outfile, ',batch_rows=4,batch_seconds=3600')
+
+    # Rows are committed four at a time.
+    for i in range(7):
+        writer.one_result(make_stats(i))
+        assert count_rows(outfile) == (i + 1) // 4 * 4
+    writer.end()
+    assert count_rows(outfile) == 7
+
+    conn = sqlite3.connect(str(outfile))
+    assert conn.execute('pragma journal_mode').fetchone()[0] == 'wal'
+    indexes = conn.execute("select sql from sqlite_master where type = 'index'").fetchall()
+    assert any('(base_name, service_type, start_time)' in sql for sql, in indexes)
+
+    rows = conn.execute('select base_name, RA, num_rows, status, query_total_dur, extra_dur0_name, '
+                        'extra_dur1_value, start_time from results order by RA').fetchall()
+    assert rows[1][:7] == ('HSC', 11.0, 1, '200', 1.5, 'ttfb', None)
+    assert rows[3][2:4] == (None, 'timeout')
+    assert rows[0][7] <= rows[6][7]
+
+    plan = conn.execute("explain query plan select * from results where base_name = 'HSC' "
+                        "and service_type = 'cone' order by start_time").fetchall()
+    assert 'results_service_time' in str(plan)
+    conn.close()
+
+
+def test_sqlite_writer_appends(tmp_path):
+    outfile = tmp_path / 'results.sqlite'
+    writer = begin_writer(tmp_path, outfile, ',batch_seconds=0')
+    writer.one_result(make_stats(0))
+    assert count_rows(outfile) == 1
+    writer.end()
+
+    writer = begin_writer(tmp_path, outfile)
+    writer.one_result(make_stats(1))
+    writer.end()
+    assert count_rows(outfile) == 2
+
+
+def test_sqlite_writer_commits_when_idle(tmp_path):
+    outfile = tmp_path / 'results.sqlite'
+    writer = begin_writer(tmp_path, outfile, ',batch_rows=100,batch_seconds=0.5')
+    writer.one_result(make_stats(0))
+    writer.one_result(make_stats(1))
+    assert count_rows(outfile) == 0
+
+    # No more rows arrive, but the waiting ones are committed on time.
+    for _ in range(50):
+        if count_rows(outfile) == 2:
+            break
+        time.sleep(0.05)
+    assert count_rows(outfile) == 2
+    writer.end()
+    assert count_rows(outfile) == 2
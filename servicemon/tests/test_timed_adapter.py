@@ -0,0 +1,30 @@
+from servicemon.query_timing import QueryTimings
+from servicemon.session_pool import SessionPool
+from servicemon.tests.local_server import LocalServer
+from servicemon.timing_labels import DNS, CONNECT, TLS_HANDSHAKE, TTFB, TRANSFER
+
+
+def test_phase_timings():
+    body = b'x' * 100000
+    with LocalServer({'/cone': (200, 'text/xml', body)}) as server:
+        session = SessionPool().get(server.url())
+
+        first = QueryTimings()
+        with first.activate():
+            response = session.get(server.url('/cone'), stream=True)
+            assert b''.join(response.iter_content(chunk_size=8096)) == body
+        for label in (DNS, CONNECT, TTFB, TRANSFER):
+            assert first.get(label) > 0
+        assert TLS_HANDSHAKE not in first
+
+        # The keep-alive connection is reused, so there is no connection setup.
+        second = QueryTimings()
+        with second.activate():
+            response = session.get(server.url('/cone'))
+            assert response.content == body
+        assert DNS not in second
+        assert CONNECT not in second
+        assert second.get(TTFB) > 0
+        assert second.get(TRANSFER) > 0
+
+        assert server.connections == 1
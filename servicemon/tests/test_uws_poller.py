@@ -0,0 +1,98 @@
+import re
+import threading
+
+import pytest
+
+from servicemon.deadline import QueryTimeout
+from servicemon.pyvo_wrappers import TAPServiceSM
+from servicemon.session_pool import SessionPool
+from servicemon.tests.local_server import LocalServer, FakeTapService
+from servicemon.tests.test_query import votable_bytes
+from servicemon.uws_poller import UwsPoller, _TimerWheel
+
+
+def test_timer_wheel():
+    wheel = _TimerWheel(0.5, slots=4)
+    wheel.add('a', 0.5)
+    wheel.add('b', 1.2)
+    wheel.add('c', 2.0)
+    wheel.add('d', 5.0)
+    assert len(wheel) == 4
+
+    due = [wheel.advance() for _ in range(10)]
+    assert due == [['a'], [], ['b'], ['c'], [], [], [], [], [], ['d']]
+    assert len(wheel) == 0
+
+
+def submit_jobs(server, count):
+    pool = SessionPool()
+    tap = TAPServiceSM(server.url('/tap'), session=pool.get(server.url('/tap')))
+    return [tap.submit_async_timed('select * from t') for _ in range(count)]
+
+
+@pytest.mark.parametrize('version', ['1.0', '1.1'])
+def test_many_jobs_few_threads(monkeypatch, version):
+    monkeypatch.setattr(UwsPoller, '_first_interval', 0.01)
+    tap = FakeTapService(votable_bytes(3), version=version, polls_to_complete=3)
+    with LocalServer(tap) as server:
+        jobs = submit_jobs(server, 12)
+        submitted = len(server.requests)
+        poller = UwsPoller(threads=2, tick=0.01)
+
+        done = []
+        # Hold the polling threads back until every job is being watched.
+        with poller._cond:
+            watches = [poller.watch(job, done.append) for job in jobs]
+        for w in watches:
+            assert w.done.wait(10)
+        poll_threads = [t for t in threading.enumerate() if t.name.startswith('sm_uws')]
+        assert len(poll_threads) == poller.threads == 3
+        poller.close()
+
+        # One connection was used to submit the jobs, and at most one more per thread.
+        assert server.connections <= 3
+
+        polls = job_polls(server, submitted)
+
+    assert done == [None] * 12
+    assert all(job.phase == 'COMPLETED' for job in jobs)
+    # With more jobs than threads, no thread is held by a WAIT.
+    assert not any('WAIT=' in path for path in polls[:12])
+
+
+def job_polls(server, start=0):
+    return [path for method, path, _ in server.requests[start:]
+            if method == 'GET' and re.fullmatch(r'/tap/async/job\d+(\?.*)?', path)]
+
+
+def test_wait_with_a_free_thread(monkeypatch):
+    monkeypatch.setattr(UwsPoller, '_first_interval', 0.01)
+    tap = FakeTapService(votable_bytes(3), version='1.1', polls_to_complete=2)
+    with LocalServer(tap) as server:
+        job, = submit_jobs(server, 1)
+        submitted = len(server.requests)
+        poller = UwsPoller(threads=2, tick=0.01)
+        poller.wait(job)
+        poller.close()
+        polls = job_polls(server, submitted)
+
+    assert job.phase == 'COMPLETED'
+    assert polls and all('WAIT=' in path for path in polls)
+
+
+def test_wait_raises_job_errors_and_timeouts(monkeypatch):
+    monkeypatch.setattr(UwsPoller, '_first_interval', 0.01)
+    tap = FakeTapService(votable_bytes(3), version='1.0', polls_to_complete=10 ** 6)
+    with LocalServer(tap) as server:
+        job, = submit_jobs(server, 1)
+        poller = UwsPoller(threads=1, tick=0.01)
+        with pytest.raises(QueryTimeout):
+            poller.wait(job, total_timeout=0.3)
+
+        tap.jobs['job1']['phase'] = 'UNKNOWN_PHASE'
+        with pytest.raises(Exception, match='not active'):
+            poller.wait(job)
+        poller.close()
+
+    with pytest.raises(RuntimeError):
+        poller.watch(job, print)
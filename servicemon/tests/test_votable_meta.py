@@ -0,0 +1,89 @@
+import io
+import warnings
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from astropy.io.votable import from_table, writeto
+
+from servicemon.votable_meta import VOTableMetaExtractor
+
+
+def make_votable(nrows, tabledata_format, variable=False):
+    t = Table({
+        'i': np.arange(nrows),
+        's': [('x' * (i % 7)) for i in range(nrows)],
+        'f': np.linspace(0, 1, nrows),
+        'arr': np.ones((nrows, 3), dtype=np.int16),
+        'b': [i % 2 == 0 for i in range(nrows)],
+    })
+    votable = from_table(t)
+    if variable:
+        votable.get_first_table().get_field_by_id('s').arraysize = '*'
+    buf = io.BytesIO()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        writeto(votable, buf, tabledata_format=tabledata_format)
+    return buf.getvalue()
+
+
+def extract(data, chunk_size):
+    meta = VOTableMetaExtractor()
+    for i in range(0, len(data), chunk_size):
+        meta.feed(data[i:i + chunk_size])
+    meta.close()
+    return meta
+
+
+@pytest.mark.parametrize('tabledata_format', ['tabledata', 'binary', 'binary2'])
+@pytest.mark.parametrize('variable', [False, True])
+@pytest.mark.parametrize('chunk_size', [7, 8096])
+def test_matches_table_read(tabledata_format, variable, chunk_size):
+    data = make_votable(250, tabledata_format, variable=variable)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        t = Table.read(io.BytesIO(data), format='votable')
+
+    meta = extract(data, chunk_size)
+    meta.raise_if_error()
+    assert meta.size == len(data)
+    assert meta.num_rows == len(t)
+    assert meta.num_columns == len(t.columns)
+
+
+def test_empty_table_and_query_status():
+    data = b"""<?xml version="1.0"?>
+<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">
+ <RESOURCE type="results">
+  <INFO name="QUERY_STATUS" value="OK"/>
+  <TABLE>
+   <FIELD name="a" datatype="int"/>
+   <FIELD name="b" datatype="char" arraysize="*"/>
+  </TABLE>
+  <INFO name="QUERY_STATUS" value="OVERFLOW"/>
+ </RESOURCE>
+</VOTABLE>
+"""
+    meta = extract(data, 10)
+    meta.raise_if_error()
+    assert meta.num_rows == 0
+    assert meta.num_columns == 2
+    assert meta.query_status == 'OVERFLOW'
+
+
+def test_errors():
+    data = b"""<?xml version="1.0"?>
+<VOTABLE version="1.3">
+ <RESOURCE type="results">
+  <INFO name="QUERY_STATUS" value="ERROR">Bad query</INFO>
+ </RESOURCE>
+</VOTABLE>
+"""
+    meta = extract(data, 10)
+    assert meta.query_status == 'ERROR'
+    with pytest.raises(ValueError, match='No table found'):
+        meta.raise_if_error()
+
+    meta = extract(b'<html><body>Service unavailable</body>', 10)
+    with pytest.raises(ValueError, match='Unable to parse VOTable'):
+        meta.raise_if_error()
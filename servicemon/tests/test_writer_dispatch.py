@@ -0,0 +1,237 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from servicemon.query_runner import QueryRunner, _parse_query
+from servicemon.writer_dispatch import WriterDispatch
+from servicemon.tests.test_parquet_writer import make_stats
+
+
+class ListWriter():
+    # Not an AbstractResultWriter, which would register it as a plugin.
+    def __init__(self, delay=0.0, gate=None):
+        self.rows = []
+        self.delay = delay
+        self.gate = gate
+        self.started = threading.Event()
+        self.threads = set()
+
+    def begin(self, args, **kwargs):
+        pass
+
+    def end(self):
+        pass
+
+    def one_result(self, stats):
+        self.started.set()
+        if self.gate is not None:
+            self.gate.wait()
+        time.sleep(self.delay)
+        self.threads.add(threading.current_thread().name)
+        self.rows.append(stats.row_values()['name'])
+
+
+def stats_list(n):
+    return [make_stats(i) for i in range(n)]
+
+
+def names(*indexes):
+    return [f'HSC_cone_{i}' for i in indexes]
+
+
+def test_slow_writer_does_not_delay():
+    slow = ListWriter(delay=0.05)
+    fast = ListWriter()
+    dispatch = WriterDispatch([slow, fast], queue_size=100)
+
+    start = time.perf_counter()
+    for stats in stats_list(10):
+        dispatch.put(stats)
+    assert time.perf_counter() - start < 0.25
+
+    dispatch.close()
+    assert slow.rows == names(*range(10))
+    assert fast.rows == names(*range(10))
+    assert slow.threads == {'sm_writer0'}
+    assert fast.threads == {'sm_writer1'}
+
+    metrics = dispatch.metrics()
+    assert list(metrics['writer']) == ['ListWriter', 'ListWriter']
+    assert list(metrics['written']) == [10, 10]
+    assert metrics['mean'][0] >= 0.05
+    assert metrics['p95'][1] < metrics['p95'][0] <= metrics['max'][0]
+
+
+def test_drop_oldest():
+    gate = threading.Event()
+    writer = ListWriter(gate=gate)
+    dispatch = WriterDispatch([writer], queue_size=3, overflow='drop_oldest')
+
+    all_stats = stats_list(6)
+    dispatch.put(all_stats[0])
+    # The writer holds the first stats until the gate opens.
+    assert writer.started.wait(5)
+    for stats in all_stats[1:]:
+        dispatch.put(stats)
+    gate.set()
+    dispatch.close()
+
+    assert writer.rows == names(0, 3, 4, 5)
+    metrics = dispatch.metrics()
+    assert metrics['dropped'][0] == 2
+    assert metrics['max_depth'][0] == 3
+
+
+def test_spill_keeps_order(tmp_path):
+    gate = threading.Event()
+    writer = ListWriter(gate=gate)
+    dispatch = WriterDispatch([writer], queue_size=2, overflow='spill', spill_dir=str(tmp_path / 'spill'))
+
+    all_stats = stats_list(8)
+    dispatch.put(all_stats[0])
+    assert writer.started.wait(5)
+    for stats in all_stats[1:]:
+        dispatch.put(stats)
+    gate.set()
+    dispatch.close()
+
+    # Two are queued behind the first, and the rest spilled and read back in order.
+    assert writer.rows == names(*range(8))
+    metrics = dispatch.metrics()
+    assert metrics['spilled'][0] == 5
+    assert metrics['max_depth'][0] == 2
+    assert metrics['written'][0] == 8
+    assert metrics['dropped'][0] == 0
+
+
+def test_block_waits_for_room():
+    writer = ListWriter(delay=0.02)
+    dispatch = WriterDispatch([writer], queue_size=1, overflow='block')
+    for stats in stats_list(5):
+        dispatch.put(stats)
+    dispatch.close()
+
+    assert writer.rows == names(*range(5))
+    assert dispatch.metrics()['max_depth'][0] == 1
+
+
+def test_written_completes_after_every_writer():
+    gate = threading.Event()
+    slow = ListWriter(gate=gate)
+    fast = ListWriter()
+    dispatch = WriterDispatch([slow, fast], queue_size=2, overflow='spill')
+
+    written = [dispatch.put(stats) for stats in stats_list(4)]
+    assert fast.started.wait(5)
+    assert not any(future.done() for future in written)
+    gate.set()
+    dispatch.close()
+
+    # The spilled stats complete too.
+    assert all(future.result(0) is None for future in written)
+
+
+def test_dropped_and_failed_are_not_written():
+    class FailingWriter(ListWriter):
+        def one_result(self, stats):
+            super().one_result(stats)
+            if stats.row_values()['name'] == 'HSC_cone_0':
+                raise RuntimeError('disk full')
+
+    gate = threading.Event()
+    writer = FailingWriter(gate=gate)
+    dispatch = WriterDispatch([writer], queue_size=1, overflow='drop_oldest')
+
+    all_stats = stats_list(3)
+    written = [dispatch.put(all_stats[0])]
+    assert writer.started.wait(5)
+    written += [dispatch.put(stats) for stats in all_stats[1:]]
+    gate.set()
+    dispatch.close()
+
+    assert writer.rows == names(0, 2)
+    assert 'disk full' in str(written[0].exception(0))
+    assert 'Dropped' in str(written[1].exception(0))
+    assert written[2].result(0) is None
+
+
+def test_writer_errors_are_counted():
+    class FailingWriter(ListWriter):
+        def one_result(self, stats):
+            super().one_result(stats)
+            if stats.row_values()['name'] == 'HSC_cone_1':
+                raise RuntimeError('disk full')
+
+    writer = FailingWriter()
+    dispatch = WriterDispatch([writer])
+    for stats in stats_list(3):
+        dispatch.put(stats)
+    dispatch.close()
+
+    assert writer.rows == names(0, 1, 2)
+    metrics = dispatch.metrics()
+    assert metrics['errors'][0] == 1
+    assert metrics['written'][0] == 2
+
+
+def test_bad_arguments():
+    with pytest.raises(ValueError):
+        WriterDispatch([], queue_size=0)
+    with pytest.raises(ValueError):
+        WriterDispatch([], overflow='drop_newest')
+
+
+def test_runner_drains_dispatch_before_end(tmp_path):
+    class EndingWriter(ListWriter):
+        def end(self):
+            self.rows_at_end = list(self.rows)
+
+    args = _parse_query(['fake_services_file', '--cone_file', 'my_cones.py',
+                         '--result_dir', str(tmp_path), '--writer_queue', '2'])
+    args.services = [{'base_name': 'HSC', 'service_type': 'cone', 'access_url': 'http://example.org/cone'}]
+    args.cone_file = [{'ra': 10.0, 'dec': 20.0, 'radius': 0.1}]
+    args.writers = []
+    writer = EndingWriter(delay=0.01)
+    qr = QueryRunner(args, writers=[writer])
+    qr._run_with_cones = lambda: [qr._output_stats_row(stats) for stats in stats_list(6)]
+    qr.run()
+
+    assert qr._dispatch is not None
+    assert writer.rows_at_end == names(*range(6))
+    assert writer.threads == {'sm_writer0'}
+
+
+def test_journal_waits_for_writers(tmp_path):
+    class FailingWriter(ListWriter):
+        def one_result(self, stats):
+            if stats == 'bad':
+                raise RuntimeError('disk full')
+            self.rows.append(stats)
+
+    class RecordingJournal():
+        def __init__(self):
+            self.records = []
+
+        def is_completed(self, cone_index, service_key):
+            return False
+
+        def record(self, cone_index, service_key):
+            # Whether the writer had the row when it was journaled.
+            self.records.append((cone_index, cone_index in writer.rows))
+
+    args = _parse_query(['fake_services_file', '--cone_file', 'my_cones.py',
+                         '--result_dir', str(tmp_path), '--writer_queue', '2'])
+    args.services = [{'base_name': 'HSC', 'service_type': 'cone', 'access_url': 'http://example.org/cone'}]
+    args.cone_file = [{'ra': float(i), 'dec': 20.0, 'radius': 0.1} for i in range(4)]
+    args.writers = []
+    writer = FailingWriter(delay=0.01)
+    journal = RecordingJournal()
+    qr = QueryRunner(args, writers=[writer], journal=journal)
+    qr._run_query = lambda index, cone, service: SimpleNamespace(
+        stats='bad' if index == 2 else index, skipped=False)
+    qr.run()
+
+    assert writer.rows == [0, 1, 3]
+    assert journal.records == [(0, True), (1, True), (3, True)]
@@ -0,0 +1,159 @@
+"""
+A requests transport adapter that splits each request into its connection phases.
+
+The phases are recorded into the current `~servicemon.query_timing.QueryTimings`:
+
+dns
+    Name resolution for a new connection.
+connect
+    TCP connect for a new connection.
+tls_handshake
+    TLS handshake for a new https connection.
+ttfb
+    From the request being sent until the response status line and headers
+    have been read.
+transfer
+    Time spent reading the response body from the socket.
+
+dns, connect and tls_handshake are only recorded when a new connection is made,
+so they are absent for requests that reuse a keep-alive connection.
+Durations of the same phase from several requests (e.g., the UWS requests of an
+async TAP query) accumulate.
+"""
+import http.client
+import socket
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NameResolutionError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+from .deadline import current_deadline
+from .query_timing import timed, record_duration
+from .timing_labels import DNS, CONNECT, TLS_HANDSHAKE, TTFB, TRANSFER
+
+__all__ = ['TimedHTTPAdapter']
+
+
+class TimedHTTPResponse(http.client.HTTPResponse):
+    """
+    Times reading the status line and headers (ttfb) and the body (transfer).
+    The socket is shut down if the current deadline is reached while the
+    response is being read.
+    """
+
+    _in_read = False
+
+    def __init__(self, sock, *args, **kwargs):
+        super().__init__(sock, *args, **kwargs)
+        deadline = current_deadline()
+        if deadline is not None and deadline.total is not None:
+            deadline.watch(sock)
+
+    def begin(self):
+        with timed(TTFB):
+            super().begin()
+
+    def read(self, amt=None):
+        return self._timed_read(super().read, amt)
+
+    def read1(self, n=-1):
+        return self._timed_read(super().read1, n)
+
+    def readinto(self, b):
+        return self._timed_read(super().readinto, b)
+
+    def _timed_read(self, method, arg):
+        # read() is implemented with readinto(), so only time the outermost call.
+        if self._in_read:
+            return method(arg)
+        self._in_read = True
+        try:
+            with timed(TRANSFER):
+                return method(arg)
+        finally:
+            self._in_read = False
+
+
+class _TimedConnectionMixin():
+    response_class = TimedHTTPResponse
+
+    # Seconds spent in the most recent _new_conn().
+    _new_conn_elapsed = 0.0
+
+    def _new_conn(self):
+        start = time.perf_counter()
+        try:
+            with timed(DNS):
+                try:
+                    addresses = socket.getaddrinfo(self._dns_host, self.port,
+                                                   allowed_gai_family(), socket.SOCK_STREAM)
+                except socket.gaierror as e:
+                    raise NameResolutionError(self.host, self, e) from e
+                if not addresses:
+                    raise NameResolutionError(self.host, self,
+                                              socket.gaierror('getaddrinfo returned no addresses'))
+
+            # Connect to the resolved addresses in order, as create_connection() would,
+            # without resolving the name again.
+            dns_host = self._dns_host
+            error = None
+            with timed(CONNECT):
+                try:
+                    for address in addresses:
+                        self._dns_host = address[4][0]
+                        try:
+                            return super()._new_conn()
+                        except NewConnectionError as e:
+                            error = e
+                finally:
+                    self._dns_host = dns_host
+            raise error
+        finally:
+            self._new_conn_elapsed = time.perf_counter() - start
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+
+    def connect(self):
+        self._new_conn_elapsed = 0.0
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            elapsed = time.perf_counter() - start
+            record_duration(TLS_HANDSHAKE, elapsed - self._new_conn_elapsed)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter whose connections record their phase timings, and whose
+    requests are limited by the current `~servicemon.deadline.Deadline`, if any.
+    """
+
+    def send(self, request, timeout=None, **kwargs):
+        deadline = current_deadline()
+        if deadline is not None:
+            timeout = deadline.request_timeout(timeout)
+        return super().send(request, timeout=timeout, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
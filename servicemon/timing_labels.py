@@ -7,7 +7,14 @@ __all__ = [
     'TAP_WAIT',
     'TAP_RAISE_IF_ERROR',
     'TAP_FETCH_RESPONSE',
-    'TAP_DELETE'
+    'TAP_DELETE',
+    'TAP_SERVER_QUEUED',
+    'TAP_SERVER_EXEC',
+    'DNS',
+    'CONNECT',
+    'TLS_HANDSHAKE',
+    'TTFB',
+    'TRANSFER'
 ]
 
 DO_QUERY = 'do_query'
@@ -21,3 +28,14 @@ TAP_WAIT = 'tap_wait'
 TAP_RAISE_IF_ERROR = 'tap_raise_if_error'
 TAP_FETCH_RESPONSE = 'tap_fetch_response'
 TAP_DELETE = 'tap_delete'
+
+# Server-side phases of an async TAP job, from the times in its UWS job document
+TAP_SERVER_QUEUED = 'tap_server_queued'
+TAP_SERVER_EXEC = 'tap_server_exec'
+
+# Connection phases of each HTTP request, summed over the requests of a query
+DNS = 'dns'
+CONNECT = 'connect'
+TLS_HANDSHAKE = 'tls_handshake'
+TTFB = 'ttfb'
+TRANSFER = 'transfer'
@@ -0,0 +1,278 @@
+"""
+A shared poller for all the outstanding UWS jobs of a run.
+
+Without it, each async TAP query polls its own job, sleeping between polls of
+a UWS 1.0 job or holding a connection open for a UWS 1.1 WAIT request, so every
+job in flight ties up a thread or a connection.  The poller instead polls every
+job from a fixed number of threads.  Jobs are scheduled on a timer wheel, with
+the same growing intervals as `~servicemon.pyvo_wrappers.AsyncTAPSM.wait`, and
+polled with a plain GET of the job.  A blocking WAIT request holds its thread
+for as long as the job does not change, so UWS 1.1 jobs are only polled with
+WAIT while there are fewer jobs than threads, which leaves a thread free for
+any new job.  Whoever is waiting on a job is notified when it reaches a final
+phase, fails, or runs out of time.
+"""
+import collections
+import contextvars
+import logging
+import math
+import threading
+import time
+from distutils.version import LooseVersion
+
+from .deadline import QueryTimeout, current_deadline
+
+__all__ = ['UwsPoller']
+
+
+class UwsPoller():
+    """
+    Polls UWS jobs from a bounded set of threads.
+
+    Parameters
+    ----------
+    threads : int
+        Number of polling threads, and so the most polls, and connections,
+        in use at once.
+    tick : float
+        Seconds per slot of the timer wheel for UWS 1.0 jobs.
+    wait : float
+        Seconds for the WAIT requests of UWS 1.1 jobs.
+    request_timeout : float
+        Timeout for UWS 1.0 polls.
+    clock : callable
+        Returns the current time in seconds.
+    """
+
+    _first_interval = 1.0
+    _increment = 1.2
+    _max_interval = 120.0
+
+    def __init__(self, threads=4, tick=0.1, wait=30.0, request_timeout=30.0, clock=time.monotonic):
+        if threads < 1:
+            raise ValueError(f'Number of threads must be at least 1: {threads}')
+        self._nthreads = threads
+        self._wait = wait
+        self._request_timeout = request_timeout
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._ready = collections.deque()
+        self._wheel = _TimerWheel(tick)
+        self._watches = set()
+        self._threads = []
+        self._closed = False
+
+    @property
+    def threads(self):
+        """
+        Number of threads the poller has started.
+        """
+        return len(self._threads)
+
+    def watch(self, job, callback, phases=None, total_timeout=120):
+        """
+        Poll job until it reaches one of phases, then call callback(None).  If
+        polling fails, or the job is still running after total_timeout seconds
+        or at the current deadline, callback(exception) is called instead.
+
+        The job is polled in a copy of the current context, so its requests
+        are timed and limited as those of the query that started it.  callback
+        is called from a polling thread.
+
+        Returns
+        -------
+        An object whose done attribute is a threading.Event set when the
+        callback has been called.
+        """
+        expires = total_timeout
+        deadline = current_deadline()
+        if deadline is not None and deadline.remaining() is not None:
+            expires = min(expires, deadline.remaining())
+
+        w = _Watch(job, phases or {'COMPLETED', 'ABORTED', 'ERROR'}, callback,
+                   contextvars.copy_context(), self._clock() + expires, total_timeout,
+                   LooseVersion(job._job.version) >= LooseVersion('1.1'), self._first_interval)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('The UWS poller is closed')
+            self._start_threads()
+            self._watches.add(w)
+            if w.wait_for_statechange:
+                self._ready.append(w)
+            else:
+                self._wheel.add(w, min(w.interval, expires))
+            self._cond.notify_all()
+        return w
+
+    def wait(self, job, phases=None, total_timeout=120):
+        """
+        Block until job reaches one of phases, as for
+        `~servicemon.pyvo_wrappers.AsyncTAPSM.wait`.  Raises the exception that
+        ended the polling, if any.
+        """
+        errors = []
+        w = self.watch(job, errors.append, phases=phases, total_timeout=total_timeout)
+        w.done.wait()
+        if errors[0] is not None:
+            raise errors[0]
+        return job
+
+    def close(self):
+        """
+        Stop the polling threads.  Jobs still being watched fail.
+        """
+        with self._cond:
+            self._closed = True
+            watches = list(self._watches)
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        for w in watches:
+            self._finish(w, RuntimeError('The UWS poller was closed'))
+
+    def _start_threads(self):
+        if self._threads:
+            return
+        for i in range(self._nthreads):
+            self._threads.append(threading.Thread(target=self._poll_loop, name=f'sm_uws_poll{i}',
+                                                  daemon=True))
+        self._threads.append(threading.Thread(target=self._wheel_loop, name='sm_uws_wheel',
+                                              daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _wheel_loop(self):
+        """
+        Move the UWS 1.0 jobs that are due to the ready queue, one tick at a time.
+        """
+        next_tick = self._clock() + self._wheel.tick
+        with self._cond:
+            while not self._closed:
+                if not self._wheel:
+                    self._cond.wait()
+                    next_tick = self._clock() + self._wheel.tick
+                    continue
+                delay = next_tick - self._clock()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                next_tick += self._wheel.tick
+                due = self._wheel.advance()
+                if due:
+                    self._ready.extend(due)
+                    self._cond.notify_all()
+
+    def _poll_loop(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                w = self._ready.popleft()
+                blocking = self._can_block(w)
+            w.context.run(self._poll, w, blocking)
+
+    def _can_block(self, w):
+        # A WAIT holds its thread, so only make one while a thread is left free
+        # for the other jobs.  Called with the lock held.
+        return w.wait_for_statechange and len(self._watches) < self._nthreads
+
+    def _poll(self, w, blocking):
+        remaining = w.expires - self._clock()
+        if remaining <= 0:
+            self._finish(w, self._timeout(w))
+            return
+        try:
+            if blocking:
+                finished = w.job.poll(w.phases, wait_for_statechange=True,
+                                      timeout=max(1, math.ceil(min(self._wait, remaining))))
+            else:
+                finished = w.job.poll(w.phases, timeout=self._request_timeout)
+        except Exception as e:
+            self._finish(w, e)
+            return
+
+        remaining = w.expires - self._clock()
+        if finished:
+            self._finish(w, None)
+        elif remaining <= 0:
+            self._finish(w, self._timeout(w))
+        else:
+            with self._cond:
+                if self._can_block(w):
+                    self._ready.append(w)
+                else:
+                    if not blocking:
+                        w.interval = min(self._max_interval, w.interval * self._increment)
+                    self._wheel.add(w, min(w.interval, remaining))
+                self._cond.notify_all()
+
+    def _timeout(self, w):
+        # Called from _poll, in the job's context.
+        deadline = current_deadline()
+        if deadline is not None and deadline.expired:
+            return QueryTimeout(f'Query exceeded its total timeout of {deadline.total}s')
+        return QueryTimeout(f'Async TAP job timed out, exceeding {w.total_timeout}s.')
+
+    def _finish(self, w, error):
+        with self._cond:
+            if w not in self._watches:
+                return
+            self._watches.discard(w)
+        try:
+            w.callback(error)
+        except Exception as e:
+            logging.error(f'Error notifying the waiter for UWS job {w.job.url}: {repr(e)}')
+        finally:
+            w.done.set()
+
+
+class _Watch():
+    def __init__(self, job, phases, callback, context, expires, total_timeout,
+                 wait_for_statechange, interval):
+        self.job = job
+        self.phases = phases
+        self.callback = callback
+        self.context = context
+        self.expires = expires
+        self.total_timeout = total_timeout
+        self.wait_for_statechange = wait_for_statechange
+        self.interval = interval
+        self.done = threading.Event()
+
+
+class _TimerWheel():
+    """
+    A hashed timer wheel: items are put in the slot for the tick at which
+    they are due, with the number of turns of the wheel still to go.
+    """
+
+    def __init__(self, tick, slots=1024):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._current = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, item, delay):
+        ticks = max(1, math.ceil(delay / self.tick))
+        turns, offset = divmod(ticks, len(self._slots))
+        if offset == 0:
+            turns, offset = turns - 1, len(self._slots)
+        slot = (self._current + offset) % len(self._slots)
+        self._slots[slot].append([turns, item])
+        self._count += 1
+
+    def advance(self):
+        """
+        Move to the next tick, returning the items that are due.
+        """
+        self._current = (self._current + 1) % len(self._slots)
+        slot = self._slots[self._current]
+        due = [item for turns, item in slot if turns == 0]
+        self._slots[self._current] = [[turns - 1, item] for turns, item in slot if turns > 0]
+        self._count -= len(due)
+        return due
@@ -0,0 +1,248 @@
+"""
+Extract result metadata from a VOTable as its bytes arrive.
+"""
+import binascii
+from xml.parsers import expat
+
+__all__ = ['VOTableMetaExtractor']
+
+# Bytes per element for each VOTable datatype.  'bit' is handled separately.
+_DATATYPE_SIZES = {
+    'boolean': 1,
+    'unsignedByte': 1,
+    'short': 2,
+    'int': 4,
+    'long': 8,
+    'char': 1,
+    'unicodeChar': 2,
+    'float': 4,
+    'double': 8,
+    'floatComplex': 8,
+    'doubleComplex': 16,
+}
+
+_WHITESPACE = b' \t\r\n'
+
+
+class VOTableMetaExtractor():
+    """
+    Incrementally parse a VOTable to find the number of rows and columns of its
+    first table, along with the value of its QUERY_STATUS INFO element.
+
+    Bytes are given to `feed` as they are downloaded, so no copy of the
+    table needs to be kept or parsed afterwards.  TABLEDATA rows are counted
+    as they are parsed, and BINARY and BINARY2 streams are decoded just far
+    enough to find the row boundaries.
+
+    Attributes
+    ----------
+    size : int
+        Number of bytes fed.
+    num_rows : int or None
+        Number of rows in the first table, or None if they could not be counted
+        (e.g., FITS serialization or an externally referenced stream).
+    num_columns : int or None
+        Number of FIELDs in the first table.
+    query_status : str or None
+        The value of the QUERY_STATUS INFO, e.g., 'OK', 'ERROR' or 'OVERFLOW'.
+        An ERROR status is not replaced by a later QUERY_STATUS.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.num_rows = None
+        self.num_columns = None
+        self.query_status = None
+        self._error = None
+
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._chars
+
+        self._tables_seen = 0
+        self._in_first_table = False
+        self._fields = []
+        self._serialization = None
+        self._binary_rows = None
+
+    def feed(self, data):
+        """
+        Parse the next chunk of bytes.  Parsing errors are saved for `raise_if_error`
+        rather than raised, so they do not interrupt the download.
+        """
+        self.size += len(data)
+        if self._error is None:
+            try:
+                self._parser.Parse(data, False)
+            except Exception as e:
+                self._error = e
+
+    def close(self):
+        """
+        Signal the end of the data.
+        """
+        if self._error is None:
+            try:
+                self._parser.Parse(b'', True)
+            except Exception as e:
+                self._error = e
+
+    def raise_if_error(self):
+        """
+        Raise an exception if the data was not a VOTable containing a table.
+        """
+        if self._error is not None:
+            raise ValueError(f'Unable to parse VOTable: {self._error}')
+        if self._tables_seen == 0:
+            raise ValueError('No table found in VOTable')
+
+    def _start(self, name, attrs):
+        name = _local_name(name)
+        if name == 'TABLE':
+            self._tables_seen += 1
+            if self._tables_seen == 1:
+                self._in_first_table = True
+                self.num_rows = 0
+        elif name == 'INFO':
+            if attrs.get('name') == 'QUERY_STATUS' and self.query_status != 'ERROR':
+                self.query_status = attrs.get('value')
+        elif not self._in_first_table:
+            pass
+        elif name == 'FIELD':
+            self._fields.append((attrs.get('datatype'), attrs.get('arraysize')))
+        elif name == 'DATA':
+            self.num_columns = len(self._fields)
+        elif name in ('TABLEDATA', 'BINARY', 'BINARY2', 'FITS'):
+            self._serialization = name
+            if name == 'FITS':
+                self.num_rows = None
+        elif name == 'STREAM' and self._serialization in ('BINARY', 'BINARY2'):
+            if attrs.get('href') is None and attrs.get('encoding', 'base64') == 'base64':
+                self._binary_rows = _BinaryRowCounter(self._fields, self._serialization == 'BINARY2')
+            else:
+                self.num_rows = None
+
+    def _end(self, name):
+        if not self._in_first_table:
+            return
+        name = _local_name(name)
+        if name == 'TR' and self._serialization == 'TABLEDATA':
+            self.num_rows += 1
+        elif name == 'STREAM' and self._binary_rows is not None:
+            self.num_rows = self._binary_rows.close()
+            self._binary_rows = None
+        elif name == 'TABLE':
+            self._in_first_table = False
+            if self.num_columns is None:
+                self.num_columns = len(self._fields)
+
+    def _chars(self, data):
+        if self._binary_rows is not None:
+            self._binary_rows.feed_base64(data)
+
+
+class _BinaryRowCounter():
+    """
+    Counts the rows in a base64 encoded BINARY or BINARY2 stream.
+    """
+
+    def __init__(self, fields, binary2):
+        self._rows = 0
+        self._pending_b64 = b''
+        self._buf = bytearray()
+
+        # Each field is either fixed length (nbytes, None) or variable
+        # length (None, (bytes_per_item, items_per_count, is_bit)).
+        self._layout = [_field_layout(datatype, arraysize) for datatype, arraysize in fields]
+
+        # BINARY2 rows start with a null flag bit per field.
+        self._mask_size = (len(fields) + 7) // 8 if binary2 else 0
+
+        if all(var is None for _, var in self._layout):
+            self._row_size = self._mask_size + sum(size for size, _ in self._layout)
+        else:
+            self._row_size = None
+
+    def feed_base64(self, text):
+        chars = self._pending_b64 + text.encode('ascii').translate(None, _WHITESPACE)
+        usable = len(chars) - len(chars) % 4
+        self._pending_b64 = chars[usable:]
+        if usable:
+            self._feed(binascii.a2b_base64(chars[:usable]))
+
+    def close(self):
+        if self._pending_b64:
+            raise ValueError('Truncated base64 data in VOTable STREAM')
+        if self._buf:
+            raise ValueError('Incomplete row in VOTable STREAM')
+        return self._rows
+
+    def _feed(self, data):
+        self._buf.extend(data)
+        buf = self._buf
+        if self._row_size is not None:
+            if self._row_size == 0:
+                raise ValueError('VOTable has no fields for its binary stream')
+            nrows = len(buf) // self._row_size
+            self._rows += nrows
+            del buf[:nrows * self._row_size]
+            return
+
+        pos = 0
+        nbuf = len(buf)
+        while True:
+            p = pos + self._mask_size
+            for size, var in self._layout:
+                if size is not None:
+                    p += size
+                else:
+                    if p + 4 > nbuf:
+                        p = nbuf + 1
+                        break
+                    count = int.from_bytes(buf[p:p + 4], 'big')
+                    p += 4 + _var_size(count, var)
+                if p > nbuf:
+                    break
+            if p > nbuf:
+                break
+            self._rows += 1
+            pos = p
+        del buf[:pos]
+
+
+def _field_layout(datatype, arraysize):
+    is_bit = datatype == 'bit'
+    if not is_bit and datatype not in _DATATYPE_SIZES:
+        raise ValueError(f'Unknown VOTable datatype: {datatype}')
+    item_size = 1 if is_bit else _DATATYPE_SIZES[datatype]
+
+    items = 1
+    variable = False
+    if arraysize:
+        dims = arraysize.split('x')
+        for dim in dims[:-1]:
+            items *= int(dim)
+        last = dims[-1]
+        if last.endswith('*'):
+            variable = True
+        else:
+            items *= int(last)
+
+    if variable:
+        return None, (item_size, items, is_bit)
+    if is_bit:
+        return (items + 7) // 8, None
+    return item_size * items, None
+
+
+def _var_size(count, var):
+    item_size, items_per_count, is_bit = var
+    if is_bit:
+        return (count * items_per_count + 7) // 8
+    return count * items_per_count * item_size
+
+
+def _local_name(name):
+    return name.rpartition(':')[2]
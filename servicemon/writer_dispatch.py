@@ -0,0 +1,252 @@
+"""
+A dispatch stage between the queries and the result writers.
+
+Without it, every writer's one_result is called in turn between queries, so a
+slow writer, such as one posting to a remote database or fsyncing a file,
+delays the next query and changes the load on the services.  The dispatch
+stage instead gives each writer a bounded queue and a thread of its own that
+hands it the stats in order.  When a writer falls so far behind that its queue
+is full, the overflow policy decides what happens to the next stats:
+
+block
+    Wait for room in the queue, as the writers did before, but only once the
+    queue is full.
+drop_oldest
+    Drop the oldest stats in the queue to make room.
+spill
+    Append the stats to a spill file, from which the writer's thread reads
+    them back, in order, once it has caught up with its queue.
+
+`WriterDispatch.put` returns a Future that completes once every writer's
+one_result has returned for the stats.  It fails instead if a writer raised or
+the stats were dropped, so that a caller such as the progress journal can wait
+to record a query until its results are really written.  Stats still queued
+when the process is killed are lost with the daemon threads, and their Futures
+never complete.
+
+The time each writer takes for one_result and the depth of its queue are
+recorded, and summarized by `WriterDispatch.metrics`.
+"""
+import collections
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+from astropy.table import Table
+
+__all__ = ['WriterDispatch']
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'spill')
+
+
+class WriterDispatch():
+    """
+    Hands stats to each of a list of writers from a thread per writer.
+
+    Parameters
+    ----------
+    writers : list of AbstractResultWriter
+        The writers, which must have begun.
+    queue_size : int
+        Most stats waiting for each writer, not counting any spilled.
+    overflow : str
+        What to do with stats for a writer whose queue is full: 'block',
+        'drop_oldest' or 'spill'.
+    spill_dir : str or None
+        Directory for the spill files, the system's temporary directory if None.
+    """
+
+    def __init__(self, writers, queue_size=1000, overflow='block', spill_dir=None):
+        if queue_size < 1:
+            raise ValueError(f'Queue size must be at least 1: {queue_size}')
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+        self._workers = [_WriterWorker(w, i, queue_size, overflow, spill_dir)
+                         for i, w in enumerate(writers)]
+
+    def put(self, stats):
+        """
+        Queue stats for every writer.
+
+        Returns
+        -------
+        `~concurrent.futures.Future`
+            Completes, from a writer's thread, once every writer has written
+            the stats, or fails if a writer raised or the stats were dropped.
+        """
+        written = _Written(len(self._workers))
+        for worker in self._workers:
+            worker.put(stats, written)
+        return written.future
+
+    def close(self):
+        """
+        Wait until every writer has been given all the stats queued and
+        spilled for it, then stop the threads.  The writers are not ended.
+        """
+        for worker in self._workers:
+            worker.close()
+
+    def metrics(self):
+        """
+        Summarize the dispatch as a Table with one row per writer.
+
+        Returns
+        -------
+        `~astropy.table.Table`
+            With columns writer, written, dropped, spilled, errors, max_depth
+            (the most stats queued for the writer at once, not counting spilled
+            ones), and the mean, p95 and max of the time one_result took, in
+            seconds.
+        """
+        rows = []
+        for worker in self._workers:
+            with worker.cond:
+                latencies = np.array(worker.latencies, dtype=float)
+                if len(latencies):
+                    mean, p95, top = latencies.mean(), np.percentile(latencies, 95), latencies.max()
+                else:
+                    mean = p95 = top = np.nan
+                rows.append((worker.name, len(latencies), worker.dropped, worker.spilled,
+                             worker.errors, worker.max_depth, mean, p95, top))
+
+        table = Table(rows=rows if rows else None,
+                      names=('writer', 'written', 'dropped', 'spilled', 'errors', 'max_depth',
+                             'mean', 'p95', 'max'),
+                      dtype=(str, int, int, int, int, int, float, float, float))
+        for col in ('mean', 'p95', 'max'):
+            table[col].format = '.6f'
+        return table
+
+
+class _Written():
+    """
+    Completes a Future once each of a number of writers is done with the same stats.
+    """
+
+    def __init__(self, count):
+        self.future = Future()
+        self._lock = threading.Lock()
+        self._remaining = count
+        self._error = None
+        if not count:
+            self.future.set_result(None)
+
+    def done(self, error=None):
+        with self._lock:
+            self._remaining -= 1
+            if error is not None and self._error is None:
+                self._error = error
+            if self._remaining:
+                return
+        if self._error is None:
+            self.future.set_result(None)
+        else:
+            self.future.set_exception(self._error)
+
+
+class _WriterWorker():
+    def __init__(self, writer, index, queue_size, overflow, spill_dir):
+        self.writer = writer
+        self.name = type(writer).__name__
+        self.cond = threading.Condition()
+        self.latencies = []
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+        self.max_depth = 0
+        self._queue_size = queue_size
+        self._overflow = overflow
+        self._spill_dir = spill_dir
+        self._queue = collections.deque()
+        self._spill_file = None
+        # The _Written for each spilled stats, in the order they were spilled.
+        self._spilled_written = collections.deque()
+        self._unread = 0
+        self._read_pos = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f'sm_writer{index}', daemon=True)
+        self._thread.start()
+
+    def put(self, stats, written):
+        with self.cond:
+            if self._unread or len(self._queue) >= self._queue_size:
+                if self._overflow == 'block':
+                    while len(self._queue) >= self._queue_size:
+                        self.cond.wait()
+                elif self._overflow == 'drop_oldest':
+                    _, dropped = self._queue.popleft()
+                    dropped.done(RuntimeError(f'Dropped from the full queue for {self.name}'))
+                    self.dropped += 1
+                else:
+                    # Once spilling, keep spilling until the spill is read back,
+                    # so that the writer gets the stats in order.
+                    self._spill(stats, written)
+                    self.cond.notify_all()
+                    return
+            self._queue.append((stats, written))
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self._closed = True
+            self.cond.notify_all()
+        self._thread.join()
+        if self._spill_file is not None:
+            self._spill_file.close()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self._queue and not self._unread and not self._closed:
+                    self.cond.wait()
+                if self._queue:
+                    stats, written = self._queue.popleft()
+                    self.cond.notify_all()
+                elif self._unread:
+                    stats, written = self._unspill()
+                else:
+                    return
+
+            start = time.perf_counter()
+            try:
+                self.writer.one_result(stats)
+            except Exception as e:
+                logging.error(f'Error writing stats with {self.name}: {repr(e)}')
+                with self.cond:
+                    self.errors += 1
+                written.done(e)
+                continue
+            latency = time.perf_counter() - start
+            with self.cond:
+                self.latencies.append(latency)
+            written.done()
+
+    def _spill(self, stats, written):
+        if self._spill_file is None:
+            if self._spill_dir is not None:
+                os.makedirs(self._spill_dir, exist_ok=True)
+            self._spill_file = tempfile.TemporaryFile(prefix=f'sm_spill_{self.name}_', dir=self._spill_dir)
+        self._spill_file.seek(0, os.SEEK_END)
+        pickle.dump(stats, self._spill_file)
+        self._spilled_written.append(written)
+        self._unread += 1
+        self.spilled += 1
+
+    def _unspill(self):
+        self._spill_file.seek(self._read_pos)
+        stats = pickle.load(self._spill_file)
+        self._read_pos = self._spill_file.tell()
+        self._unread -= 1
+        if not self._unread:
+            # Start the file over, so it only grows as far as the writer falls behind.
+            self._spill_file.seek(0)
+            self._spill_file.truncate()
+            self._read_pos = 0
+        return stats, self._spilled_written.popleft()